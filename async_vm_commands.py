@@ -0,0 +1,249 @@
+import asyncssh
+import asyncio
+import fabric
+import invoke
+import logging
+import os
+import shlex
+import tarfile
+import test_VM_commands as vm
+
+
+class AsyncConnection:
+    """
+    Asyncio counterpart of fabric.Connection, returned by connect. Exposes host and user like fabric.Connection,
+    So the results and logs of the coroutines below have the same shape as the ones of test_VM_commands
+    """
+
+    def __init__(self, host: str, user: str, connection: asyncssh.SSHClientConnection):
+        self.host = host
+        self.user = user
+        self.connection = connection
+        self._sftp = None
+
+    async def sftp(self) -> asyncssh.SFTPClient:
+        """
+        Returns SFTP client of the connection. It is started once and reused, as in fabric
+        :return: asyncssh.SFTPClient
+        """
+        if self._sftp is None:
+            self._sftp = await self.connection.start_sftp_client()
+        return self._sftp
+
+    async def close(self) -> None:
+        if self._sftp is not None:
+            self._sftp.exit()
+        self.connection.close()
+        await self.connection.wait_closed()
+
+
+async def connect(ip_addr: str, *, username: str, key_path: str, port: int = 22) -> AsyncConnection:
+    """
+    Establishes an SSH connection with specified parameters. Async variant of test_VM_commands.connect
+    Unlike there, the connection is kept open and is used by the other coroutines of this module
+    :param ip_addr: str
+    :param username: str
+    :param key_path: str
+    :param port: int
+    :return: AsyncConnection
+    :raises ConnectionError: if connection was not established. Reason is logged
+    """
+    err_str = f"Connection to {ip_addr} not established. Reason: "
+    try:
+        if not os.path.exists(key_path):
+            raise FileNotFoundError(key_path)
+        connection = await asyncio.wait_for(
+            asyncssh.connect(ip_addr, port=port, username=username, client_keys=[key_path], known_hosts=None),
+            timeout=10)
+    except asyncio.TimeoutError:
+        logging.exception(err_str + "timed out", exc_info=False)
+    except FileNotFoundError:
+        logging.exception(err_str + f"key file at {key_path} does not exist", exc_info=False)
+    except asyncssh.KeyImportError:
+        logging.exception(err_str + f"invalid key format", exc_info=False)
+    except (asyncssh.PermissionDenied, asyncssh.DisconnectError):
+        logging.exception(err_str + "authentication failed (most likely) or invalid key format", exc_info=False)
+    else:
+        return AsyncConnection(ip_addr, username, connection)
+
+    raise ConnectionError
+
+
+async def execute(target_con: AsyncConnection, *, command: str, sudo: bool = False) -> fabric.Result:
+    """
+    Performs a command on a machine specified in the connection. Async variant of test_VM_commands.execute
+    If sudo is true, the command will be executed as an elevated user (passwordless sudo is required)
+    invoke.UnexpectedExit is raised (and logged) if command execution returns an error code
+    :param target_con: AsyncConnection
+    :param command: str
+    :param sudo: bool
+    :return: fabric.Result
+    """
+    remote_command = f"sudo -n bash -c {shlex.quote(command)}" if sudo else command
+    completed = await target_con.connection.run(remote_command, check=False)
+    result = fabric.Result(connection=target_con, command=command,
+                           exited=completed.exit_status if completed.exit_status is not None else -1,
+                           stdout=completed.stdout or "", stderr=completed.stderr or "", hide=("stdout", "stderr"))
+    if result.return_code != 0:
+        logging.error(vm.EXEC_ERR_LOG.format(result))
+        raise invoke.UnexpectedExit(result)
+
+    if len(result.stdout) == 0:
+        result.stdout = "<NO_OUTPUT>"
+    logging.info(vm.EXEC_LOG.format(result))
+    return result
+
+
+async def execute_with_input(target_con: AsyncConnection, *, command: str, data: bytes,
+                             sudo: bool = False) -> fabric.Result:
+    """
+    Performs a command like execute, but data is streamed to its standard input. Async variant of
+    test_VM_commands.execute_with_input
+    :param target_con: AsyncConnection
+    :param command: str
+    :param data: bytes
+    :param sudo: bool
+    :return: fabric.Result
+    """
+    remote_command = f"sudo -n bash -c {shlex.quote(command)}" if sudo else command
+    completed = await target_con.connection.run(remote_command, input=data, encoding=None, check=False)
+    result = fabric.Result(connection=target_con, command=command,
+                           exited=completed.exit_status if completed.exit_status is not None else -1,
+                           stdout=(completed.stdout or b"").decode(errors="replace"),
+                           stderr=(completed.stderr or b"").decode(errors="replace"), hide=("stdout", "stderr"))
+    if result.return_code != 0:
+        logging.error(vm.EXEC_ERR_LOG.format(result))
+        raise invoke.UnexpectedExit(result)
+    logging.info(vm.EXEC_LOG.format(result))
+    return result
+
+
+async def put_file(target_con: AsyncConnection, local_path: str, dest_path: str, *,
+                   permissions: str = "644", overwrite: bool = False, sudo: bool = False) -> str:
+    """
+    Transfers a file found at local_path to the machine specified in target_con. Async variant of
+    test_VM_commands.put_file, with the same parameters, error handling and return value
+    Returns the remote path of the file that was put. Returns empty string if transfer failed
+    :param target_con: AsyncConnection
+    :param local_path: str
+    :param dest_path: str
+    :param permissions: str
+    :param overwrite: bool
+    :param sudo: bool
+    :return: str
+    """
+    quoted = shlex.quote(dest_path)
+    try:
+        if not os.path.isfile(local_path):
+            raise FileNotFoundError(f"Local file {local_path} does not exist")
+        if not overwrite:  # We need to check if file exists already on target
+            check = await execute(target_con, command=f"test -e {quoted} && echo exists || true", sudo=sudo)
+            if check.stdout.strip() == "exists":
+                raise FileExistsError("Overwrite flag was not set, but file already exists on target machine!")
+
+        sftp = await target_con.sftp()
+        if sudo:  # Same principle as in test_VM_commands.sudo_put_file
+            with open(local_path, "rb") as file:
+                data = file.read()
+            await execute_with_input(target_con, command=f"install -o root -g root -m {permissions} /dev/stdin "
+                                                         f"{quoted}", data=data, sudo=True)
+        else:
+            await sftp.put(local_path, dest_path)
+            await sftp.chmod(dest_path, int(permissions, 8))
+
+    except (FileNotFoundError, FileExistsError) as e:  # General error raised if transfer fails
+        logging.exception(f"File related error occurred while transferring {local_path}\nReason: {e}")
+    except (OSError, asyncssh.SFTPError):
+        logging.exception(f"Error occured while transferring {local_path} to {dest_path}.")
+    except invoke.UnexpectedExit:
+        logging.exception("Error while executing remote command in put_file. Check previous exception",
+                          exc_info=False)
+    else:  # If no exceptions are caught
+        return dest_path
+
+    return ""  # When an exception is caught, the else in try: else: is not executed
+
+
+async def get_file(target_con: AsyncConnection, remote_path: str, dest_path: str = "", *,
+                   folder_mode: bool = False, sudo: bool = False, pattern: str = "*") -> None:
+    """
+    Transfers file from remote machine specified in target_con, to local filesystem.
+    Async variant of test_VM_commands.get_file. Dest_path should be relative to the 'transfers' folder.
+    If folder_mode is true, files of the remote folder matching the pattern are fetched as one tar stream
+    :param target_con: AsyncConnection
+    :param remote_path: str
+    :param dest_path: str
+    :param folder_mode: bool
+    :param sudo: bool
+    :param pattern: str
+    :return: None
+    """
+    try:
+        if folder_mode:
+            packed = await execute(target_con, command=vm.folder_pack_command(remote_path, pattern), sudo=sudo)
+            vm.unpack_folder(packed.stdout, dest_path)
+            return
+
+        local_path = f"./transfers/{dest_path}"
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        sftp = await target_con.sftp()
+        if sudo:  # Copy to a temporary file of the user first. Mktemp creates it with mode 600, unreadable to others
+            copy = await execute(target_con, command=f"t=$(mktemp /tmp/vm_automation_XXXXXX) || exit 1; "
+                                                     f"install -o {target_con.user} -m 600 {shlex.quote(remote_path)} "
+                                                     f"\"$t\" || {{ rm -f \"$t\"; exit 1; }}; echo \"$t\"", sudo=True)
+            temp_file = copy.stdout.strip()
+            try:
+                await sftp.get(temp_file, local_path)
+            finally:
+                await execute(target_con, command=f"rm -f {temp_file}", sudo=True)
+        else:
+            await sftp.get(remote_path, local_path)
+
+    except invoke.UnexpectedExit:
+        logging.exception(f"Transfer failed: unable to fetch {remote_path}. Check previous exception", exc_info=False)
+    except (ValueError, OSError, asyncssh.SFTPError, tarfile.TarError):
+        logging.exception(f"Transfer failed: unable to fetch {remote_path}")
+
+
+async def run_all(targets: list, coroutine_func, *args, limit: int = 64,
+                  **kwargs) -> ({str: object}, {str: Exception}):
+    """
+    Runs coroutine_func(target, *args, **kwargs) for all targets concurrently in one event loop
+    At most limit coroutines run at once. Async variant of test_VM_commands.run_parallel
+    Targets are AsyncConnection objects or ip addresses. Returns results and errors keyed by host
+    :param targets: [AsyncConnection] or [str]
+    :param coroutine_func: coroutine function
+    :param limit: int
+    :return: ({str: object}, {str: Exception})
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _run(target):
+        async with semaphore:
+            return await coroutine_func(target, *args, **kwargs)
+
+    hosts = [target.host if isinstance(target, AsyncConnection) else target for target in targets]
+    outcomes = await asyncio.gather(*(_run(target) for target in targets), return_exceptions=True)
+    results, errors = {}, {}
+    for host, outcome in zip(hosts, outcomes):
+        if isinstance(outcome, Exception):
+            logging.error(f"{coroutine_func.__name__} failed on {host}: {outcome!r}")
+            errors[host] = outcome
+        else:
+            results[host] = outcome
+    return results, errors
+
+
+async def init_connections(conn_dict: {str: str}, *, username: str = "open5gs",
+                           port: int = 22) -> ({str: AsyncConnection}, {str: Exception}):
+    """
+    Connects to all machines from the ip_addr:key_path dictionary concurrently
+    :param conn_dict: {str: str}
+    :param username: str
+    :param port: int
+    :return: ({str: AsyncConnection}, {str: Exception})
+    """
+    async def _connect(ip: str) -> AsyncConnection:
+        return await connect(ip, username=username, key_path=conn_dict[ip], port=port)
+
+    return await run_all(list(conn_dict), _connect)
@@ -0,0 +1,293 @@
+import test_VM_commands as vm
+import yaml_processing as config
+from fixtures import TEMPLATES, TEMPLATE_PATHS
+import argparse
+import contextlib
+import getpass
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Diff of the n-th variant of every template. Same keys as the drivers use
+VARIANTS = {
+    "amf": lambda i: {'amf-ngap0-addr': f"10.0.{i // 250 % 250}.{i % 250 + 1}", 'amf-guami-plmn_id-mcc': '001',
+                      'amf-guami-plmn_id-mnc': '01', 'amf-tai-plmn_id-mcc': '001', 'amf-tai-plmn_id-mnc': '01'},
+    "smf": lambda i: {'smf-pfcp0-addr': f"10.0.{i // 250 % 250}.{i % 250 + 1}", 'smf-subnet0-addr': "10.45.0.1/16",
+                      'smf-subnet0-dnn': "internet", 'smf-subnet1-addr': "10.46.0.1/16", 'smf-subnet1-dnn': "ims",
+                      'upf-pfcp0-addr': "10.1.0.1", 'upf-pfcp0-dnn': ["internet", "ims"]},
+    "upf": lambda i: {'upf-pfcp0-addr': f"10.0.{i // 250 % 250}.{i % 250 + 1}", 'upf-gtpu0-addr': "10.1.0.1",
+                      'upf-subnet0-dev': "ogstun"},
+    "gnb": lambda i: {'mcc': '001', 'mnc': '01', 'linkIp': f"10.0.{i // 250 % 250}.{i % 250 + 1}",
+                      'amfConfigs0-address': "10.1.0.1"},
+    "ue": lambda i: {'supi': f"imsi-00101{i:010d}", 'mcc': '001', 'mnc': '01', 'gnbSearchList0': "10.1.0.2",
+                     'sessions0-apn': "ims" if i % 2 else "internet"},
+}
+DEFAULT_SIZES = (1, 100, 10000)
+
+
+@contextlib.contextmanager
+def bench_workdir():
+    """
+    Runs the block in a temporary working directory with the templates in ./transfers/all_open5gs and
+    ./transfers/all_ueransim, as modify_helper and the transfer functions use paths relative to ./transfers
+    """
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="vm_automation_bench_") as workdir:
+        for path, text in TEMPLATES.items():
+            file_path = os.path.join(workdir, "transfers", path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w", newline="\n") as file:
+                file.write(text.lstrip())
+        os.chdir(workdir)
+        try:
+            yield workdir
+        finally:
+            os.chdir(old_cwd)
+
+
+def summary(name: str, samples: [float], *, ops: int = 1, **params) -> dict:
+    """
+    Returns one benchmark result. Samples are durations in seconds of runs that did ops operations each
+    :param name: str
+    :param samples: [float]
+    :param ops: int
+    :return: dict
+    """
+    per_op = sorted(sample / ops for sample in samples)
+    return {"name": name, **params, "ops": ops, "runs": len(samples),
+            "total_s": round(sum(samples), 6),
+            "mean_us": round(statistics.fmean(per_op) * 1e6, 3),
+            "p50_us": round(per_op[len(per_op) // 2] * 1e6, 3),
+            "p95_us": round(per_op[min(len(per_op) - 1, int(len(per_op) * 0.95))] * 1e6, 3),
+            "min_us": round(per_op[0] * 1e6, 3),
+            "ops_per_s": round(ops * len(samples) / sum(samples), 1) if sum(samples) > 0 else None}
+
+
+def timed(func, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_config(sizes: [int] = DEFAULT_SIZES, elements: [str] = tuple(VARIANTS)) -> [dict]:
+    """
+    Measures throughput of read_yaml, modify_yaml, write_yaml and modify_helper for every template element,
+    Generating the given numbers of variants. Has to be run inside bench_workdir
+    :param sizes: [int]
+    :param elements: [str]
+    :return: [dict]
+    """
+    results = []
+    for element in elements:
+        template_path = f"./transfers/{TEMPLATE_PATHS[element]}"
+        template = config.read_yaml(template_path)
+        for n in sizes:
+            diffs = [VARIANTS[element](i) for i in range(n)]
+            params = {"element": element, "variants": n}
+
+            def read_all():
+                for _ in range(n):
+                    config.read_yaml(template_path)
+
+            modified = []
+
+            def modify_all():
+                for diff in diffs:
+                    modified.append(config.modify_yaml(template, diff))
+
+            def write_all():
+                for i, yaml_data in enumerate(modified):
+                    config.write_yaml(f"./transfers/bench/{element}/{i}.yaml", yaml_data, overwrite=True)
+
+            def helper_all():
+                for i, diff in enumerate(diffs):
+                    config.modify_helper(element, f"bench/helper_{element}/{i}.yaml", diff, overwrite=True)
+
+            os.makedirs(f"./transfers/bench/{element}", exist_ok=True)
+            results.append(summary("read_yaml", [timed(read_all)], ops=n, **params))
+            results.append(summary("modify_yaml", [timed(modify_all)], ops=n, **params))
+            results.append(summary("write_yaml", [timed(write_all)], ops=n, **params))
+            results.append(summary("modify_helper", [timed(helper_all)], ops=n, **params))
+    return results
+
+
+def bench_engine(sizes: [int] = DEFAULT_SIZES, elements: [str] = ("ue", "gnb")) -> [dict]:
+    """
+    Compares parse and serialize throughput of the preconfigured yaml engines (see yaml_processing.YamlEngine)
+    To the ruamel.yaml module functions that read_yaml and write_yaml used before (legacy)
+    Engine results carry speedup_vs_legacy. Legacy benchmarks are skipped if the installed ruamel has removed them
+    :param sizes: [int]
+    :param elements: [str]
+    :return: [dict]
+    """
+    import ruamel.yaml
+    import warnings
+    results = []
+    for element in elements:
+        text = TEMPLATES[TEMPLATE_PATHS[element]].lstrip()
+        template = config.parse_yaml(text)
+        for n in sizes:
+            documents = [config.overlay_yaml(template, VARIANTS[element](i)) for i in range(n)]
+            texts = [config.yaml_to_string(document) for document in documents]
+            params = {"element": element, "variants": n}
+            legacy = {}
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                try:
+                    legacy["load"] = timed(lambda: [ruamel.yaml.safe_load(t) for t in texts])
+                    legacy["dump"] = timed(lambda: [ruamel.yaml.dump(d, default_flow_style=False)
+                                                    for d in documents])
+                except (AttributeError, TypeError):  # Module functions were removed in ruamel.yaml 0.18
+                    legacy = {}
+            for operation, seconds in legacy.items():
+                results.append(summary(f"legacy_{operation}", [seconds], ops=n, **params))
+
+            engine = {"load": timed(lambda: [config.SAFE_ENGINE.load(t) for t in texts]),
+                      "dump": timed(lambda: [config.SAFE_ENGINE.dump(d) for d in documents])}
+            for operation, seconds in engine.items():
+                result = summary(f"engine_{operation}", [seconds], ops=n,
+                                 accelerated=config.SAFE_ENGINE.accelerated, **params)
+                if operation in legacy:
+                    result["speedup_vs_legacy"] = round(legacy[operation] / seconds, 2)
+                results.append(result)
+
+            round_trip = [config.ROUND_TRIP_ENGINE.load(t) for t in texts[:1]] * n
+            results.append(summary("round_trip_load", [timed(lambda: [config.ROUND_TRIP_ENGINE.load(t)
+                                                                      for t in texts])], ops=n, **params))
+            results.append(summary("round_trip_dump", [timed(lambda: [config.ROUND_TRIP_ENGINE.dump(d)
+                                                                      for d in round_trip])], ops=n, **params))
+    return results
+
+
+def bench_transfer(*, repeat: int = 20, sizes_kb: [int] = (4, 1024)) -> [dict]:
+    """
+    Measures latency of execute, put_file and get_file against local_ssh_server.LocalSSHServer
+    Connection setup is measured too, as every driver pays it once per machine
+    Has to be run inside bench_workdir
+    :param repeat: int
+    :param sizes_kb: [int]
+    :return: [dict]
+    """
+    from local_ssh_server import LocalSSHServer  # asyncssh is needed only for these benchmarks
+    server = LocalSSHServer()
+    server.start_in_thread()
+    results = []
+    try:
+        username = getpass.getuser()
+        connections = []
+
+        def connect():
+            connections.append(vm.connect(server.host, username=username, key_path=server.client_key_path,
+                                          keep_open=True, port=server.port))
+
+        results.append(summary("connect", [timed(connect) for _ in range(min(repeat, 5))]))
+        c = connections[-1]
+        for other in connections[:-1]:
+            other.close()
+
+        results.append(summary("execute", [timed(vm.execute, c, command="true") for _ in range(repeat)]))
+        for size_kb in sizes_kb:
+            local_path = os.path.abspath(f"./transfers/bench_{size_kb}k.bin")
+            with open(local_path, "wb") as file:
+                file.write(os.urandom(size_kb * 1024))
+            remote_path = local_path + ".remote"
+            results.append(summary("put_file", [timed(vm.put_file, c, local_path, remote_path, overwrite=True)
+                                                for _ in range(repeat)], size_kb=size_kb))
+            results.append(summary("get_file", [timed(vm.get_file, c, remote_path, f"bench_{size_kb}k.fetched")
+                                                for _ in range(repeat)], size_kb=size_kb))
+        c.close()
+    finally:
+        server.stop_in_thread()
+    return results
+
+
+def environment() -> dict:
+    """
+    Returns details of the machine and code the benchmarks were run on, stored next to the results
+    :return: dict
+    """
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        revision = ""
+    return {"timestamp": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+            "platform": platform.platform(), "revision": revision}
+
+
+def compare(results: [dict], baseline: [dict], *, threshold: float = 0.2) -> [dict]:
+    """
+    Compares mean latencies of results to the baseline (results of an earlier run)
+    Returns the benchmarks that got slower by more than threshold (0.2 = 20 %)
+    :param results: [dict]
+    :param baseline: [dict]
+    :param threshold: float
+    :return: [dict]
+    """
+    def key(result: dict) -> tuple:
+        return tuple(sorted((k, v) for k, v in result.items() if k in ("name", "element", "variants", "size_kb")))
+
+    old = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = old.get(key(result))
+        if previous is not None and previous["mean_us"] > 0:
+            ratio = result["mean_us"] / previous["mean_us"]
+            if ratio > 1 + threshold:
+                regressions.append({**dict(key(result)), "baseline_us": previous["mean_us"],
+                                    "mean_us": result["mean_us"], "ratio": round(ratio, 3)})
+    return regressions
+
+
+def main(argv: [str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of config generation and transfer functions. "
+                                                 "Results are written as json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="numbers of config variants to generate")
+    parser.add_argument("--elements", nargs="+", default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument("--repeat", type=int, default=20, help="runs of every transfer benchmark")
+    parser.add_argument("--skip-config", action="store_true")
+    parser.add_argument("--skip-engine", action="store_true")
+    parser.add_argument("--skip-transfer", action="store_true")
+    parser.add_argument("--output", help="file to write the results to. Printed to stdout if not set")
+    parser.add_argument("--baseline", help="results of an earlier run. Regressions are reported and fail the run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)  # Info logs of every transfer would be measured too
+
+    results = []
+    with bench_workdir():
+        if not args.skip_config:
+            results += bench_config(args.sizes, args.elements)
+        if not args.skip_engine:
+            results += bench_engine(args.sizes)
+        if not args.skip_transfer:
+            results += bench_transfer(repeat=args.repeat)
+    report = {"environment": environment(), "results": results}
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            report["regressions"] = compare(results, json.load(file)["results"], threshold=args.threshold)
+        if len(report["regressions"]) != 0:
+            logging.error(f"{len(report['regressions'])} benchmarks regressed against {args.baseline}")
+            exit_code = 1
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
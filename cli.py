@@ -0,0 +1,214 @@
+import time
+
+_START = time.perf_counter()  # Import time of the CLI itself is measured from here
+
+import argparse
+import importlib
+import logging
+import os
+import sys
+import threading
+
+CLI_IMPORT_TIME = time.perf_counter() - _START
+# Module:seconds spent importing it (with its dependencies) on first use. See lazy_import
+IMPORT_TIMES = {}
+
+
+def lazy_import(name: str):
+    """
+    Imports the module when a subcommand needs it and records how long the import took
+    SSH (fabric, paramiko, invoke) and yaml (ruamel) dependencies are loaded only by the subcommands that use them,
+    E.g. offline config rendering never imports fabric
+    :param name: str
+    :return: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES[name] = time.perf_counter() - start
+    return module
+
+
+def known_roles(selected: [str], roles: dict) -> bool:
+    unknown = [role for role in selected if role not in roles]
+    if len(unknown) != 0:
+        print(f"Unknown roles: {', '.join(unknown)}. Scenario has: {', '.join(roles)}", file=sys.stderr)
+    return len(unknown) == 0
+
+
+def generate(args: argparse.Namespace) -> int:
+    # Offline, only yaml dependencies are imported. Scenario is read the same way as in scenario_engine.load_scenario
+    config = lazy_import("yaml_processing")
+    generator = lazy_import("config_generator")
+    scenario = config.read_yaml(args.scenario)
+    name = scenario.get('name', "scenario")
+    roles = scenario['roles']
+    ips = {role: spec['ip'] for role, spec in roles.items()}
+    if not known_roles(args.role, roles):
+        return 2
+
+    count = 0
+    for role in args.role or roles:
+        dest_folder = os.path.join(args.out, role) if args.out else None
+        try:
+            rendered = generator.render_configs(name, role, roles[role], ips, scenario.get('username', "open5gs"),
+                                                local_copies=True, dest_folder=dest_folder)
+        except FileNotFoundError as e:
+            print(f"Template of role {role} not found ({e.filename}). Run fetch-defaults first", file=sys.stderr)
+            return 1
+        count += len(rendered)
+    print(f"Rendered {count} configs to {args.out or f'./transfers/{name}'}")
+    return 0
+
+
+def run_stages(args: argparse.Namespace, stages: [str], *, install: bool = False) -> int:
+    # Remote subcommands are scenario runs limited to some stages, see scenario_engine.build_scenario
+    engine = lazy_import("scenario_engine")
+    scenario = engine.load_scenario(args.scenario)
+    if install:
+        if not known_roles(args.role, scenario['roles']):
+            return 2
+        for role in args.role or scenario['roles']:
+            scenario['roles'][role]['install'] = True
+        scenario['artifacts'] = args.artifacts or scenario.get('artifacts', False)
+    results, errors = engine.run_scenario(scenario, stages=stages)
+    for step, error in errors.items():
+        print(f"{step} failed: {error!r}", file=sys.stderr)
+    print(f"{len(results)} steps done, {len(errors)} failed")
+    return 1 if len(errors) != 0 else 0
+
+
+def capture(args: argparse.Namespace) -> int:
+    # Captures on the interfaces listed under 'capture' of the roles, until the time is up or Ctrl+C
+    engine = lazy_import("scenario_engine")
+    packet_capture = lazy_import("packet_capture")
+    scenario = engine.load_scenario(args.scenario)
+    roles = {role: spec for role, spec in scenario['roles'].items() if len(spec.get('capture', ())) != 0}
+    pool = engine.vm.ConnectionPool()
+    try:
+        targets = {pool.get(spec['ip'], username=scenario.get('username', "open5gs"),
+                            key_path=spec.get('key_path', scenario.get('key_path'))): spec['capture']
+                   for spec in roles.values()}
+        session = packet_capture.CaptureSession(
+            targets, args.out or f"./transfers/{scenario.get('name', 'scenario')}/capture",
+            rotate_bytes=args.rotate_mb * 1_000_000 if args.rotate_mb else None, rotate_seconds=args.rotate_seconds)
+        started, errors = session.start()
+        print(f"Capturing {sum(len(names) for names in started.values())} interfaces on {len(started)} hosts. "
+              f"Ctrl+C to stop", file=sys.stderr)
+        try:
+            if args.seconds:
+                time.sleep(args.seconds)
+            else:
+                threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        index = session.stop()
+    finally:
+        pool.close_all()
+    print(f"{len(index)} files, {sum(entry['bytes'] for entry in index)} pcap bytes in {session.dest_folder}")
+    return 1 if len(errors) != 0 else 0
+
+
+def logs(args: argparse.Namespace) -> int:
+    # Only new log bytes are fetched, so the collection can be repeated during a long run
+    engine = lazy_import("scenario_engine")
+    log_collector = lazy_import("log_collector")
+    scenario = engine.load_scenario(args.scenario)
+    dest_folder = args.out or f"./transfers/{scenario.get('name', 'scenario')}/logs"
+    pool = engine.vm.ConnectionPool()
+    errors = {}
+    try:
+        connections = [pool.get(spec['ip'], username=scenario.get('username', "open5gs"),
+                                key_path=spec.get('key_path', scenario.get('key_path')))
+                       for spec in scenario['roles'].values()]
+        while True:
+            collected, errors = log_collector.collect_logs_parallel(connections, dest_folder=dest_folder)
+            print(f"{sum(sum(files.values()) for files in collected.values())} new bytes from "
+                  f"{len(collected)} hosts in {dest_folder}", file=sys.stderr)
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close_all()
+    return 1 if len(errors) != 0 else 0
+
+
+def parser() -> argparse.ArgumentParser:
+    """
+    Returns parser of the command line. Every subcommand takes a scenario file (see scenario_engine.build_scenario)
+    :return: argparse.ArgumentParser
+    """
+    main_parser = argparse.ArgumentParser(description="Open5Gs and UERANSIM deployment automation")
+    main_parser.add_argument("--log", help="log file (INFO level). By default only warnings are printed")
+    main_parser.add_argument("--quiet", action="store_true", help="do not print the import times")
+    main_parser.add_argument("--dry-run", action="store_true", help="run against in-memory fake machines "
+                                                                    "(see fake_connection.py) and print round trips")
+    main_parser.add_argument("--fake-latency", type=float, default=0.0, help="seconds per round trip of --dry-run")
+    subparsers = main_parser.add_subparsers(dest="command", required=True)
+
+    def add(name: str, help_text: str, func) -> argparse.ArgumentParser:
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument("scenario", help="scenario yaml file")
+        subparser.set_defaults(func=func)
+        return subparser
+
+    generate_parser = add("generate", "render configs locally (offline)", generate)
+    generate_parser.add_argument("--role", action="append", default=[], help="role to render (repeatable)")
+    generate_parser.add_argument("--out", help="output folder, one subfolder per role. "
+                                               "Default is ./transfers/<scenario name>")
+    add("fetch-defaults", "fetch default configs of the installed simulators (cached per version)",
+        lambda args: run_stages(args, ["defaults"]))
+    install_parser = add("install", "install the simulators", lambda args: run_stages(args, ["install"], install=True))
+    install_parser.add_argument("--role", action="append", default=[], help="role to install (repeatable). "
+                                                                            "Default is all roles")
+    install_parser.add_argument("--artifacts", action="store_true", help="build once and copy the artifacts")
+    add("push", "render configs and push the changed ones", lambda args: run_stages(args, ["push"]))
+    add("provision", "add subscribers of the generated UEs", lambda args: run_stages(args, ["provision"]))
+    add("launch", "launch the daemons in dependency order (configs are not pushed)",
+        lambda args: run_stages(args, ["launch"]))
+    capture_parser = add("capture", "capture packets on the 'capture' interfaces of the roles", capture)
+    capture_parser.add_argument("--out", help="output folder. Default is ./transfers/<scenario name>/capture")
+    capture_parser.add_argument("--seconds", type=float, help="capture time. Default is until Ctrl+C")
+    capture_parser.add_argument("--rotate-mb", type=int, default=100, help="pcap size per file (0 disables)")
+    capture_parser.add_argument("--rotate-seconds", type=float, help="capture time per file")
+    logs_parser = add("logs", "collect new bytes of the daemon logs from all hosts", logs)
+    logs_parser.add_argument("--out", help="output folder. Default is ./transfers/<scenario name>/logs")
+    logs_parser.add_argument("--interval", type=float, help="repeat every interval seconds until Ctrl+C")
+    add("run", "push, provision and launch (and install roles marked so)",
+        lambda args: run_stages(args, lazy_import("scenario_engine").STAGES))
+    return main_parser
+
+
+def main(argv: [str] = None) -> int:
+    args = parser().parse_args(argv)
+    if args.log:
+        logging.basicConfig(filename=args.log, level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+    start = time.perf_counter()
+    network = None
+    if args.dry_run:  # Every connection of the run is made by the fake backend, nothing leaves this machine
+        fake = lazy_import("fake_connection")
+        network = fake.FakeNetwork(latency=args.fake_latency, seed=fake.DEFAULT_SEED).install()
+    try:
+        code = args.func(args)
+    finally:
+        if network is not None:
+            network.uninstall()
+            print(network.report(), file=sys.stderr)
+
+    imported = sum(IMPORT_TIMES.values())
+    report = (f"cli import {CLI_IMPORT_TIME * 1000:.1f} ms, lazy imports {imported * 1000:.1f} ms"
+              + "".join(f", {name} {seconds * 1000:.1f} ms" for name, seconds in IMPORT_TIMES.items())
+              + f", {args.command} {(time.perf_counter() - start - imported) * 1000:.1f} ms")
+    logging.info(report)
+    if not args.quiet:
+        print(report, file=sys.stderr)
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import yaml_processing as config
+import logging
+import os
+from typing import Iterable, Iterator
+
+# Default configs of the simulators, see test_VM_commands.get_default_configs_cached. Scenario elements
+# Without a template of their own are rendered from these
+TEMPLATES = {"open5gs": "./transfers/all_open5gs/{element}.yaml",
+             "ueransim": "./transfers/all_ueransim/open5gs-{element}.yaml"}
+
+
+def supi_range(supi_start: str, count: int) -> Iterator[str]:
+    """
+    Generates count consecutive SUPIs starting from supi_start, e.g. imsi-001010000000000, imsi-001010000000001...
+    Width of the number (and its leading zeros) is kept
+    :param supi_start: str
+    :param count: int
+    :return: Iterator[str]
+    """
+    prefix, _, number = supi_start.rpartition("-")
+    first = int(number)
+    for i in range(count):
+        yield f"{prefix}-{first + i:0{len(number)}d}"
+
+
+def ue_diffs(supi_start: str, count: int, *, base_diff: dict = None,
+             assignments: [(int, int, dict)] = ()) -> Iterator[dict]:
+    """
+    Generates diff dicts (as accepted by yaml_processing.modify_yaml) of count UEs
+    Every diff has the supi of the UE and the keys of base_diff (e.g. mcc, mnc, gnbSearchList0)
+    Assignments are (first, last, diff) ranges of UE indexes (last excluded) that get extra keys,
+    e.g. (0, 500, {'sessions0-apn': 'internet'}), (500, 1000, {'sessions0-apn': 'ims', 'sessions0-slice-sst': 2})
+    :param supi_start: str
+    :param count: int
+    :param base_diff: dict
+    :param assignments: [(int, int, dict)]
+    :return: Iterator[dict]
+    """
+    base_diff = base_diff or {}
+    for i, supi in enumerate(supi_range(supi_start, count)):
+        diff = dict(base_diff)
+        for first, last, range_diff in assignments:
+            if first <= i < last:
+                diff.update(range_diff)
+        diff['supi'] = supi
+        yield diff
+
+
+def generate_ue_configs(template: dict, diffs: Iterable[dict]) -> Iterator[tuple[str, dict]]:
+    """
+    Lazily generates (supi, config) pairs, one per diff. Configs are copy-on-write overlays of the template
+    (see yaml_processing.overlay_yaml), so only one config at a time is held in memory by the generator
+    Template must not be modified while configs are generated
+    :param template: dict
+    :param diffs: Iterable[dict]
+    :return: Iterator[tuple[str, dict]]
+    """
+    for diff in diffs:
+        yield diff['supi'], config.overlay_yaml(template, diff)
+
+
+def write_configs(configs: Iterable[tuple[str, dict]], dest_folder: str, *, name_format: str = "ue{index}.yaml",
+                  overwrite: bool = False, flow: bool = False) -> [str]:
+    """
+    Writes configs from the (supi, config) stream to dest_folder one by one, as they are generated
+    Name_format can use {index} (position in the stream) and {supi} fields
+    If flow is set, configs are written with the fast flow style emitter (see yaml_processing.yaml_to_string)
+    Returns the list of written file paths, which can be passed to test_VM_commands.put_files_bulk
+    :param configs: Iterable[tuple[str, dict]]
+    :param dest_folder: str
+    :param name_format: str
+    :param overwrite: bool
+    :param flow: bool
+    :return: [str]
+    """
+    os.makedirs(dest_folder, exist_ok=True)
+    paths = []
+    for index, (supi, yaml_data) in enumerate(configs):
+        file_path = os.path.join(dest_folder, name_format.format(index=index, supi=supi))
+        if os.path.exists(file_path) and not overwrite:
+            logging.error(f"Overwrite flag was not set, but file {file_path} exists! Skipping")
+            continue
+        with open(file_path, 'w', newline='\n') as output:
+            output.write(config.yaml_to_string(yaml_data, flow=flow))
+        paths.append(file_path)
+
+    logging.info(f"Generated {len(paths)} configs in {dest_folder}")
+    return paths
+
+
+def resolve(value, ips: {str: str}):
+    """
+    Resolves references to ip addresses of scenario roles in a diff value, e.g. "{cplane}"
+    Lists (e.g. dnn lists) are resolved item by item, other values are returned as they are
+    :param value: any
+    :param ips: {str: str} - role:ip address
+    :return: any
+    """
+    if isinstance(value, str) and "{" in value:
+        return value.format_map(ips)
+    if isinstance(value, list):
+        return [resolve(item, ips) for item in value]
+    return value
+
+
+def resolve_diff(diff: dict, ips: {str: str}) -> dict:
+    """
+    Returns copy of the diff dict with all values resolved, see resolve
+    :param diff: dict
+    :param ips: {str: str}
+    :return: dict
+    """
+    return {key: resolve(value, ips) for key, value in (diff or {}).items()}
+
+
+def spec_ue_diffs(spec: dict, ips: {str: str}) -> Iterator[dict]:
+    """
+    Generates UE diffs of a UE range from a scenario description (keys supi, count, diff, assignments)
+    :param spec: dict
+    :param ips: {str: str}
+    :return: Iterator[dict]
+    """
+    return ue_diffs(spec['supi'], spec['count'], base_diff=resolve_diff(spec.get('diff'), ips),
+                    assignments=[(first, last, resolve_diff(diff, ips))
+                                 for first, last, diff in spec.get('assignments', ())])
+
+
+def remote_config_path(sim: str, user: str, file_name: str) -> str:
+    """
+    Returns the path the simulator reads the config file_name from on a machine
+    :param sim: str
+    :param user: str
+    :param file_name: str
+    :return: str
+    """
+    if sim == "open5gs":
+        return f"/etc/open5gs/{file_name}"
+    home = f"/home/{user}" if user != "root" else "/root"
+    return f"{home}/UERANSIM/config/{file_name}"
+
+
+def render_configs(scenario_name: str, role: str, role_spec: dict, ips: {str: str}, username: str, *,
+                   local_copies: bool = False, dest_folder: str = None) -> {str: str}:
+    """
+    Renders the configs of the role (template + diff) in memory
+    Elements with count are UE ranges generated with config_generator (keys supi, count, diff, assignments)
+    Returns remote path:yaml text dict, as accepted by test_VM_commands.put_data_bulk
+    If local_copies is set, configs are also written to dest_folder (./transfers/<scenario name>/<role>/ by
+    Default) for inspection. Nothing here needs a connection, configs can be rendered offline
+    Role_spec is one role of a scenario description, see scenario_engine.build_scenario
+    :param scenario_name: str
+    :param role: str
+    :param role_spec: dict
+    :param ips: {str: str} - role:ip address
+    :param username: str
+    :param local_copies: bool
+    :param dest_folder: str
+    :return: {str: str}
+    """
+    sim = role_spec['sim']
+    dest_folder = dest_folder or f"./transfers/{scenario_name}/{role}"
+    rendered = {}
+    for element, spec in role_spec.get('configs', {}).items():
+        template = config.read_yaml_cached(spec.get('template') or TEMPLATES[sim].format(element=element))
+        if 'count' in spec:
+            configs = ((f"{element}{i}.yaml", yaml_data) for i, (_, yaml_data) in
+                       enumerate(generate_ue_configs(template, spec_ue_diffs(spec, ips))))
+        else:
+            configs = [(f"{element}.yaml", config.overlay_yaml(template, resolve_diff(spec.get('diff'), ips)))]
+        for file_name, yaml_data in configs:
+            text = config.yaml_to_string(yaml_data)
+            rendered[remote_config_path(sim, username, file_name)] = text
+            if local_copies:
+                os.makedirs(dest_folder, exist_ok=True)
+                with open(os.path.join(dest_folder, file_name), "w", newline="\n") as file:
+                    file.write(text)
+    return rendered
@@ -0,0 +1,1001 @@
+import fabric
+import fabric.transfer
+import invoke
+import test_VM_commands as vm
+from fixtures import TEMPLATES
+from launch_engine import OPEN5GS_PFCP_READY, UERANSIM_READY
+import logging
+import base64
+import fnmatch
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import posixpath
+import re
+import shlex
+import sys
+import tarfile
+import threading
+import time
+import uuid
+
+# Fake machines do not interpret shell scripts. Every remote command of this repository is recognised as the
+# Operation it performs (batch, folder pack, install from stdin, stage launch...) and applied to a dict
+# Filesystem. Plain commands joined by &&, || and ; run one by one. Anything else is unhandled, see FakeHost.on
+
+# Folders every fake machine starts with. Homes of the users are added on their first connection
+BASE_FOLDERS = {"/", "/bin", "/etc", "/home", "/root", "/tmp", "/usr", "/usr/bin", "/usr/local", "/usr/local/bin",
+                "/usr/local/lib", "/var", "/var/log"}
+# Remote folder:local folder (or file name:text) copied to every fake machine on the first connection of a user
+# ~ is the user home. DEFAULT_SEED ships the default configs of fixtures.TEMPLATES, so it works on a clean checkout
+# LOCAL_SEED copies the configs fetched from real machines to ./transfers instead
+DEFAULT_SEED = {"/etc/open5gs": {posixpath.basename(path): text.lstrip() for path, text in TEMPLATES.items()
+                                 if path.startswith("all_open5gs/")},
+                "~/UERANSIM/config": {posixpath.basename(path): text.lstrip() for path, text in TEMPLATES.items()
+                                      if path.startswith("all_ueransim/")}}
+LOCAL_SEED = {"/etc/open5gs": "./transfers/all_open5gs", "~/UERANSIM/config": "./transfers/all_ueransim"}
+
+# Prefixes of invoke (sudo), stream_lines, execute_with_input and packet_capture
+_SUDO = re.compile(r"sudo (?:-S -p '[^']*'|-n) (?:-H -u (\S+) )?")
+# Redirections of plain commands that do not change the result (output is discarded or merged)
+_IGNORED_REDIRECT = re.compile(r"\d?>(?:&\d|>?/dev/null)|</dev/null")
+_SEPARATORS = ("&&", "||", ";")
+_UNSUPPORTED = {"{", "}", "(", ")", "if", "then", "else", "fi", "for", "while", "do", "done", "case", "esac", "|"}
+
+
+def _output(value) -> (bytes, bytes, int):
+    # Handler results: stdout (str or bytes), exit code, or a (stdout, stderr, exit code) tuple
+    if isinstance(value, int):
+        return b"", b"", value
+    if not isinstance(value, tuple):
+        value = (value, b"", 0)
+    stdout, stderr, code = value
+    return (stdout.encode() if isinstance(stdout, str) else stdout or b"",
+            stderr.encode() if isinstance(stderr, str) else stderr or b"", code)
+
+
+def _unquote(word: str) -> str:
+    return shlex.split(word)[0]
+
+
+def _command_list(script: str) -> [tuple[str, [str]]]:
+    """
+    Splits plain commands joined by &&, || and ; into (separator, argv) pairs. Returns None for anything else
+    (substitutions, pipes, compound commands, redirections to files), which is left to the operations or handlers
+    """
+    if "\n" in script or "`" in script or "$(" in script:
+        return None
+    try:
+        words = shlex.split(script)
+    except ValueError:
+        return None
+    commands, separator, argv = [], None, []
+    for word in words + [";"]:
+        if word in _SEPARATORS:
+            if len(argv) == 0:
+                return None
+            commands.append((separator, argv))
+            separator, argv = word, []
+        elif word in _UNSUPPORTED or (word[:1] in "<>" or re.match(r"\d>", word)) and \
+                not _IGNORED_REDIRECT.fullmatch(word):
+            return None
+        elif not _IGNORED_REDIRECT.fullmatch(word):
+            argv.append(word)
+    return commands
+
+
+def _pcap_header(snaplen: int) -> bytes:
+    return b"\xd4\xc3\xb2\xa1" + (2).to_bytes(2, "little") + (4).to_bytes(2, "little") + bytes(8) + \
+        snaplen.to_bytes(4, "little") + (1).to_bytes(4, "little")
+
+
+class FakeHost:
+    """
+    One fake machine: dict filesystem, process table, subscriber database, command history and handlers
+    Commands are matched against the handlers first (later ones take precedence), then against the operations the
+    Repository performs and the few plain commands they use. A handler is called with (host, argv, stdin bytes)
+    And returns stdout (str or bytes), an exit code or a (stdout, stderr, exit code) tuple. Usage:
+        host.on(r"dpkg-query ", lambda host, argv, stdin: "2.7.0")
+        host.on(r"systemctl restart ", lambda host, argv, stdin: 0)
+    """
+
+    def __init__(self, name: str, *, strict: bool = False, sudo_password: str = None):
+        """
+        :param name: str
+        :param strict: bool - unhandled commands fail with 127 (command not found) instead of succeeding silently
+        :param sudo_password: str - None means passwordless sudo
+        """
+        self.name = name
+        self.strict = strict
+        self.sudo_password = sudo_password
+        self.files = {}  # path:content
+        self.meta = {}  # path:{"mode", "owner", "inode"}
+        self.dirs = set(BASE_FOLDERS)
+        self.interfaces = ["lo", "eth0"]  # Listed in /sys/class/net, see packet_capture.resolve_interfaces
+        self.processes = {}  # pid:{"pid", "name", "argv", "user"}
+        self.databases = {}  # Mongo database:{collection:{imsi:document}}
+        self.history = []  # Executed commands: {"user", "command"}
+        self.unhandled = []  # Commands nothing simulated: {"user", "command"}
+        self.users = set()
+        self.lock = threading.RLock()  # Commands of one host run one at a time
+        self._handlers = []
+        self._inode = 1000
+        self._pid = 1000
+
+    # Filesystem
+    def home(self, user: str) -> str:
+        return "/root" if user == "root" else f"/home/{user}"
+
+    def makedirs(self, path: str) -> None:
+        while path not in self.dirs:
+            self.dirs.add(path)
+            path = posixpath.dirname(path)
+
+    def read(self, path: str, user: str = "root") -> bytes:
+        """
+        Returns content of the file. Errors are the ones SFTP raises
+        :param path: str
+        :param user: str
+        :return: bytes
+        :raises FileNotFoundError, IsADirectoryError, PermissionError:
+        """
+        if path in self.dirs:
+            raise IsADirectoryError(21, "Is a directory", path)
+        if path not in self.files:
+            raise FileNotFoundError(2, "No such file or directory", path)
+        meta = self.meta[path]
+        if user != "root" and meta["owner"] != user and meta["mode"] & 0o004 == 0:
+            raise PermissionError(13, "Permission denied", path)
+        return self.files[path]
+
+    def write(self, path: str, data: bytes | str, user: str = "root", *, mode: int = 0o644, owner: str = None,
+              parents: bool = False) -> None:
+        """
+        Writes the file as the user. Users other than root write only to their home, /tmp and their own files
+        :param path: str
+        :param data: bytes | str
+        :param user: str
+        :param mode: int
+        :param owner: str - defaults to the user
+        :param parents: bool - creates missing folders (as install -D)
+        :return: None
+        :raises FileNotFoundError, IsADirectoryError, PermissionError:
+        """
+        folder = posixpath.dirname(path)
+        if path in self.dirs:
+            raise IsADirectoryError(21, "Is a directory", path)
+        if user != "root" and (self.meta[path]["owner"] != user if path in self.files else
+                               folder != "/tmp" and not (folder + "/").startswith(self.home(user) + "/")):
+            raise PermissionError(13, "Permission denied", path)
+        if folder not in self.dirs:
+            if not parents:
+                raise FileNotFoundError(2, "No such file or directory", path)
+            self.makedirs(folder)
+        if path not in self.files:
+            self._inode += 1
+            self.meta[path] = {"inode": self._inode}
+        self.files[path] = data.encode() if isinstance(data, str) else bytes(data)
+        self.meta[path].update(mode=mode, owner=owner or user)
+
+    def remove(self, path: str, user: str = "root") -> None:
+        if path not in self.files:
+            raise FileNotFoundError(2, "No such file or directory", path)
+        if user != "root" and self.meta[path]["owner"] != user:
+            raise PermissionError(13, "Permission denied", path)
+        del self.files[path], self.meta[path]
+
+    def glob(self, pattern: str) -> [str]:
+        # Wildcards of the file name only, as the remote commands use them
+        folder, name = posixpath.split(pattern)
+        return sorted(path for path in self.files if posixpath.dirname(path) == folder and
+                      fnmatch.fnmatchcase(posixpath.basename(path), name))
+
+    def add_user(self, user: str, seed: {str: str | dict} = None) -> None:
+        """
+        Creates the home folder of the user and copies the seed folders on the first call
+        Seed maps a remote folder to a local folder or to the files themselves (file name:text)
+        :param user: str
+        :param seed: {str: str | dict}
+        :return: None
+        """
+        with self.lock:
+            if user in self.users:
+                return
+            self.users.add(user)
+            self.makedirs(self.home(user))
+            for remote_folder, files in (seed or {}).items():
+                remote_folder = self.home(user) + remote_folder[1:] if remote_folder.startswith("~") else remote_folder
+                if not isinstance(files, dict):
+                    files = {name: open(os.path.join(files, name), "rb").read() for name in sorted(os.listdir(files))
+                             if os.path.isfile(os.path.join(files, name)) and not name.startswith(".")} \
+                        if os.path.isdir(files) else {}
+                self.makedirs(remote_folder)
+                for name, content in files.items():
+                    self.write(posixpath.join(remote_folder, name), content,
+                               owner="root" if remote_folder.startswith("/etc") else user)
+
+    # Commands
+    def on(self, pattern: str, handler) -> None:
+        """
+        Registers a handler of the commands that match the regular expression from the start. Plain commands are
+        Matched one by one, with their arguments unquoted and joined by spaces. Other scripts are matched whole,
+        Before the operations
+        :param pattern: str
+        :param handler: callable
+        :return: None
+        """
+        self._handlers.insert(0, (re.compile(pattern), handler))
+
+    def spawn(self, argv: [str], user: str) -> int:
+        self._pid += 1
+        self.processes[self._pid] = {"pid": self._pid, "name": posixpath.basename(argv[0]), "argv": list(argv),
+                                     "user": user}
+        return self._pid
+
+    def run(self, command: str, *, user: str = "root", stdin: bytes = b"") -> (bytes, bytes, int):
+        """
+        Runs the command of a session as the user. Sudo prefixes are checked and removed. Returns stdout, stderr
+        And exit code
+        :param command: str
+        :param user: str
+        :param stdin: bytes
+        :return: (bytes, bytes, int)
+        """
+        with self.lock:
+            match = _SUDO.match(command)
+            if match is not None:
+                if self.sudo_password is not None:
+                    if match.group(0).startswith("sudo -n"):
+                        return b"", b"sudo: a password is required\n", 1
+                    password, _, stdin = stdin.partition(b"\n")
+                    if password.decode() != self.sudo_password:
+                        return b"", b"sudo: 1 incorrect password attempt\n", 1
+                user, command = match.group(1) or "root", command[match.end():]
+            return self.execute(command, user, stdin)
+
+    def execute(self, script: str, user: str, stdin: bytes = b"") -> (bytes, bytes, int):
+        """
+        Runs a command (without the sudo prefix) as the user. Returns stdout, stderr and exit code
+        :param script: str
+        :param user: str
+        :param stdin: bytes
+        :return: (bytes, bytes, int)
+        """
+        if script.startswith("bash -c "):
+            script = _unquote(script[len("bash -c "):])
+        self.history.append({"user": user, "command": script})
+        commands = _command_list(script)
+        for regex, handler in self._handlers if commands is None else ():
+            if regex.match(script):
+                return _output(handler(self, shlex.split(script), stdin))
+        for regex, operation in _OPERATIONS:
+            match = regex.match(script)
+            if match is not None:
+                return getattr(self, operation)(match, user, stdin)
+        if commands is None:
+            return self._unhandled(script, user)
+        stdout, stderr, code = b"", b"", 0
+        for separator, argv in commands:
+            if (separator == "&&" and code != 0) or (separator == "||" and code == 0):
+                continue
+            out, err, code = self._command(argv, user, stdin)
+            stdout, stderr = stdout + out, stderr + err
+        return stdout, stderr, code
+
+    def _command(self, argv: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        command = " ".join(argv)
+        for regex, handler in self._handlers:
+            if regex.match(command):
+                return _output(handler(self, argv, stdin))
+        method = _COMMANDS.get(posixpath.basename(argv[0]))
+        if method is None:
+            return self._unhandled(command, user)
+        try:
+            return getattr(self, method)(argv[1:], user, stdin)
+        except OSError as e:
+            return b"", f"{argv[0]}: {e.filename}: {e.strerror}\n".encode(), 1
+
+    def _unhandled(self, command: str, user: str) -> (bytes, bytes, int):
+        logging.debug(f"[{self.name}] unhandled command: {command}")
+        self.unhandled.append({"user": user, "command": command})
+        if self.strict:
+            return b"", f"bash: {command.split(' ', 1)[0]}: command not found\n".encode(), 127
+        return b"", b"", 0
+
+    # Plain commands. Arguments without the command name
+    def _true(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        return b"", b"", 0
+
+    def _false(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        return b"", b"", 1
+
+    def _test(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        # File tests only: -e, -f and -d
+        tests = {"-e": lambda path: path in self.files or path in self.dirs, "-f": lambda path: path in self.files,
+                 "-d": lambda path: path in self.dirs}
+        return b"", b"", 0 if tests[args[0]](args[1]) else 1
+
+    def _echo(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        return (" ".join(args) + "\n").encode(), b"", 0
+
+    def _cat(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        return (b"".join(self.read(path, user) for path in args) if len(args) != 0 else stdin), b"", 0
+
+    def _cp(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        source, dest = args[-2:]
+        self.write(dest, self.read(source, user), user, mode=self.meta[source]["mode"])
+        return b"", b"", 0
+
+    def _rm(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        force = any(arg.startswith("-") and "f" in arg for arg in args)
+        for path in (arg for arg in args if not arg.startswith("-")):
+            if path in self.files or not force:
+                self.remove(path, user)
+        return b"", b"", 0
+
+    def _mkdir(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        for path in (arg for arg in args if not arg.startswith("-")):
+            self.makedirs(path)
+        return b"", b"", 0
+
+    def _chmod(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        for path in args[1:]:
+            self.write(path, self.read(path, user), user, mode=int(args[0], 8), owner=self.meta[path]["owner"])
+        return b"", b"", 0
+
+    def _mktemp(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        names = [arg for arg in args if not arg.startswith("-")]
+        path = re.sub(r"X{3,}$", lambda match: uuid.uuid4().hex[:len(match.group())],
+                      names[0] if len(names) != 0 else "/tmp/tmp.XXXXXXXXXX")
+        if "-d" in args:
+            self.makedirs(path)
+        else:
+            self.write(path, b"", user, mode=0o600)
+        return (path + "\n").encode(), b"", 0
+
+    def _sha256sum(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        stdout, stderr = b"", b""
+        for path in args:
+            try:
+                stdout += f"{hashlib.sha256(self.read(path, user)).hexdigest()}  {path}\n".encode()
+            except OSError as e:
+                stderr += f"sha256sum: {path}: {e.strerror}\n".encode()
+        return stdout, stderr, 0 if len(stderr) == 0 else 1
+
+    def _find(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        # Files directly in the starting points (or the starting points themselves) with -type f, -name and -perm
+        # (exact mode) tests. -exec sha256sum {} + is the only action besides printing
+        start = next((i for i, arg in enumerate(args) if arg.startswith("-")), len(args))
+        roots, action = args[:start], None
+        if "-exec" in args:
+            action, args = args[args.index("-exec") + 1:-2], args[:args.index("-exec")]
+        options = dict(zip(args[start::2], args[start + 1::2]))
+        found, stderr = [], b""
+        for root in roots:
+            if root not in self.files and root not in self.dirs:
+                stderr += f"find: '{root}': No such file or directory\n".encode()
+                continue
+            candidates = [root] if options.get("-maxdepth") == "0" or root in self.files else \
+                sorted(path for path in self.files if posixpath.dirname(path) == root.rstrip("/"))
+            found += [path for path in candidates if path in self.files and
+                      fnmatch.fnmatchcase(posixpath.basename(path), options.get("-name", "*")) and
+                      ("-perm" not in options or self.meta[path]["mode"] == int(options["-perm"], 8))]
+        if action is not None:
+            if len(found) == 0:
+                return b"", stderr, 0 if len(stderr) == 0 else 1
+            stdout, action_stderr, code = self._command([arg for arg in action if arg != "{}"] + found, user, stdin)
+            return stdout, stderr + action_stderr, code or (0 if len(stderr) == 0 else 1)
+        return "".join(path + "\n" for path in found).encode(), stderr, 0 if len(stderr) == 0 else 1
+
+    def _ls(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        if args == ["/sys/class/net"]:
+            return "".join(name + "\n" for name in self.interfaces).encode(), b"", 0
+        names = {path[len(folder) + 1:].split("/")[0] for folder in args
+                 for path in list(self.files) + list(self.dirs) if path.startswith(folder.rstrip("/") + "/")}
+        return "".join(name + "\n" for name in sorted(names)).encode(), b"", 0
+
+    def _kill(self, args: [str], user: str, stdin: bytes) -> (bytes, bytes, int):
+        stderr = b""
+        for pid in (arg for arg in args if not arg.startswith("-")):
+            if self.processes.pop(int(pid), None) is None:
+                stderr += f"kill: ({pid}) - No such process\n".encode()
+        return b"", stderr, 0 if len(stderr) == 0 else 1
+
+    def _install(self, args: [str], source: bytes, dest: str, user: str) -> None:
+        # Options of install: -D, -o owner, -g group, -m mode
+        options = dict(zip(*[iter(arg for arg in args if arg != "-D")] * 2))
+        self.write(dest, source, user, mode=int(options.get("-m", "755"), 8), owner=options.get("-o"),
+                   parents="-D" in args)
+
+    # Operations, see _OPERATIONS
+    def _op_batch(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # test_VM_commands.execute_batch
+        stdout = b""
+        for block in _BATCH_BLOCK.finditer(match.string):
+            out, err, code = self.execute(block["command"], user)
+            stdout += (f"{block['token']} {block['index']} {code} {base64.b64encode(out).decode()} "
+                       f"{base64.b64encode(err).decode()}\n").encode()
+            if block["stop"] and code != 0:
+                break
+        return stdout, b"", 0
+
+    def _op_pack(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # test_VM_commands.folder_pack_command
+        folder, pattern = _unquote(match["folder"]).rstrip("/") or "/", _unquote(match["pattern"])
+        if folder not in self.dirs:
+            return b"", f"bash: line 1: cd: {folder}: No such file or directory\n".encode(), 1
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            for path in self.glob(posixpath.join(folder, pattern)):
+                data = self.read(path, user)
+                info = tarfile.TarInfo("./" + posixpath.basename(path))
+                info.size, info.mtime, info.mode = len(data), int(time.time()), self.meta[path]["mode"]
+                tar.addfile(info, io.BytesIO(data))
+        return base64.b64encode(archive.getvalue()), b"", 0
+
+    def _op_install_stdin(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # test_VM_commands.put_data, sudo_put_file and the install of the patch helper
+        dest = _unquote(match["dest"])
+        checks = match["checks"] or ""
+        if dest in self.files and "UNCHANGED" in checks:
+            digest = re.search(r"= ([0-9a-f]{64}) \]", checks).group(1)
+            mode = re.search(r"%a \S+\)\" = ([0-7]+) \]", checks)
+            if hashlib.sha256(self.files[dest]).hexdigest() == digest and \
+                    (mode is None or self.meta[dest]["mode"] == int(mode.group(1), 8)):
+                return b"UNCHANGED\n", b"", 0
+        if dest in self.files and "EXISTS" in checks:
+            return b"EXISTS\n", b"", 0
+        try:
+            self._install(match["args"].split(), stdin, dest, user)
+        except OSError as e:
+            return b"", f"install: cannot create regular file '{dest}': {e.strerror}\n".encode(), 1
+        return (b"WRITTEN\n" if match["written"] else b""), b"", 0
+
+    def _op_install_bulk(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # test_VM_commands.put_data_bulk
+        with tarfile.open(fileobj=io.BytesIO(stdin), mode="r:gz") as tar:
+            members = {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+        stdout = b""
+        for line in _BULK_LINE.finditer(match.string):
+            dest = _unquote(line["dest"])
+            if line["exists"] and dest in self.files:
+                stdout += f"EXISTS {line['index']}\n".encode()
+                continue
+            try:
+                self._install(line["args"].split(), members[line["index"]], dest, user)
+                stdout += f"OK {line['index']}\n".encode()
+            except OSError:
+                stdout += f"FAILED {line['index']}\n".encode()
+        return stdout, b"", 0
+
+    def _op_config_key(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # test_VM_commands.default_config_key
+        version, _, code = self.execute(match["version"], user)
+        version = version.decode().rstrip("\n")
+        if code == 0 and len(version) != 0:
+            return f"version-{version}\n".encode(), b"", 0
+        files = b"".join(self.files[path] for pattern in shlex.split(match["files"])[1:] for path in self.glob(pattern))
+        return f"hash-{hashlib.sha256(files).hexdigest()[:16]}\n".encode(), b"", 0
+
+    def _op_patch(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # test_VM_commands.patch_yaml. The installed helper is applied to the files of the host in process
+        helper_path = _unquote(match["helper"])
+        if helper_path not in self.files:
+            return b"MISSING\n", b"", 0
+        helper = _patch_helper()
+        request = json.loads(stdin)
+        stdout, failed = b"", False
+        for path, diff in request["files"].items():
+            try:
+                data = helper.yaml.safe_load(self.read(path, user)) or {}
+                original = json.dumps(data, sort_keys=True, default=str)
+                missed = []
+                for key, steps, new_value in diff:
+                    try:
+                        helper.apply(data, steps, new_value)
+                    except (KeyError, IndexError, TypeError, AttributeError):
+                        missed.append(key)
+                changed = json.dumps(data, sort_keys=True, default=str) != original
+                if changed:
+                    if request.get("backup", True):
+                        self.write(path + ".bak", self.files[path], user, mode=self.meta[path]["mode"])
+                    self.write(path, helper.yaml.safe_dump(data, default_flow_style=False, sort_keys=False), user,
+                               mode=self.meta[path]["mode"], owner=self.meta[path]["owner"])
+                outcome = {"path": path, "changed": changed, "missed": missed}
+            except (OSError, helper.yaml.YAMLError) as e:
+                outcome, failed = {"path": path, "error": f"{type(e).__name__}: {e}"}, True
+            stdout += json.dumps(outcome).encode() + b"\n"
+        return stdout, b"", 1 if failed else 0
+
+    def _op_provision(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # subscriber_provisioning.provision_subscribers. Compressed mongo shell script comes on stdin
+        db, script = match["db"], gzip.decompress(stdin).decode()
+        match = re.search(r"^var docs = (.*?);$", script, re.M)
+        if match is None:
+            return self._unhandled(f"mongo {db}", user)
+        collection = self.databases.setdefault(db, {}).setdefault("subscribers", {})
+        inserted = existing = 0
+        for document in json.loads(match.group(1)):
+            if document["imsi"] in collection:
+                existing += 1
+                if '"$set"' in script:
+                    collection[document["imsi"]].update(document)
+            else:
+                inserted += 1
+                collection[document["imsi"]] = document
+        return json.dumps({"inserted": inserted, "existing": existing}).encode() + b"\n", b"", 0
+
+    def _op_stage(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # launch_engine._stage_script. Daemons are ready as soon as they are started
+        folder = re.search(r"^cd (\S+) \|\| exit 1$", match.string, re.M)
+        if folder is not None and folder.group(1) not in self.dirs:
+            return b"", f"bash: line 2: cd: {folder.group(1)}: No such file or directory\n".encode(), 1
+        for start in re.finditer(r"^setsid -f (\S+)(?: -c (\S+))? (?:>>(\S+) )?", match.string, re.M):
+            name = posixpath.basename(start.group(1))
+            self.spawn([start.group(1)] + (["-c", start.group(2)] if start.group(2) else []), user)
+            if start.group(3):  # UERANSIM writes its output to the log the probe reads
+                element = name[len("nr-"):]
+                self._append(start.group(3), f"[{name}] {UERANSIM_READY.get(element, 'started')}\n")
+            else:
+                daemon = name[len("open5gs-"):-1]
+                self._append(f"/var/log/open5gs/{daemon}.log",
+                             f"open5gs-{daemon}d started\n" + (f"{OPEN5GS_PFCP_READY}\n" if daemon == "smf" else ""))
+        probes = re.findall(r"^\s+(\w+)\) if ", match.string, re.M)
+        return "".join(f"READY {name} 0\n" for name in probes).encode(), b"", 0
+
+    def _append(self, path: str, text: str) -> None:
+        self.write(path, self.files.get(path, b"") + text.encode(), "root", parents=True)
+
+    def _op_collect(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # log_collector.collect_command
+        known = {}
+        for entry in shlex.split(match["known"]):
+            path, inode, offset = re.fullmatch(r"\[(.*)\]=(\d+) (\d+)", entry).groups()
+            known[path] = (int(inode), int(offset))
+        max_bytes = int(re.search(r"head -c (\d+)", match.string).group(1))
+        stream = b""
+        for path in (path for pattern in match["patterns"].split() for path in self.glob(pattern)):
+            data, inode = self.read(path, user), self.meta[path]["inode"]
+            known_inode, offset = known.get(path, (0, 0))
+            if inode != known_inode or len(data) < offset:
+                offset = 0
+            chunk = data[offset:offset + max_bytes]
+            if len(chunk) != 0:
+                stream += f"FILE {inode} {offset} {len(chunk)} {path}\n".encode() + chunk
+        return base64.b64encode(gzip.compress(stream)), b"", 0
+
+    def _op_capture(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # packet_capture.Capture.command. Captures nothing, as if it was stopped right away
+        args = shlex.split(match["args"])
+        interface, snaplen = args[args.index("-i") + 1], int(args[args.index("-s") + 1])
+        if interface not in self.interfaces and interface != "any":
+            return b"", f"tcpdump: {interface}: No such device exists\n".encode(), 1
+        stderr = (f"tcpdump: listening on {interface}, link-type EN10MB (Ethernet), snapshot length {snaplen} bytes\n"
+                  f"0 packets captured\n0 packets received by filter\n0 packets dropped by kernel\n")
+        return gzip.compress(_pcap_header(snaplen)), stderr.encode(), 0
+
+    def _op_stop_capture(self, match: re.Match, user: str, stdin: bytes) -> (bytes, bytes, int):
+        # packet_capture.Capture.stop. Capture has already ended, its pid file is gone
+        if match["pid_file"] in self.files:
+            self.processes.pop(int(self.files[match["pid_file"]]), None)
+        return b"", b"", 0
+
+
+# Command name:FakeHost method of the plain commands
+_COMMANDS = {"true": "_true", "false": "_false", "test": "_test", "echo": "_echo", "cat": "_cat", "cp": "_cp",
+             "rm": "_rm", "mkdir": "_mkdir", "chmod": "_chmod", "mktemp": "_mktemp", "sha256sum": "_sha256sum",
+             "find": "_find", "ls": "_ls", "kill": "_kill"}
+_BATCH_BLOCK = re.compile(r"^\(\n(?P<command>.*?)\n\) >\"\$d/o\" 2>\"\$d/e\" </dev/null; rc=\$\?\n"
+                          r"printf '[^']*' (?P<token>\S+) (?P<index>\d+) [^\n]*"
+                          r"(?P<stop>\n\[ \$rc -eq 0 \] \|\| exit 0)?", re.S | re.M)
+_BULK_LINE = re.compile(r"^(?P<exists>if \[ -e \S+ \]; then echo \"EXISTS \d+\"; else )?"
+                        r"if install (?P<args>.*?) \"\$t/(?P<index>\d+)\" (?P<dest>\S+); then", re.M)
+# Remote commands of the repository: regular expression (matched from the start):FakeHost method
+_OPERATIONS = [
+    (re.compile(r"d=\$\(mktemp -d\) \|\| exit 1\ntrap 'rm -rf \"\$d\"' EXIT\n"), "_op_batch"),
+    (re.compile(r"set -o pipefail; cd (?P<folder>.+?) && find \. -maxdepth 1 -type f -name (?P<pattern>.+?) -print0 "
+                r"\| tar --null -T - -czf - \| base64 -w0$"), "_op_pack"),
+    (re.compile(r"(?:if \[ -e \S+ \]; then (?P<checks>.*); fi; )?install (?P<args>(?:-\S+ )*(?:-[ogm] \S+ )*)"
+                r"/dev/stdin (?P<dest>\S+)(?P<written> && echo WRITTEN)?$"), "_op_install_stdin"),
+    (re.compile(r"t=\$\(mktemp -d /tmp/vm_automation_X+\) \|\| exit 1\ntar -xzf - -C \"\$t\""), "_op_install_bulk"),
+    (re.compile(r"v=\$\((?P<version>.*?) 2>/dev/null\) && \[ -n \"\$v\" \] && echo \"version-\$v\" \|\| "
+                r"echo \"hash-\$\((?P<files>.*?) 2>/dev/null \| sha256sum \| cut -c1-16\)\"$"), "_op_config_key"),
+    (re.compile(r"if \[ ! -f (?P<helper>\S+) \]; then cat >/dev/null; echo MISSING; exit 0; fi; python3 (?P=helper)$"),
+     "_op_patch"),
+    (re.compile(r"f=\$\(mktemp --suffix=\.js \S+\) \|\| exit 1; gunzip -c > \"\$f\" && "
+                r"mongo(?:sh)? --quiet (?P<db>\S+) \"\$f\"; rc=\$\?; rm -f \"\$f\"; exit \$rc$"), "_op_provision"),
+    (re.compile(r"t0=\$\(date \+%s%N\)\n"), "_op_stage"),
+    (re.compile(r"declare -A known=\((?P<known>.*?)\)\nshopt -s nullglob\n.*?\{ for f in (?P<patterns>.*?); do\n",
+                re.S), "_op_collect"),
+    (re.compile(r"\{ tcpdump (?P<args>.*?) & echo \$! > \S+; wait; \} \| gzip -1 -c;"), "_op_capture"),
+    (re.compile(r"kill -INT \$\(cat (?P<pid_file>\S+)\) 2>/dev/null \|\| true$"), "_op_stop_capture"),
+]
+_HELPER = {}
+
+
+def _patch_helper():
+    # Remote patch helper (scripts/patch_yaml.py), loaded once. Needs PyYAML like on the machines
+    if "module" not in _HELPER:
+        spec = importlib.util.spec_from_file_location("vm_automation_patch_yaml", vm.PATCH_HELPER)
+        _HELPER["module"] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_HELPER["module"])
+    return _HELPER["module"]
+
+
+class FakeChannel:
+    """
+    Stand-in of the paramiko channel. Run and sudo of FakeConnection use it like fabric does, and so do
+    Execute_with_input, stream_lines and packet_capture (kind exec)
+    The command runs when the input is closed (shutdown_write) or when the output is first asked for
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.kind = "exec"  # Kind of the recorded round trip
+        self._command = None
+        self._input = bytearray()
+        self._writing = False
+        self._stdout = self._stderr = None
+        self._code = None
+        self._pipe = None
+
+    def exec_command(self, command: str) -> None:
+        self._command = command
+
+    def sendall(self, data: bytes) -> None:
+        self._input += data
+
+    def send_ready(self) -> bool:
+        return True
+
+    def send(self, data: bytes) -> int:
+        # Output is not ready until the input is closed, as the operations read their whole stdin first
+        self._writing = True
+        self._input += data
+        return len(data)
+
+    def shutdown_write(self) -> None:
+        self._writing = False
+        self._run()
+
+    def _run(self) -> None:
+        if self._code is None:
+            stdout, stderr, self._code = self.connection.network.execute(self.connection, self.kind, self._command,
+                                                                         stdin=bytes(self._input))
+            self._stdout, self._stderr = io.BytesIO(stdout), io.BytesIO(stderr)
+
+    def _ready(self, stream: io.BytesIO) -> bool:
+        return stream.tell() < len(stream.getbuffer())
+
+    def recv_ready(self) -> bool:
+        if self._writing:
+            return False
+        self._run()
+        return self._ready(self._stdout)
+
+    def recv_stderr_ready(self) -> bool:
+        if self._writing:
+            return False
+        self._run()
+        return self._ready(self._stderr)
+
+    def recv(self, size: int) -> bytes:
+        self._run()
+        return self._stdout.read(size)
+
+    def recv_stderr(self, size: int) -> bytes:
+        self._run()
+        return self._stderr.read(size)
+
+    def exit_status_ready(self) -> bool:
+        if self._writing:
+            return False
+        self._run()
+        return True
+
+    def recv_exit_status(self) -> int:
+        self._run()
+        return self._code
+
+    def makefile(self, mode: str = "rb") -> io.BytesIO:
+        self._run()
+        return self._stdout
+
+    def makefile_stderr(self, mode: str = "rb") -> io.BytesIO:
+        self._run()
+        return self._stderr
+
+    def fileno(self) -> int:
+        # Always readable, so select() in stream_lines returns right away
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            os.write(self._pipe[1], b"x")
+        return self._pipe[0]
+
+    def close(self) -> None:
+        if self._pipe is not None:
+            os.close(self._pipe[0])
+            os.close(self._pipe[1])
+            self._pipe = None
+
+
+class FakeTransport:
+    def __init__(self, connection):
+        self.connection = connection
+        self.active = True
+        self.keepalive = 0
+
+    def is_authenticated(self) -> bool:
+        return self.active
+
+    def is_active(self) -> bool:
+        return self.active
+
+    def set_keepalive(self, interval: int) -> None:
+        self.keepalive = interval
+
+    def open_session(self) -> FakeChannel:
+        return FakeChannel(self.connection)
+
+
+class FakeConnection(fabric.Connection):
+    """
+    fabric.Connection whose commands and transfers go to a FakeHost of a FakeNetwork instead of an SSH server
+    Run, sudo, put, get and transport channels behave (and fail) like the fabric ones, so test_VM_commands and the
+    Drivers use it unchanged. It is an instance of fabric.Connection, run_parallel and the pool treat it as one
+    """
+
+    def __init__(self, network, host: str, **kwargs):
+        """
+        :param network: FakeNetwork
+        :param host: str
+        :param kwargs: fabric.Connection arguments
+        """
+        super().__init__(host, **kwargs)
+        self.network = network
+        self.fake_host = network.host(self.host)
+
+    def open(self) -> None:
+        if self.is_connected:
+            return
+        self.network.round_trip(self, "connect", "", 0)
+        self.fake_host.add_user(self.user, self.network.seed)
+        self.transport = FakeTransport(self)
+        self._sftp = None
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.active = False
+        self.transport = None
+        self._sftp = None
+
+    def _session(self, kind: str, command: str, stdin: bytes = b"") -> (bytes, bytes, int):
+        # Every command gets its own channel of the transport, as in fabric
+        channel = self.transport.open_session()
+        channel.kind = kind
+        channel.exec_command(command)
+        channel.sendall(stdin)
+        channel.shutdown_write()
+        stdout, stderr = channel.makefile("rb").read(), channel.makefile_stderr("rb").read()
+        code = channel.recv_exit_status()
+        channel.close()
+        return stdout, stderr, code
+
+    def _sftp_session(self) -> None:
+        # Transfers share one SFTP channel, opened by the first one (fabric caches its SFTP client)
+        if self._sftp is None:
+            self._sftp = self.transport.open_session()
+
+    def _result(self, command: str, stdout: bytes, stderr: bytes, code: int, hide, warn: bool) -> fabric.Result:
+        result = fabric.Result(connection=self, command=command, exited=code,
+                               stdout=stdout.decode(errors="replace"), stderr=stderr.decode(errors="replace"),
+                               hide=("stdout", "stderr") if hide else ())
+        if not hide:
+            sys.stdout.write(result.stdout)
+            sys.stderr.write(result.stderr)
+        if code != 0 and not warn:
+            raise invoke.UnexpectedExit(result)
+        return result
+
+    def run(self, command: str, *, hide=None, warn: bool = False, **kwargs) -> fabric.Result:
+        self.open()
+        stdout, stderr, code = self._session("run", command)
+        return self._result(command, stdout, stderr, code, hide, warn)
+
+    def sudo(self, command: str, *, hide=None, warn: bool = False, user: str = None, password: str = None,
+             **kwargs) -> fabric.Result:
+        self.open()
+        password = password or self.config.sudo.password
+        # Same prefix as invoke, test_VM_commands.execute cuts it off the result command
+        full_command = "sudo -S -p '[sudo] password: ' " + (f"-H -u {user} " if user else "") + command
+        stdin = (password + "\n").encode() if password and self.fake_host.sudo_password is not None else b""
+        stdout, stderr, code = self._session("sudo", full_command, stdin)
+        return self._result(full_command, stdout, stderr, code, hide, warn)
+
+    def _remote_path(self, path: str) -> str:
+        return posixpath.normpath(posixpath.join(self.fake_host.home(self.user), path))
+
+    def put(self, local, remote: str = None, preserve_mode: bool = True) -> fabric.transfer.Result:
+        self.open()
+        if hasattr(local, "read"):
+            data, mode, local_name = local.read(), 0o644, getattr(local, "name", None)
+        else:
+            with open(local, "rb") as file:
+                data = file.read()
+            mode, local_name = (os.stat(local).st_mode & 0o777 if preserve_mode else 0o644), os.path.basename(local)
+        remote_path = self._remote_path(remote or local_name)
+        if remote_path in self.fake_host.dirs:
+            remote_path = posixpath.join(remote_path, local_name)
+        self._sftp_session()
+        self.network.round_trip(self, "put", remote_path, len(data))
+        with self.fake_host.lock:
+            self.fake_host.write(remote_path, data, self.user, mode=mode)
+        return fabric.transfer.Result(local=local, orig_local=local, remote=remote_path, orig_remote=remote,
+                                      connection=self)
+
+    def get(self, remote: str, local=None, preserve_mode: bool = True) -> fabric.transfer.Result:
+        self.open()
+        remote_path = self._remote_path(remote)
+        with self.fake_host.lock:
+            data = self.fake_host.read(remote_path, self.user)
+            mode = self.fake_host.meta[remote_path]["mode"]
+        self._sftp_session()
+        self.network.round_trip(self, "get", remote_path, len(data))
+        if hasattr(local, "write"):
+            local.write(data)
+            return fabric.transfer.Result(local=local, orig_local=local, remote=remote_path, orig_remote=remote,
+                                          connection=self)
+        local_path = local or posixpath.basename(remote_path)
+        if local_path.endswith(os.sep) or os.path.isdir(local_path):
+            local_path = os.path.join(local_path, posixpath.basename(remote_path))
+        os.makedirs(os.path.dirname(os.path.abspath(local_path)), exist_ok=True)
+        with open(local_path, "wb") as file:
+            file.write(data)
+        if preserve_mode:
+            os.chmod(local_path, mode)
+        return fabric.transfer.Result(local=os.path.abspath(local_path), orig_local=local, remote=remote_path,
+                                      orig_remote=remote, connection=self)
+
+
+class FakeNetwork:
+    """
+    Connection backend with fake machines (see test_VM_commands.set_backend). Machines are created on the first
+    Connection to their address. Every round trip (connect, run, sudo, exec, put, get) is recorded with its host,
+    User, command or path, bytes and exit code, and delayed by the configured latency and bandwidth. Usage:
+        with FakeNetwork(latency=0.005) as network:  # Connections made by test_VM_commands.connect are fake
+            simple_case_driver.main()
+        print(network.report())
+        assert network.round_trips("192.168.56.105") <= 20
+    """
+
+    def __init__(self, *, latency: float = 0.0, handshake: float = None, bandwidth: float = None,
+                 strict: bool = False, sudo_password: str = None, seed: {str: str | dict} = None,
+                 unreachable: [str] = ()):
+        """
+        :param latency: float - seconds added to every round trip
+        :param handshake: float - seconds added to every connect. Default is 3 round trips
+        :param bandwidth: float - bytes per second of the payload (commands, input, output, files). None is unlimited
+        :param strict: bool - unhandled commands fail, see FakeHost
+        :param sudo_password: str - sudo password of the machines. None means passwordless sudo
+        :param seed: {str: str | dict} - folders copied to every machine, see FakeHost.add_user and DEFAULT_SEED
+        :param unreachable: [str] - hosts whose connect times out
+        """
+        self.latency = latency
+        self.handshake = handshake if handshake is not None else 3 * latency
+        self.bandwidth = bandwidth
+        self.strict = strict
+        self.sudo_password = sudo_password
+        self.seed = seed or {}
+        self.unreachable = set(unreachable)
+        self.hosts = {}
+        self.operations = []
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def host(self, name: str) -> FakeHost:
+        """
+        Returns the fake machine with the address, creates it on the first call
+        :param name: str
+        :return: FakeHost
+        """
+        with self._lock:
+            if name not in self.hosts:
+                self.hosts[name] = FakeHost(name, strict=self.strict, sudo_password=self.sudo_password)
+            return self.hosts[name]
+
+    def connection(self, host: str, **kwargs) -> FakeConnection:
+        """
+        Backend factory: takes the fabric.Connection arguments and returns a FakeConnection
+        :param host: str
+        :param kwargs: fabric.Connection arguments
+        :return: FakeConnection
+        """
+        return FakeConnection(self, host, **kwargs)
+
+    def round_trip(self, connection: FakeConnection, kind: str, detail: str, size: int, *,
+                   exited: int = None, seconds: float = 0.0) -> None:
+        if connection.host in self.unreachable:
+            raise TimeoutError(f"Connection to {connection.host} timed out (fake network)")
+        delay = (self.handshake if kind == "connect" else self.latency) + \
+            (size / self.bandwidth if self.bandwidth else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self.operations.append({"host": connection.host, "user": connection.user, "kind": kind,
+                                    "detail": detail, "bytes": size, "exited": exited, "seconds": seconds + delay})
+
+    def execute(self, connection: FakeConnection, kind: str, command: str, *, stdin: bytes = b"") -> (bytes, bytes,
+                                                                                                       int):
+        """
+        Runs the command on the machine of the connection as one round trip. Returns stdout, stderr and exit code
+        :param connection: FakeConnection
+        :param kind: str - run, sudo or exec (channel)
+        :param command: str
+        :param stdin: bytes
+        :return: (bytes, bytes, int)
+        """
+        start = time.perf_counter()
+        stdout, stderr, code = connection.fake_host.run(command, user=connection.user, stdin=stdin)
+        self.round_trip(connection, kind, command, len(command) + len(stdin) + len(stdout) + len(stderr),
+                        exited=code, seconds=time.perf_counter() - start)
+        return stdout, stderr, code
+
+    def round_trips(self, host: str = None, kind: str = None) -> int:
+        """
+        Returns the number of recorded round trips, optionally of one host and/or kind
+        :param host: str
+        :param kind: str
+        :return: int
+        """
+        with self._lock:
+            return sum(1 for operation in self.operations
+                       if (host is None or operation["host"] == host) and (kind is None or operation["kind"] == kind))
+
+    def counts(self) -> {str: {str: int}}:
+        """
+        Returns host:{kind:count} of the recorded round trips
+        :return: {str: {str: int}}
+        """
+        counts = {}
+        with self._lock:
+            for operation in self.operations:
+                host_counts = counts.setdefault(operation["host"], {})
+                host_counts[operation["kind"]] = host_counts.get(operation["kind"], 0) + 1
+        return counts
+
+    def report(self) -> str:
+        """
+        Returns a table of round trips, bytes and unhandled commands per host
+        :return: str
+        """
+        lines = [f"{'host':<20} {'round trips':>11} {'bytes':>10} {'unhandled':>9}  by kind"]
+        for host, counts in self.counts().items():
+            transferred = sum(operation["bytes"] for operation in self.operations if operation["host"] == host)
+            lines.append(f"{host:<20} {sum(counts.values()):>11} {transferred:>10} "
+                         f"{len(self.hosts[host].unhandled):>9}  "
+                         + ", ".join(f"{kind} {count}" for kind, count in sorted(counts.items())))
+        return "\n".join(lines)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.operations.clear()
+
+    def install(self):
+        """
+        Makes test_VM_commands.connect (and so the pools, drivers and the scenario engine) use this network
+        :return: FakeNetwork
+        """
+        self._previous = vm.set_backend(self.connection)
+        return self
+
+    def uninstall(self) -> None:
+        vm.set_backend(self._previous)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info) -> None:
+        self.uninstall()
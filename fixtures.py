@@ -0,0 +1,180 @@
+# Default configs as shipped by Open5Gs (v2.6) and UERANSIM (v3.2), trimmed of comments. Keys are paths relative
+# To ./transfers. Benchmarks, fake machines (fake_connection.DEFAULT_SEED) and tests use these, so they do not
+# Depend on the configs fetched to ./transfers
+TEMPLATES = {
+    "all_open5gs/amf.yaml": """
+logger:
+    file: /var/log/open5gs/amf.log
+sbi:
+    server:
+      no_tls: true
+amf:
+    sbi:
+      - addr: 127.0.0.5
+        port: 7777
+    ngap:
+      - addr: 127.0.0.5
+    metrics:
+      - addr: 127.0.0.5
+        port: 9090
+    guami:
+      - plmn_id:
+          mcc: 999
+          mnc: 70
+        amf_id:
+          region: 2
+          set: 1
+    tai:
+      - plmn_id:
+          mcc: 999
+          mnc: 70
+        tac: 1
+    plmn_support:
+      - plmn_id:
+          mcc: 999
+          mnc: 70
+        s_nssai:
+          - sst: 1
+    security:
+        integrity_order : [ NIA2, NIA1, NIA0 ]
+        ciphering_order : [ NEA0, NEA1, NEA2 ]
+    network_name:
+        full: Open5GS
+    amf_name: open5gs-amf0
+scp:
+    sbi:
+      - addr: 127.0.1.10
+        port: 7777
+parameter:
+max:
+usrsctp:
+time:
+  t3512:
+    value: 540
+""",
+    "all_open5gs/smf.yaml": """
+logger:
+    file: /var/log/open5gs/smf.log
+sbi:
+    server:
+      no_tls: true
+smf:
+    sbi:
+      - addr: 127.0.0.4
+        port: 7777
+    pfcp:
+      - addr: 127.0.0.4
+      - addr: ::1
+    gtpc:
+      - addr: 127.0.0.4
+      - addr: ::1
+    gtpu:
+      - addr: 127.0.0.4
+      - addr: ::1
+    metrics:
+      - addr: 127.0.0.4
+        port: 9090
+    subnet:
+      - addr: 10.45.0.1/16
+      - addr: 2001:db8:cafe::1/48
+    dns:
+      - 8.8.8.8
+      - 8.8.4.4
+    mtu: 1400
+    ctf:
+      enabled: auto
+    freeDiameter: /etc/freeDiameter/smf.conf
+scp:
+    sbi:
+      - addr: 127.0.1.10
+        port: 7777
+upf:
+    pfcp:
+      - addr: 127.0.0.7
+parameter:
+max:
+time:
+""",
+    "all_open5gs/upf.yaml": """
+logger:
+    file: /var/log/open5gs/upf.log
+upf:
+    pfcp:
+      - addr: 127.0.0.7
+    gtpu:
+      - addr: 127.0.0.7
+    subnet:
+      - addr: 10.45.0.1/16
+      - addr: 2001:db8:cafe::1/48
+    metrics:
+      - addr: 127.0.0.7
+        port: 9090
+smf:
+parameter:
+max:
+time:
+""",
+    "all_ueransim/open5gs-gnb.yaml": """
+mcc: '999'
+mnc: '70'
+nci: '0x000000010'
+idLength: 32
+tac: 1
+linkIp: 127.0.0.1
+ngapIp: 127.0.0.1
+gtpIp: 127.0.0.1
+amfConfigs:
+  - address: 127.0.0.5
+    port: 38412
+slices:
+  - sst: 1
+ignoreStreamIds: true
+""",
+    "all_ueransim/open5gs-ue.yaml": """
+supi: 'imsi-999700000000001'
+mcc: '999'
+mnc: '70'
+key: '465B5CE8B199B49FAA5F0A2EE238A6BC'
+op: 'E8ED289DEBA952E4283B54E88E6183CA'
+opType: 'OPC'
+amf: '8000'
+imei: '356938035643803'
+imeiSv: '4370816125816151'
+gnbSearchList:
+  - 127.0.0.1
+uacAic:
+  mps: false
+  mcs: false
+uacAcc:
+  normalClass: 0
+  class11: false
+  class12: false
+  class13: false
+  class14: false
+  class15: false
+sessions:
+  - type: 'IPv4'
+    apn: 'internet'
+    slice:
+      sst: 1
+configured-nssai:
+  - sst: 1
+default-nssai:
+  - sst: 1
+    sd: 1
+integrity:
+  IA1: true
+  IA2: true
+  IA3: true
+ciphering:
+  EA1: true
+  EA2: true
+  EA3: true
+integrityMaxRate:
+  uplink: 'full'
+  downlink: 'full'
+""",
+}
+# Template of every element, as used by the benchmarks
+TEMPLATE_PATHS = {"amf": "all_open5gs/amf.yaml", "smf": "all_open5gs/smf.yaml", "upf": "all_open5gs/upf.yaml",
+                  "gnb": "all_ueransim/open5gs-gnb.yaml", "ue": "all_ueransim/open5gs-ue.yaml"}
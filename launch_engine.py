@@ -0,0 +1,189 @@
+import fabric
+import test_VM_commands as vm
+import yaml_processing as config
+import logging
+import ipaddress
+import os
+import shlex
+
+# Open5Gs daemons are started in stages. Daemons of a stage are started together, the next stage is started
+# As soon as all daemons of the previous one are ready. NRF and SCP have to be up before the other NFs register
+OPEN5GS_STAGES = [["nrf"], ["scp"], ["udr", "udm", "ausf", "pcf", "bsf", "nssf", "upf"], ["amf", "smf"]]
+UERANSIM_STAGES = [["gnb"], ["ue"]]
+# Log lines that mean the UERANSIM element is ready
+UERANSIM_READY = {"gnb": "NG Setup procedure is successful", "ue": "PDU Session establishment is successful"}
+OPEN5GS_PFCP_READY = "PFCP associated"
+
+
+def read_launch_config(file_path: str) -> {str: [str]}:
+    """
+    Reads the launch config written by test_VM_commands.write_launch_config
+    Each line is "<daemon> <config path>". Empty path means the default config. Daemon can be listed many times
+    Returns daemon:[config paths] dict. None in the list stands for the default config
+    :param file_path: str
+    :return: {str: [str]}
+    """
+    daemons = {}
+    with open(file_path, "r") as file:
+        for line in file:
+            if len(line.strip()) == 0:
+                continue
+            key, _, value = line.strip().partition(" ")
+            daemons.setdefault(key, []).append(value.strip() or None)
+    return daemons
+
+
+def _log_offset(log_path: str, var: str) -> str:
+    # Size of the log before the start. Only lines written after the start are checked by the probes
+    return f"{var}=$(stat -c %s {log_path} 2>/dev/null || echo 0)"
+
+
+def _log_probe(log_path: str, var: str, line: str) -> str:
+    return f"tail -c +$(({var} + 1)) {log_path} 2>/dev/null | grep -q {shlex.quote(line)}"
+
+
+def _stage_script(starts: [str], probes: {str: str}, timeout: float) -> str:
+    """
+    Returns a script that runs the start commands, then polls every probe until it succeeds or timeout is reached
+    For every ready probe "READY <name> <milliseconds since start>" is printed, for others "TIMEOUT <name>"
+    """
+    lines = ["t0=$(date +%s%N)"] + starts
+    lines.append(f"deadline=$((t0 + {int(timeout * 1e9)}))")
+    lines.append("pending=" + shlex.quote(" ".join(probes)))
+    lines.append('while [ -n "$pending" ] && [ "$(date +%s%N)" -lt "$deadline" ]; do')
+    lines.append('  left=""')
+    lines.append('  for name in $pending; do')
+    lines.append('    case "$name" in')
+    for name, probe in probes.items():
+        lines.append(f'      {name}) if {probe}; then echo "READY {name} $((($(date +%s%N) - t0) / 1000000))"; '
+                     f'else left="$left {name}"; fi ;;')
+    lines.append('    esac')
+    lines.append('  done')
+    lines.append('  pending="$left"')
+    lines.append('  [ -n "$pending" ] && sleep 0.1')
+    lines.append('done')
+    lines.append('for name in $pending; do echo "TIMEOUT $name"; done')
+    return "\n".join(lines)
+
+
+def _run_stage(target_con: fabric.Connection, script: str) -> {str: float}:
+    result = vm.execute(target_con, command="bash -c " + shlex.quote(script), sudo=True)
+    ready, timed_out = {}, []
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == "READY":
+            ready[fields[1]] = int(fields[2]) / 1000
+        elif len(fields) == 2 and fields[0] == "TIMEOUT":
+            timed_out.append(fields[1])
+    if len(timed_out) != 0:
+        logging.error(f"Daemons {', '.join(timed_out)} on {target_con.host} did not become ready in time")
+        raise TimeoutError(f"Daemons not ready on {target_con.host}: {', '.join(timed_out)}")
+    return ready
+
+
+def setup_upf_interfaces(target_con: fabric.Connection, config_paths: [str]) -> None:
+    """
+    Creates tun interfaces of the UPF subnets (upf.subnet addr and dev fields) and enables NAT for them
+    Configs are read from the remote machine. Commands are idempotent, so they can be repeated on every launch
+    :param target_con: fabric.Connection
+    :param config_paths: [str]
+    :return: None
+    """
+    commands = ["sysctl -w net.ipv4.ip_forward=1", "sysctl -w net.ipv6.conf.all.forwarding=1"]
+    for config_path in config_paths:
+        upf_config = config.parse_yaml(vm.execute(target_con, command=f"cat {config_path}", sudo=True).stdout)
+        for subnet in upf_config['upf'].get('subnet') or []:
+            dev = subnet.get('dev', 'ogstun')
+            network = ipaddress.ip_interface(subnet['addr']).network
+            tables = "iptables" if network.version == 4 else "ip6tables"
+            commands += [f"ip link show {dev} >/dev/null 2>&1 || ip tuntap add name {dev} mode tun",
+                         f"ip addr replace {subnet['addr']} dev {dev}",
+                         f"ip link set {dev} up",
+                         f"{tables} -t nat -C POSTROUTING -s {network} ! -o {dev} -j MASQUERADE 2>/dev/null || "
+                         f"{tables} -t nat -A POSTROUTING -s {network} ! -o {dev} -j MASQUERADE"]
+    vm.execute_batch(target_con, commands=commands, sudo=True)
+
+
+def launch_open5gs(target_con: fabric.Connection, daemons: {str: [str]}, *, timeout: float = 30,
+                   wait_pfcp: bool = False) -> {str: float}:
+    """
+    Starts Open5Gs daemons in dependency order (see OPEN5GS_STAGES). Each stage is one remote command that starts
+    The daemons and returns as soon as all of them listen on their sockets, so there are no fixed sleeps
+    If wait_pfcp is set, SMF is ready only after it logs PFCP association with an UPF
+    Returns daemon:startup latency in seconds
+    :param target_con: fabric.Connection
+    :param daemons: {str: [str]} - as returned by read_launch_config
+    :param timeout: float - per stage
+    :param wait_pfcp: bool
+    :return: {str: float}
+    :raises TimeoutError: if a daemon was not ready in time. Later stages are not started
+    """
+    if "upf" in daemons:  # Tunnel interfaces have to exist before UPF starts
+        setup_upf_interfaces(target_con, [path or "/etc/open5gs/upf.yaml" for path in daemons["upf"]])
+
+    known = [daemon for stage in OPEN5GS_STAGES for daemon in stage]
+    stages = OPEN5GS_STAGES + [[daemon for daemon in daemons if daemon not in known]]  # e.g. 4G daemons go last
+    latencies = {}
+    for stage in stages:
+        starts, probes = [], {}
+        for daemon in (d for d in stage if d in daemons):
+            log_path = f"/var/log/open5gs/{daemon}.log"
+            for path in daemons[daemon]:
+                config_arg = f" -c {path}" if path else ""
+                starts.append(f"setsid -f /bin/open5gs-{daemon}d{config_arg} >/dev/null 2>&1 </dev/null")
+            probes[daemon] = f"ss -Hltunp 2>/dev/null | grep -q '\"open5gs-{daemon}d\"'"
+            if daemon == "smf" and wait_pfcp:
+                starts.insert(0, _log_offset(log_path, "off_smf"))
+                probes[daemon] += " && " + _log_probe(log_path, "off_smf", OPEN5GS_PFCP_READY)
+        if len(starts) != 0:
+            latencies.update(_run_stage(target_con, _stage_script(starts, probes, timeout)))
+
+    logging.info(f"Open5Gs daemons on {target_con.host} ready. Startup latencies: {latencies}")
+    return latencies
+
+
+def launch_ueransim(target_con: fabric.Connection, elements: {str: [str]}, *, timeout: float = 30) -> {str: float}:
+    """
+    Starts UERANSIM gNBs, then UEs. Each element is ready when its success line appears in its log
+    (see UERANSIM_READY). Logs are written to /tmp/nr-<element>-<config name>.log on the remote machine
+    Returns element (e.g. ue:ue0.yaml):startup latency in seconds
+    :param target_con: fabric.Connection
+    :param elements: {str: [str]} - as returned by read_launch_config, config paths relative to UERANSIM folder
+    :param timeout: float - per stage
+    :return: {str: float}
+    :raises TimeoutError: if an element was not ready in time. Later stages are not started
+    """
+    home = f"/home/{target_con.user}/UERANSIM" if target_con.user != "root" else "/root/UERANSIM"
+    latencies = {}
+    for stage in UERANSIM_STAGES:
+        starts, probes, names = [f"cd {home} || exit 1"], {}, {}
+        for element in (e for e in stage if e in elements):
+            for i, path in enumerate(elements[element]):
+                path = path or f"config/open5gs-{element}.yaml"
+                probe_name = f"{element}{i}"  # Probe names have to be valid shell words
+                names[probe_name] = f"{element}:{os.path.basename(path)}"
+                log_path = f"/tmp/nr-{element}-{os.path.basename(path)}.log"
+                starts += [_log_offset(log_path, f"off_{probe_name}"),
+                           f"setsid -f build/nr-{element} -c {path} >>{log_path} 2>&1 </dev/null"]
+                probes[probe_name] = _log_probe(log_path, f"off_{probe_name}", UERANSIM_READY[element])
+        if len(probes) != 0:
+            ready = _run_stage(target_con, _stage_script(starts, probes, timeout))
+            latencies.update({names[name]: latency for name, latency in ready.items()})
+
+    logging.info(f"UERANSIM elements on {target_con.host} ready. Startup latencies: {latencies}")
+    return latencies
+
+
+def launch(target_con: fabric.Connection, launch_config_path: str, *, timeout: float = 30) -> {str: float}:
+    """
+    Launches the simulation described in the launch config file (see test_VM_commands.write_launch_config)
+    On the machine specified in target_con. Mode is detected like in start_sim.sh: gnb or ue keys mean UERANSIM
+    :param target_con: fabric.Connection
+    :param launch_config_path: str
+    :param timeout: float
+    :return: {str: float}
+    """
+    daemons = read_launch_config(launch_config_path)
+    if "gnb" in daemons or "ue" in daemons:
+        return launch_ueransim(target_con, daemons, timeout=timeout)
+    return launch_open5gs(target_con, daemons, timeout=timeout)
@@ -0,0 +1,141 @@
+import asyncssh
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+
+# Sudo stand-in put first on the PATH of the executed commands. Skips the sudo options and runs the command
+# As the server user. Stand-in does not need root, but commands that need it will fail like on a real machine
+_SUDO_SHIM = """#!/bin/sh
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -p|-u|-g) shift 2 ;;
+    --) shift; break ;;
+    -*) shift ;;
+    *) break ;;
+  esac
+done
+exec "$@"
+"""
+
+
+class LocalSSHServer:
+    """
+    In-process SSH server (asyncssh) that executes commands and SFTP transfers on the local machine
+    It is a stand-in for the VMs, so test_VM_commands, async_vm_commands and the drivers can be exercised
+    And benchmarked without real machines. Host and client keys are generated in a temporary folder
+    Usage from blocking code (e.g. fabric):
+        server = LocalSSHServer()
+        server.start_in_thread()
+        c = test_VM_commands.connect("127.0.0.1", username=getpass.getuser(), key_path=server.client_key_path,
+                                     port=server.port)
+        ...
+        server.stop_in_thread()
+    From asyncio code, await start() and stop() instead
+    """
+
+    def __init__(self, *, host: str = "127.0.0.1", port: int = 0):
+        """
+        :param host: str
+        :param port: int - 0 picks a free port, see the port attribute after the start
+        """
+        self.host = host
+        self.port = port
+        self._workdir = tempfile.TemporaryDirectory(prefix="vm_automation_sshd_")
+        self.client_key_path = os.path.join(self._workdir.name, "client_key")
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._connections = []
+
+        host_key = asyncssh.generate_private_key("ssh-ed25519")
+        client_key = asyncssh.generate_private_key("ssh-ed25519")
+        client_key.write_private_key(self.client_key_path)
+        self._host_key = host_key
+        self._authorized_keys = asyncssh.import_authorized_keys(client_key.export_public_key().decode())
+
+        bin_dir = os.path.join(self._workdir.name, "bin")
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "sudo"), "w") as file:
+            file.write(_SUDO_SHIM)
+        os.chmod(os.path.join(bin_dir, "sudo"), 0o755)
+        self._env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""))
+
+    async def _handle_process(self, process: asyncssh.SSHServerProcess) -> None:
+        local = await asyncio.create_subprocess_shell(
+            process.command or "sh", env=self._env,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+        async def pump(src, dst):
+            while data := await src.read(65536):
+                dst.write(data)
+                await dst.drain()
+
+        async def feed():
+            try:
+                while data := await process.stdin.read(65536):
+                    local.stdin.write(data)
+                    await local.stdin.drain()
+            except (asyncssh.Error, ConnectionError):
+                pass
+            finally:
+                local.stdin.close()
+
+        feeder = asyncio.ensure_future(feed())
+        # All the output is forwarded before the exit status is sent
+        await asyncio.gather(pump(local.stdout, process.stdout), pump(local.stderr, process.stderr))
+        exit_code = await local.wait()
+        feeder.cancel()
+        process.exit(exit_code)
+
+    async def start(self) -> None:
+        """
+        Starts listening. Has to be awaited in the event loop that will serve the connections
+        :return: None
+        """
+        self._server = await asyncssh.create_server(
+            asyncssh.SSHServer, self.host, self.port,
+            server_host_keys=[self._host_key], authorized_client_keys=self._authorized_keys,
+            process_factory=self._handle_process, sftp_factory=True, encoding=None, acceptor=self._connections.append)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"Local SSH server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        """
+        Stops the server and removes the generated keys
+        :return: None
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        for connection in self._connections:  # Sessions (e.g. SFTP) of the clients end with their connection
+            connection.close()
+            await connection.wait_closed()
+        self._workdir.cleanup()
+
+    def start_in_thread(self) -> None:
+        """
+        Starts the server in its own thread with its own event loop. For use from blocking code
+        :return: None
+        """
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop_in_thread(self) -> None:
+        """
+        Stops the server started with start_in_thread
+        :return: None
+        """
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
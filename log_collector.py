@@ -0,0 +1,270 @@
+import fabric
+import invoke
+import test_VM_commands as vm
+import logging
+import base64
+import gzip
+import json
+import os
+import shlex
+import time
+from metrics import instrumented
+from typing import Iterator
+
+# Remote logs of the simulators. UERANSIM output is redirected to /tmp/nr-*.log by launch_engine
+LOG_SOURCES = {"open5gs": ["/var/log/open5gs/*.log"],
+               "ueransim": ["/tmp/nr-*.log"]}
+DEFAULT_DEST = "./transfers/logs"  # One folder per host: log files, offsets.json and index.jsonl
+MAX_CHUNK = 64 * 1024 * 1024  # Bytes fetched from one file per collection. The rest is fetched by the next one
+
+
+def collect_command(patterns: [str], known: {str: [int]}, *, max_bytes: int = MAX_CHUNK) -> str:
+    """
+    Returns the remote (bash) script that outputs new bytes of all files matching the patterns, in one gzip
+    Compressed, base64 encoded stream. Known is remote path:[inode, offset] of the previous collection
+    A file whose inode changed or that got shorter (rotated or truncated) is read from the start
+    Every chunk is framed by a "FILE inode offset length path" line, see parse_chunks
+    :param patterns: [str]
+    :param known: {str: [int]}
+    :param max_bytes: int
+    :return: str
+    """
+    entries = " ".join(f"[{shlex.quote(path)}]={shlex.quote(f'{inode} {offset}')}"
+                       for path, (inode, offset) in known.items())
+    return "\n".join([
+        f"declare -A known=({entries})",
+        "shopt -s nullglob",
+        "chunk=$(mktemp /tmp/vm_automation_XXXXXX) || exit 1",
+        f"{{ for f in {' '.join(patterns)}; do",
+        '  [ -f "$f" ] || continue',
+        '  read -r inode size <<< "$(stat -c "%i %s" "$f")"',
+        '  read -r known_inode offset <<< "${known[$f]:-0 0}"',
+        '  if [ "$inode" != "$known_inode" ] || [ "$size" -lt "$offset" ]; then offset=0; fi',
+        '  [ "$size" -gt "$offset" ] || continue',
+        # Chunk is copied first, so the frame has the exact length even if the file changes meanwhile
+        f'  tail -c +$((offset + 1)) "$f" | head -c {max_bytes} > "$chunk"',
+        '  printf "FILE %s %s %s %s\\n" "$inode" "$offset" "$(stat -c %s "$chunk")" "$f"',
+        '  cat "$chunk"',
+        'done; } | gzip -c | base64 -w0',
+        'rm -f "$chunk"'])
+
+
+def parse_chunks(packed: str) -> Iterator[tuple[str, int, int, bytes]]:
+    """
+    Parses output of the collect command into (remote path, inode, offset, data) chunks
+    :param packed: str
+    :return: Iterator[tuple[str, int, int, bytes]]
+    """
+    stream = gzip.decompress(base64.b64decode(packed.strip()))
+    position = 0
+    while position < len(stream):
+        end = stream.index(b"\n", position)
+        _, inode, offset, length, path = stream[position:end].decode().split(" ", 4)
+        position = end + 1 + int(length)
+        yield path, int(inode), int(offset), stream[end + 1:position]
+
+
+def daemon_name(remote_path: str) -> str:
+    """
+    Returns the daemon (or UERANSIM element) a log belongs to, e.g. amf for /var/log/open5gs/amf.log and
+    nr-gnb-open5gs-gnb.yaml for /tmp/nr-gnb-open5gs-gnb.yaml.log
+    :param remote_path: str
+    :return: str
+    """
+    name = os.path.basename(remote_path)
+    return name[:-len(".log")] if name.endswith(".log") else name
+
+
+def load_offsets(host_folder: str) -> ({str: [int]}, {str: int}):
+    """
+    Returns remote path:[inode, offset] and local file name:length saved by the last completed collection
+    Returns None if nothing usable is saved (no file, a damaged file or one without the local lengths)
+    :param host_folder: str
+    :return: ({str: [int]}, {str: int})
+    """
+    try:
+        with open(os.path.join(host_folder, "offsets.json"), "r") as file:
+            saved = json.load(file)
+        if not isinstance(saved["remote"], dict) or not isinstance(saved["local"], dict):
+            return None
+        return saved["remote"], saved["local"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+        return None
+
+
+def set_aside(host_folder: str, names: [str]) -> str:
+    """
+    Moves the files of the host folder to a new previous_<time> subfolder, so they are kept but not continued
+    Returns the subfolder. Index lines of the moved files still point to the original paths
+    :param host_folder: str
+    :param names: [str]
+    :return: str
+    """
+    previous = os.path.join(host_folder, time.strftime("previous_%Y%m%d-%H%M%S"))
+    while os.path.exists(previous):  # Two generations within a second
+        previous += "_"
+    os.makedirs(previous)
+    for name in names:
+        os.replace(os.path.join(host_folder, name), os.path.join(previous, name))
+    return previous
+
+
+def start_generation(host_folder: str) -> None:
+    """
+    Sets the collected files of the host aside when their offsets are lost. Collection starts from the beginning
+    Of the remote logs again, and appending to the old files would duplicate their content
+    :param host_folder: str
+    :return: None
+    """
+    if not os.path.isdir(host_folder):
+        return
+    names = [name for name in os.listdir(host_folder)
+             if name.endswith(".log") or name in ("index.jsonl", "offsets.json")]
+    if len(names) != 0:
+        previous = set_aside(host_folder, names)
+        logging.warning(f"Offsets of {host_folder} are missing or damaged. Collected files moved to {previous}")
+
+
+def truncate_uncommitted(host_folder: str, lengths: {str: int}) -> None:
+    """
+    Cuts the local logs and index.jsonl back to the lengths saved with the offsets. Bytes after them were written
+    By a collection that did not finish, their chunks are fetched again (and would be duplicated otherwise)
+    Only the files in lengths are cut. Logs that are not there were started by the unfinished collection,
+    They are set aside (see set_aside) instead
+    :param host_folder: str
+    :param lengths: {str: int}
+    :return: None
+    """
+    if not os.path.isdir(host_folder):
+        return
+    for name, length in lengths.items():
+        path = os.path.join(host_folder, name)
+        if os.path.isfile(path) and os.path.getsize(path) > length:
+            logging.warning(f"Dropping {os.path.getsize(path) - length} bytes of {path} "
+                            f"written by an unfinished collection")
+            with open(path, "r+b") as file:
+                file.truncate(length)
+    unlisted = [name for name in os.listdir(host_folder)
+                if (name.endswith(".log") or name == "index.jsonl") and name not in lengths]
+    if len(unlisted) != 0:
+        previous = set_aside(host_folder, unlisted)
+        logging.warning(f"Files {unlisted} of {host_folder} are not in the saved offsets. Moved to {previous}")
+
+
+@instrumented("collect_logs", size=lambda args, kwargs, result: sum(result.values()))
+def collect_logs(target_con: fabric.Connection, *, patterns: [str] = None, dest_folder: str = DEFAULT_DEST,
+                 sudo: bool = True, max_bytes: int = MAX_CHUNK) -> {str: int}:
+    """
+    Fetches bytes written to the logs on the machine specified in target_con since the previous collection
+    Offsets are kept per host and file, so repeated collection costs only the new bytes (one remote command)
+    New bytes are appended to <dest_folder>/<host>/<daemon>.log and described by a line of index.jsonl:
+    host, daemon, remote path, local path, local offset, bytes, remote offset, inode and collection time
+    A remote log that was rotated or truncated continues in the same local file, its chunk has remote offset 0
+    Returns remote path:new bytes of the files that had any. Patterns default to all LOG_SOURCES
+    :param target_con: fabric.Connection
+    :param patterns: [str] - remote glob patterns
+    :param dest_folder: str
+    :param sudo: bool
+    :param max_bytes: int - per file. Longer deltas are finished by the next collections
+    :return: {str: int}
+    """
+    patterns = patterns or [pattern for sources in LOG_SOURCES.values() for pattern in sources]
+    host_folder = os.path.join(dest_folder, target_con.host)
+    saved = load_offsets(host_folder)
+    if saved is None:
+        start_generation(host_folder)
+        offsets, lengths = {}, {}
+    else:
+        offsets, lengths = saved
+        truncate_uncommitted(host_folder, lengths)
+    collected = {}
+    command = f"bash -c {shlex.quote(collect_command(patterns, offsets, max_bytes=max_bytes))}"
+    vm.count_session(target_con)
+    try:
+        # Not through vm.execute, that logs the whole output (the collected logs)
+        if sudo:
+            result = target_con.sudo(command, hide=True)
+        else:
+            result = target_con.run(command, hide=True)
+        chunks = list(parse_chunks(result.stdout))
+    except invoke.UnexpectedExit as e:
+        logging.exception(f"Log collection on {target_con.host} failed.\n"
+                          f"Got output on stderr \n{e.result.stderr}error code {e.result.return_code}\n",
+                          exc_info=False)
+        return collected
+    except (ValueError, OSError, EOFError):
+        logging.exception(f"Log collection on {target_con.host} returned a malformed stream")
+        return collected
+
+    now = time.time()
+    os.makedirs(host_folder, exist_ok=True)
+    with open(os.path.join(host_folder, "index.jsonl"), "a") as index:
+        for remote_path, inode, offset, data in chunks:
+            local_name = daemon_name(remote_path) + ".log"
+            local_path = os.path.join(host_folder, local_name)
+            with open(local_path, "ab") as file:
+                local_offset = file.tell()
+                file.write(data)
+            lengths[local_name] = local_offset + len(data)
+            index.write(json.dumps({"host": target_con.host, "daemon": daemon_name(remote_path),
+                                    "remote_path": remote_path, "local_path": local_path,
+                                    "local_offset": local_offset, "bytes": len(data), "remote_offset": offset,
+                                    "inode": inode, "time": now}) + "\n")
+            offsets[remote_path] = [inode, offset + len(data)]
+            collected[remote_path] = len(data)
+        lengths["index.jsonl"] = index.tell()
+    # Offsets are saved (atomically) after the data. Data of an interrupted collection is cut off by the next
+    # One (see truncate_uncommitted) and fetched again, so it is neither lost nor duplicated
+    with open(os.path.join(host_folder, "offsets.json.tmp"), "w") as file:
+        json.dump({"remote": offsets, "local": lengths}, file, indent=1, sort_keys=True)
+    os.replace(os.path.join(host_folder, "offsets.json.tmp"), os.path.join(host_folder, "offsets.json"))
+    logging.info(f"Collected {sum(collected.values())} new log bytes from {len(collected)} files on {target_con.host}")
+    return collected
+
+
+def collect_logs_parallel(connections: [fabric.Connection], *, max_workers: int = 8,
+                          **collect_kwargs) -> ({str: {str: int}}, {str: Exception}):
+    """
+    Collects new log bytes from all machines at once, see collect_logs
+    :param connections: [fabric.Connection]
+    :param max_workers: int
+    :param collect_kwargs: patterns, dest_folder, sudo, max_bytes
+    :return: ({str: {str: int}}, {str: Exception})
+    """
+    return vm.run_parallel(connections, collect_logs, max_workers=max_workers, **collect_kwargs)
+
+
+def read_index(dest_folder: str = DEFAULT_DEST, *, host: str = None, daemon: str = None, since: float = None,
+               until: float = None) -> [dict]:
+    """
+    Returns index entries of the collected chunks that match the host, daemon and collection time range (unix
+    Time). Unset filters match everything. Data of an entry is read with read_chunk
+    :param dest_folder: str
+    :param host: str
+    :param daemon: str
+    :param since: float
+    :param until: float
+    :return: [dict]
+    """
+    entries = []
+    hosts = [host] if host is not None else sorted(os.listdir(dest_folder))
+    for name in hosts:
+        try:
+            with open(os.path.join(dest_folder, name, "index.jsonl"), "r") as index:
+                entries += [json.loads(line) for line in index]
+        except FileNotFoundError:
+            continue
+    return [entry for entry in entries
+            if (daemon is None or entry["daemon"] == daemon) and (since is None or entry["time"] >= since)
+            and (until is None or entry["time"] <= until)]
+
+
+def read_chunk(entry: dict) -> bytes:
+    """
+    Returns the data of an index entry (see read_index)
+    :param entry: dict
+    :return: bytes
+    """
+    with open(entry["local_path"], "rb") as file:
+        file.seek(entry["local_offset"])
+        return file.read(entry["bytes"])
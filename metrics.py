@@ -0,0 +1,204 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets in the Prometheus export
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, 300.0)
+LOCAL_HOST = "local"  # Host tag of operations that do not touch a remote machine (e.g. yaml processing)
+
+
+class Metrics:
+    """
+    Thread safe registry of operation spans and counters, tagged by host and operation
+    Every span adds to the total time of its operation and to its self time, which excludes nested spans
+    (e.g. the execute done inside put_file). Self times of a host add up to the time spent on it
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}  # (host, operation):stats dict
+
+    def _entry(self, host: str, operation: str) -> dict:
+        return self._stats.setdefault((host, operation), {
+            "count": 0, "errors": 0, "total_s": 0.0, "self_s": 0.0, "min_s": None, "max_s": 0.0, "bytes": 0,
+            "buckets": [0] * len(BUCKETS)})
+
+    @contextlib.contextmanager
+    def span(self, operation: str, host: str = LOCAL_HOST):
+        """
+        Measures the enclosed block as one call of operation on host. Exceptions are counted as errors
+        Yields a dict, bytes set in it are added to the byte counter of the operation
+        :param operation: str
+        :param host: str
+        """
+        if not self.enabled:
+            yield {}
+            return
+        stack = self._local.__dict__.setdefault("stack", [])
+        frame = {"bytes": 0, "children_s": 0.0}
+        stack.append(frame)
+        failed = False
+        start = time.perf_counter()
+        try:
+            yield frame
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if len(stack) != 0:
+                stack[-1]["children_s"] += elapsed
+            with self._lock:
+                entry = self._entry(host, operation)
+                entry["count"] += 1
+                entry["errors"] += failed
+                entry["total_s"] += elapsed
+                entry["self_s"] += max(0.0, elapsed - frame["children_s"])
+                entry["min_s"] = elapsed if entry["min_s"] is None else min(entry["min_s"], elapsed)
+                entry["max_s"] = max(entry["max_s"], elapsed)
+                entry["bytes"] += frame["bytes"]
+                for i, bound in enumerate(BUCKETS):
+                    if elapsed <= bound:
+                        entry["buckets"][i] += 1
+                        break
+
+    def add_bytes(self, operation: str, host: str, count: int) -> None:
+        """
+        Adds to the byte counter of the operation without recording a span
+        :param operation: str
+        :param host: str
+        :param count: int
+        :return: None
+        """
+        with self._lock:
+            self._entry(host, operation)["bytes"] += count
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self) -> [dict]:
+        """
+        Returns the collected stats, one dict per host and operation
+        :return: [dict]
+        """
+        with self._lock:
+            return [{"host": host, "operation": operation,
+                     **{key: (round(value, 6) if isinstance(value, float) else value)
+                        for key, value in entry.items() if key != "buckets"}}
+                    for (host, operation), entry in sorted(self._stats.items())]
+
+    def to_json(self) -> str:
+        """
+        Returns the collected stats as json
+        :return: str
+        """
+        return json.dumps({"operations": self.snapshot()}, indent=2)
+
+    def to_prometheus(self, *, prefix: str = "vm_automation") -> str:
+        """
+        Returns the collected stats in Prometheus text exposition format
+        Latencies are a histogram, errors and bytes are counters. All of them are labeled by operation and host
+        :param prefix: str
+        :return: str
+        """
+        def labels(host: str, operation: str, **extra) -> str:
+            pairs = {"operation": operation, "host": host, **extra}
+            escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                       for value in pairs.values())
+            return "{" + ",".join(f'{k}="{v}"' for k, v in zip(pairs, escaped)) + "}"
+
+        with self._lock:
+            stats = sorted(self._stats.items())
+            buckets = {key: list(entry["buckets"]) for key, entry in stats}
+        lines = [f"# HELP {prefix}_operation_seconds Duration of operations",
+                 f"# TYPE {prefix}_operation_seconds histogram"]
+        for (host, operation), entry in stats:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, buckets[(host, operation)]):
+                cumulative += count
+                lines.append(f"{prefix}_operation_seconds_bucket{labels(host, operation, le=bound)} {cumulative}")
+            lines.append(f"{prefix}_operation_seconds_bucket{labels(host, operation, le='+Inf')} {entry['count']}")
+            lines.append(f"{prefix}_operation_seconds_sum{labels(host, operation)} {entry['total_s']:.6f}")
+            lines.append(f"{prefix}_operation_seconds_count{labels(host, operation)} {entry['count']}")
+        for name, key, help_text in (("operation_errors_total", "errors", "Operations that raised an exception"),
+                                     ("operation_bytes_total", "bytes", "Bytes transferred by operations")):
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} counter"]
+            lines += [f"{prefix}_{name}{labels(host, operation)} {entry[key]}" for (host, operation), entry in stats]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """
+        Returns a readable end of run summary: per host, where the time went (self time of every operation)
+        :return: str
+        """
+        hosts = {}
+        for stat in self.snapshot():
+            hosts.setdefault(stat["host"], []).append(stat)
+        lines = []
+        for host, stats in hosts.items():
+            total = sum(stat["self_s"] for stat in stats)
+            lines.append(f"{host}: {total:.3f}s")
+            for stat in sorted(stats, key=lambda stat: stat["self_s"], reverse=True):
+                share = stat["self_s"] / total * 100 if total > 0 else 0.0
+                lines.append(f"  {stat['operation']:<16} {stat['self_s']:9.3f}s {share:5.1f}%  "
+                             f"calls {stat['count']:<6} errors {stat['errors']:<4} "
+                             f"max {stat['max_s']:.3f}s  bytes {stat['bytes']}")
+        return "\n".join(lines)
+
+
+REGISTRY = Metrics()  # Shared by test_VM_commands, yaml_processing and the drivers
+
+
+def host_of(target) -> str:
+    """
+    Returns the host tag of a connection (anything with a host attribute) or an ip address
+    :param target: fabric.Connection | str
+    :return: str
+    """
+    return getattr(target, "host", None) or (target if isinstance(target, str) else LOCAL_HOST)
+
+
+def file_size(path: str) -> int:
+    """
+    Returns size of the local file, 0 if it does not exist
+    :param path: str
+    :return: int
+    """
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def argument(args: tuple, kwargs: dict, index: int, name: str):
+    # Argument of the instrumented call, passed either by position or by name
+    return args[index] if len(args) > index else kwargs.get(name)
+
+
+def instrumented(operation: str, *, remote: bool = True, size=None):
+    """
+    Decorator that records every call of the function as a span of operation
+    If remote is set, the host tag is taken from the first argument (connection or ip address)
+    Size is an optional function (args, kwargs, result) -> bytes transferred by the call
+    :param operation: str
+    :param remote: bool
+    :param size: callable
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            host = host_of(args[0] if args else kwargs.get("target_con")) if remote else LOCAL_HOST
+            with REGISTRY.span(operation, host) as frame:
+                result = func(*args, **kwargs)
+                if size is not None and REGISTRY.enabled:
+                    frame["bytes"] += size(args, kwargs, result)
+                return result
+        return wrapper
+    return decorator
@@ -0,0 +1,292 @@
+import fabric
+import test_VM_commands as vm
+import metrics
+import logging
+import fnmatch
+import gzip
+import json
+import os
+import shlex
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+# Captures by plane instead of an interface name. Planes are captured on all interfaces with the filter
+PLANES = {"n2": "sctp port 38412",  # NGAP, gNB - AMF
+          "n3": "udp port 2152",    # GTP-U, gNB - UPF
+          "n4": "udp port 8805"}    # PFCP, SMF - UPF
+PCAP_HEADER = 24  # Global header of a pcap stream, repeated at the start of every rotated file
+RECORD_HEADER = 16  # ts_sec, ts_usec (or nsec), incl_len, orig_len
+_NANOSECOND_MAGIC = (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d")
+
+
+def resolve_interfaces(target_con: fabric.Connection, interfaces: [str]) -> [(str, str, str)]:
+    """
+    Resolves interface names, glob patterns (e.g. ogstun*) and planes (see PLANES) to (name, interface, filter)
+    Tuples. Patterns are matched against the interfaces present on the machine, in one remote call
+    :param target_con: fabric.Connection
+    :param interfaces: [str]
+    :return: [(str, str, str)]
+    """
+    present = []
+    if any(any(char in interface for char in "*?[") for interface in interfaces):
+        present = vm.execute(target_con, command="ls /sys/class/net").stdout.split()
+    resolved = []
+    for interface in interfaces:
+        if interface.lower() in PLANES:
+            resolved.append((interface.lower(), "any", PLANES[interface.lower()]))
+        elif any(char in interface for char in "*?["):
+            matched = fnmatch.filter(present, interface)
+            if len(matched) == 0:
+                logging.error(f"No interface on {target_con.host} matches {interface}")
+            resolved += [(name, name, "") for name in matched]
+        else:
+            resolved.append((interface, interface, ""))
+    return resolved
+
+
+class Capture:
+    """
+    One tcpdump on one interface of a machine. Pcap data is streamed gzip compressed over a channel of the
+    Existing connection while the capture runs, and written to local files, rotated by size and/or time
+    Rotated files are complete pcaps (.pcap.gz, readable by Wireshark). Each file is described by an index entry
+    """
+
+    def __init__(self, target_con: fabric.Connection, name: str, interface: str, dest_folder: str, *,
+                 capture_filter: str = "", snaplen: int = 262144, rotate_bytes: int = 100_000_000,
+                 rotate_seconds: float = None):
+        """
+        :param target_con: fabric.Connection
+        :param name: str - interface name or plane, used in the file names
+        :param interface: str
+        :param dest_folder: str
+        :param capture_filter: str - tcpdump filter expression
+        :param snaplen: int
+        :param rotate_bytes: int - uncompressed pcap bytes per file. None disables size rotation
+        :param rotate_seconds: float - capture time per file (by packet timestamps). None disables time rotation
+        """
+        self.target_con = target_con
+        self.name = name
+        self.interface = interface
+        self.dest_folder = dest_folder
+        self.capture_filter = capture_filter
+        self.snaplen = snaplen
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.files = []  # Index entries of the written files
+        self.wire_bytes = 0  # Compressed bytes received
+        self.error = None
+        self._pid_file = f"/tmp/vm_automation_capture_{uuid.uuid4().hex[:12]}.pid"
+        self._channel = None
+        self._thread = None
+        self._file = None
+        self._header = b""
+        self._little = True
+        self._divisor = 1e6
+
+    def command(self) -> str:
+        # Pid of tcpdump is kept to stop it with SIGINT, so it flushes its output and the stream ends cleanly
+        tcpdump = (f"tcpdump -i {shlex.quote(self.interface)} -U -n -s {self.snaplen} -w - "
+                   f"{shlex.quote(self.capture_filter) if self.capture_filter else ''}")
+        return (f"{{ {tcpdump} & echo $! > {self._pid_file}; wait; }} | gzip -1 -c; "
+                f"rc=${{PIPESTATUS[0]}}; rm -f {self._pid_file}; exit $rc")
+
+    def start(self, *, timeout: float = 10) -> None:
+        """
+        Starts tcpdump and returns once it is listening, so packets sent after the start are captured
+        :param timeout: float
+        :return: None
+        :raises RuntimeError: if tcpdump did not start listening (e.g. interface does not exist)
+        """
+        password = self.target_con.config.sudo.password
+        sudo_prefix = "sudo -S -p ''" if password else "sudo -n"
+        self.target_con.open()
+        vm.count_session(self.target_con)
+        self._channel = self.target_con.transport.open_session()
+        self._channel.exec_command(f"{sudo_prefix} bash -c {shlex.quote(self.command())}")
+        if password:
+            self._channel.sendall((password + "\n").encode())
+
+        stderr = b""
+        deadline = time.monotonic() + timeout
+        while b"listening on" not in stderr:
+            if self._channel.recv_stderr_ready():
+                stderr += self._channel.recv_stderr(4096)
+            elif self._channel.exit_status_ready() or time.monotonic() > deadline:
+                self._channel.close()
+                raise RuntimeError(f"Capture on {self.target_con.host} {self.interface} did not start. "
+                                   f"Got output on stderr \n{stderr.decode(errors='replace')}")
+            else:
+                time.sleep(0.01)
+        logging.info(f"Capture of {self.name} on {self.target_con.host} started")
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def stop(self, *, timeout: float = 30) -> [dict]:
+        """
+        Stops tcpdump, waits until the rest of the stream is received and returns the index entries
+        :param timeout: float
+        :return: [dict]
+        """
+        try:
+            vm.execute(self.target_con, command=f"kill -INT $(cat {self._pid_file}) 2>/dev/null || true", sudo=True)
+        finally:
+            self._thread.join(timeout)
+            if self._thread.is_alive():  # Stream did not end, channel is closed to release the reader
+                self.error = self.error or "stream did not end after stop"
+                self._channel.close()
+                self._thread.join()
+        while self._channel.recv_stderr_ready():  # Capture statistics (packets dropped by kernel etc.)
+            logging.info(f"[{self.target_con.host}] {self.name}: {self._channel.recv_stderr(4096).decode().strip()}")
+        self._channel.close()
+        if self.error is not None:
+            logging.error(f"Capture of {self.name} on {self.target_con.host} failed. Reason: {self.error}")
+        return self.files
+
+    def _receive(self) -> None:
+        decompressor = zlib.decompressobj(wbits=31)  # gzip stream
+        pending = b""
+        try:
+            while data := self._channel.recv(65536):
+                self.wire_bytes += len(data)
+                metrics.REGISTRY.add_bytes("capture", self.target_con.host, len(data))
+                pending = self._write_records(pending + decompressor.decompress(data))
+            self._write_records(pending + decompressor.flush())
+        except (OSError, zlib.error, struct.error) as e:
+            self.error = repr(e)
+        finally:
+            self._close_file()
+
+    def _write_records(self, data: bytes) -> bytes:
+        # Writes complete pcap records to the current file and returns the incomplete rest
+        if len(self._header) == 0:
+            if len(data) < PCAP_HEADER:
+                return data
+            self._header, data = data[:PCAP_HEADER], data[PCAP_HEADER:]
+            self._little = self._header[:4] in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1")
+            self._divisor = 1e9 if self._header[:4] in _NANOSECOND_MAGIC else 1e6
+        record_format = "<IIII" if self._little else ">IIII"
+        offset = 0
+        while len(data) - offset >= RECORD_HEADER:
+            seconds, fraction, length, _ = struct.unpack_from(record_format, data, offset)
+            end = offset + RECORD_HEADER + length
+            if end > len(data):
+                break
+            timestamp = seconds + fraction / self._divisor
+            entry = self.files[-1] if self._file is not None else None
+            if entry is None or \
+                    (self.rotate_bytes is not None and entry["bytes"] + end - offset > self.rotate_bytes and
+                     entry["packets"] != 0) or \
+                    (self.rotate_seconds is not None and timestamp - entry["first"] >= self.rotate_seconds):
+                entry = self._rotate(timestamp)
+            self._file.write(data[offset:end])
+            entry["packets"] += 1
+            entry["bytes"] += end - offset
+            entry["last"] = timestamp
+            offset = end
+        return data[offset:]
+
+    def _rotate(self, timestamp: float) -> dict:
+        self._close_file()
+        file_name = f"{self.target_con.host}_{self.name}_{len(self.files):04d}.pcap.gz"
+        os.makedirs(self.dest_folder, exist_ok=True)
+        self._file = gzip.open(os.path.join(self.dest_folder, file_name), "wb", compresslevel=1)
+        self._file.write(self._header)
+        self.files.append({"host": self.target_con.host, "interface": self.name, "file": file_name,
+                           "first": timestamp, "last": timestamp, "packets": 0, "bytes": PCAP_HEADER})
+        return self.files[-1]
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self.files[-1]["compressed_bytes"] = os.path.getsize(self._file.name)
+            self._file = None
+
+
+class CaptureSession:
+    """
+    Packet captures on many machines and interfaces, started and stopped at once. Usage:
+        with CaptureSession({c[0]: ["n2", "n4"], c[1]: ["ogstun*"]}, "./transfers/capture") as session:
+            ...  # Launch gNB and UEs, run the traffic
+        # Captures are in ./transfers/capture with index.json describing the files
+    Each file has an index entry: host, interface, file, first and last packet time (unix time), packets,
+    Bytes (uncompressed pcap) and compressed_bytes, so the captures needed can be picked without opening them
+    """
+
+    def __init__(self, targets: {fabric.Connection: [str]}, dest_folder: str, *, max_workers: int = 16,
+                 **capture_kwargs):
+        """
+        :param targets: {fabric.Connection: [str]} - interfaces (names, patterns or planes) per machine
+        :param dest_folder: str
+        :param max_workers: int
+        :param capture_kwargs: snaplen, rotate_bytes, rotate_seconds - see Capture
+        """
+        self.targets = targets
+        self.dest_folder = dest_folder
+        self.max_workers = max_workers
+        self.capture_kwargs = capture_kwargs
+        self.captures = []
+        self._lock = threading.Lock()
+
+    def start(self) -> ({str: [str]}, {str: Exception}):
+        """
+        Starts captures on all machines in parallel. Returns started capture names and errors keyed by host
+        :return: ({str: [str]}, {str: Exception})
+        """
+        def _start(target_con: fabric.Connection) -> [str]:
+            started = []
+            for name, interface, capture_filter in resolve_interfaces(target_con, self.targets[target_con]):
+                capture = Capture(target_con, name, interface, self.dest_folder, capture_filter=capture_filter,
+                                  **self.capture_kwargs)
+                capture.start()
+                with self._lock:
+                    self.captures.append(capture)
+                started.append(name)
+            return started
+
+        return vm.run_parallel(list(self.targets), _start, max_workers=self.max_workers)
+
+    def stop(self) -> [dict]:
+        """
+        Stops all captures in parallel, writes index.json to dest_folder and returns the index
+        :return: [dict]
+        """
+        def _stop(target_con: fabric.Connection) -> [dict]:
+            return [entry for capture in self.captures if capture.target_con is target_con for entry in capture.stop()]
+
+        vm.run_parallel(list(self.targets), _stop, max_workers=self.max_workers)
+        index = [entry for capture in self.captures for entry in capture.files]
+        os.makedirs(self.dest_folder, exist_ok=True)
+        with open(os.path.join(self.dest_folder, "index.json"), "w") as file:
+            json.dump(index, file, indent=1)
+        logging.info(f"Captures stopped: {len(index)} files, {sum(entry['bytes'] for entry in index)} pcap bytes, "
+                     f"{sum(capture.wire_bytes for capture in self.captures)} bytes transferred")
+        return index
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def read_index(dest_folder: str, *, host: str = None, interface: str = None, start: float = None,
+               end: float = None) -> [dict]:
+    """
+    Returns index entries of the capture files in dest_folder that match the host, interface and overlap the
+    Time range (unix time). Unset filters match everything
+    :param dest_folder: str
+    :param host: str
+    :param interface: str
+    :param start: float
+    :param end: float
+    :return: [dict]
+    """
+    with open(os.path.join(dest_folder, "index.json"), "r") as file:
+        index = json.load(file)
+    return [entry for entry in index
+            if (host is None or entry["host"] == host) and (interface is None or entry["interface"] == interface)
+            and (start is None or entry["last"] >= start) and (end is None or entry["first"] <= end)]
@@ -0,0 +1,341 @@
+import fabric
+import test_VM_commands as vm
+import yaml_processing as config
+import config_generator as generator
+import subscriber_provisioning as subscribers
+import launch_engine as launcher
+import metrics
+import logging
+import os
+import re
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Step:
+    """
+    One node of the scenario graph. Func is called without arguments once all steps in deps are done
+    Steps of the same role are never run at the same time, as they share the connection to the machine
+    Steps without a role (e.g. local config generation) are not limited
+    """
+
+    def __init__(self, name: str, func, *, deps: [str] = (), role: str = None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.role = role
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start if self.end is not None else 0.0
+
+
+class Scheduler:
+    """
+    Runs steps of a dependency graph (DAG) on a pool of worker threads. A step starts as soon as its dependencies
+    Are done, so independent steps on different hosts overlap and the wall time is set by the longest chain
+    Of dependent steps (the critical path), not by the sum of all steps
+    """
+
+    def __init__(self, *, max_workers: int = 16):
+        self.steps = {}
+        self.max_workers = max_workers
+
+    def add(self, name: str, func, *, deps: [str] = (), role: str = None) -> Step:
+        """
+        Adds a step to the graph. Dependencies may be added after the step, they are checked by run
+        :param name: str
+        :param func: callable
+        :param deps: [str]
+        :param role: str
+        :return: Step
+        """
+        if name in self.steps:
+            raise ValueError(f"Step {name} is defined twice")
+        self.steps[name] = Step(name, func, deps=deps, role=role)
+        return self.steps[name]
+
+    def order(self) -> [str]:
+        """
+        Returns step names in a dependency respecting order
+        :return: [str]
+        :raises ValueError: if a dependency is missing or the steps have a cycle
+        """
+        for step in self.steps.values():
+            missing = [dep for dep in step.deps if dep not in self.steps]
+            if len(missing) != 0:
+                raise ValueError(f"Step {step.name} depends on undefined steps {missing}")
+        waiting = {name: len(step.deps) for name, step in self.steps.items()}
+        dependents = {name: [] for name in self.steps}
+        for step in self.steps.values():
+            for dep in step.deps:
+                dependents[dep].append(step.name)
+        ordered = [name for name, count in waiting.items() if count == 0]
+        for name in ordered:  # ordered grows while it is iterated
+            for dependent in dependents[name]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ordered.append(dependent)
+        if len(ordered) != len(self.steps):
+            raise ValueError(f"Steps have a dependency cycle: {sorted(set(self.steps) - set(ordered))}")
+        return ordered
+
+    def run(self) -> ({str: object}, {str: Exception}):
+        """
+        Runs all steps. A failed step does not stop independent steps, but its dependents are skipped
+        Returns results and errors keyed by step name. Skipped steps are not in either of them
+        :return: ({str: object}, {str: Exception})
+        """
+        pending = self.order()
+        results, errors = {}, {}
+        running = {}  # future:step
+        busy_roles, skipped = set(), set()
+        t0 = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    step = self.steps[name]
+                    if any(dep in errors or dep in skipped for dep in step.deps):
+                        logging.error(f"Step {name} skipped, as its dependency failed")
+                        skipped.add(name)
+                        pending.remove(name)
+                    elif all(dep in results for dep in step.deps) and step.role not in busy_roles:
+                        if step.role is not None:
+                            busy_roles.add(step.role)
+                        pending.remove(name)
+                        running[executor.submit(self._run_step, step, t0)] = step
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    busy_roles.discard(step.role)
+                    try:
+                        results[step.name] = future.result()
+                    except Exception as e:  # Failure is reported per step, see run_parallel
+                        logging.error(f"Step {step.name} failed: {e!r}")
+                        errors[step.name] = e
+        return results, errors
+
+    @staticmethod
+    def _run_step(step: Step, t0: float) -> object:
+        step.start = time.perf_counter() - t0
+        try:
+            logging.info(f"Step {step.name} started at {step.start:.2f}s")
+            return step.func()
+        finally:
+            step.end = time.perf_counter() - t0
+            logging.info(f"Step {step.name} finished in {step.duration:.2f}s")
+
+    def critical_path(self) -> [Step]:
+        """
+        Returns the chain of steps that set the wall time of the last run. It is followed backwards from the step
+        That finished last, through the dependency that finished last (the one the step waited for)
+        :return: [Step]
+        """
+        finished = [step for step in self.steps.values() if step.end is not None]
+        if len(finished) == 0:
+            return []
+        path = [max(finished, key=lambda step: step.end)]
+        while True:
+            deps = [self.steps[dep] for dep in path[-1].deps if self.steps[dep].end is not None]
+            if len(deps) == 0:
+                break
+            path.append(max(deps, key=lambda step: step.end))
+        return path[::-1]
+
+    def report(self) -> str:
+        """
+        Returns a readable summary of the last run: wall time, sum of step times and the critical path
+        :return: str
+        """
+        finished = [step for step in self.steps.values() if step.end is not None]
+        wall = max((step.end for step in finished), default=0.0)
+        lines = [f"Wall time {wall:.2f}s, sum of step times {sum(step.duration for step in finished):.2f}s",
+                 "Critical path:"]
+        for step in self.critical_path():
+            lines.append(f"  {step.name:<32} {step.start:8.2f}s -> {step.end:8.2f}s ({step.duration:.2f}s)")
+        return "\n".join(lines)
+
+
+def launch_daemons(role_spec: dict, files: {str: str}) -> {str: [str]}:
+    """
+    Returns the daemon:[config paths] dict (see launch_engine.read_launch_config) of the role
+    Launch lists the daemons or elements to start. Pushed configs of UERANSIM elements are passed with -c,
+    Open5Gs configs are pushed to the default location
+    :param role_spec: dict
+    :param files: {str: str} - as returned by config_generator.render_configs
+    :return: {str: [str]}
+    """
+    daemons = {}
+    names = sorted((os.path.basename(path) for path in files), key=lambda name: (len(name), name))
+    for element in role_spec.get('launch', ()):
+        paths = [f"config/{name}" for name in names if re.fullmatch(re.escape(element) + r"[0-9]*\.yaml", name)]
+        daemons[element] = paths if role_spec['sim'] == "ueransim" and len(paths) != 0 else [None]
+    return daemons
+
+
+STAGES = ("install", "defaults", "push", "provision", "launch")  # Optional steps of a role, see build_scenario
+
+
+def build_scenario(scenario: dict, *, pool: vm.ConnectionPool, stages: [str] = STAGES) -> Scheduler:
+    """
+    Builds the step graph of a scenario description. A scenario is a dict (or a yaml file, see load_scenario):
+        name: semi_adv
+        local_copies: false              # Configs are also written to ./transfers/<name>/<role>/ if set
+        artifacts: false                 # Installs use prebuilt artifacts, built once per simulator if not cached
+        artifact_keys: {ueransim: 1a2b3c4d5e6f}   # Optional version/commit of the cached artifacts to use
+        username: open5gs
+        key_path: /path/to/key           # Default for all roles
+        roles:
+          cplane:
+            ip: 192.168.111.111
+            sim: open5gs
+            install: false               # Run install_sim before anything else on the machine
+            configs:
+              amf: {diff: {'amf-ngap0-addr': "{cplane}"}}     # {role} is replaced with ip address of the role
+            launch: [nrf, scp, amf]      # Daemons (or gnb, ue) started by launch_engine
+            launch_after: [upf1]         # Roles that have to be launched first
+            subscribers_from: [ue]       # Roles whose generated UEs are provisioned in this machine's database
+            capture: [n2, n4]            # Interfaces (names, patterns or planes) captured by cli.py capture
+          ue:
+            ...
+            configs:
+              ue: {supi: imsi-001010000000000, count: 5, diff: {...}, assignments: [[1, 3, {...}]]}
+    Per role the steps are connect, install, push and launch, plus one local configure step
+    Default configs are fetched once per simulator (defaults:<sim>), from the first role that needs them
+    With artifacts set, the install artifact is prepared once per simulator (artifact:<sim>), on the first role
+    That installs it, see vm.prepare_artifacts
+    Stages limits the steps to a part of the case (e.g. only push). Connect, defaults and configure steps are
+    Added whenever the selected stages need them
+    :param scenario: dict
+    :param pool: vm.ConnectionPool
+    :param stages: [str] - subset of STAGES
+    :return: Scheduler
+    """
+    name = scenario.get('name', "scenario")
+    username = scenario.get('username', "open5gs")
+    roles = scenario['roles']
+    ips = {role: spec['ip'] for role, spec in roles.items()}
+    connections, rendered = {}, {}
+    scheduler = Scheduler(max_workers=scenario.get('max_workers', 16))
+
+    def do_connect(role: str) -> fabric.Connection:
+        key_path = roles[role].get('key_path', scenario.get('key_path'))
+        connections[role] = pool.get(ips[role], username=username, key_path=key_path)
+        return connections[role]
+
+    def do_artifact(role: str, sim: str) -> str:
+        prepared = vm.prepare_artifacts({connections[role]: sim}, keys=scenario.get('artifact_keys'))
+        if sim not in prepared:
+            raise FileNotFoundError(f"Install artifact of {sim} could not be built on {ips[role]}")
+        artifacts[sim] = prepared[sim]
+        return artifacts[sim]
+
+    def do_install(role: str) -> None:
+        vm.install_sim(connections[role], roles[role]['sim'], artifact=artifacts.get(roles[role]['sim']))
+
+    def do_defaults(role: str, sim: str) -> str:
+        folder = vm.get_default_configs_cached(connections[role], sim)
+        if len(folder) == 0:
+            raise FileNotFoundError(f"Default {sim} configs could not be fetched from {ips[role]}")
+        return folder
+
+    def do_configure(role: str) -> {str: str}:
+        rendered[role] = generator.render_configs(name, role, roles[role], ips, username,
+                                        local_copies=scenario.get('local_copies', False))
+        return rendered[role]
+
+    def do_push(role: str) -> [str]:
+        return vm.put_data_bulk(connections[role], rendered[role], overwrite=True, sudo=True, skip_unchanged=True)
+
+    def do_provision(role: str, ue_roles: [str]) -> {str: float}:
+        documents = (document for ue_role in ue_roles
+                     for element, spec in roles[ue_role]['configs'].items() if 'count' in spec
+                     for document in subscribers.subscribers_from_ues(
+                         config.read_yaml_cached(spec.get('template') or
+                                                 generator.TEMPLATES['ueransim'].format(element=element)),
+                         generator.spec_ue_diffs(spec, ips)))
+        return subscribers.provision_subscribers(connections[role], documents)
+
+    def do_launch(role: str) -> {str: float}:
+        daemons = launch_daemons(roles[role], rendered.get(role, {}))
+        if roles[role]['sim'] == "ueransim":
+            return launcher.launch_ueransim(connections[role], daemons)
+        return launcher.launch_open5gs(connections[role], daemons, wait_pfcp=roles[role].get('wait_pfcp', False))
+
+    artifacts = {}  # sim:local artifact path
+    rendering = not {"push", "provision", "launch"}.isdisjoint(stages)  # Stages that need rendered configs
+    defaults, ready = {}, {}  # sim:step name, role:last step that prepares the machine
+    for role, spec in roles.items():
+        ready[role] = f"connect:{role}"
+        scheduler.add(ready[role], functools.partial(do_connect, role), role=role)
+        if spec.get('install', False) and "install" in stages:
+            install_deps = [ready[role]]
+            if scenario.get('artifacts', False):
+                if f"artifact:{spec['sim']}" not in scheduler.steps:
+                    scheduler.add(f"artifact:{spec['sim']}", functools.partial(do_artifact, role, spec['sim']),
+                                  deps=[ready[role]], role=role)
+                install_deps.append(f"artifact:{spec['sim']}")
+            scheduler.add(f"install:{role}", functools.partial(do_install, role), deps=install_deps, role=role)
+            ready[role] = f"install:{role}"
+        if len(spec.get('configs', {})) != 0 and spec['sim'] not in defaults and ("defaults" in stages or rendering):
+            defaults[spec['sim']] = f"defaults:{spec['sim']}"
+            scheduler.add(defaults[spec['sim']], functools.partial(do_defaults, role, spec['sim']),
+                          deps=[ready[role]], role=role)
+
+    for role, spec in roles.items():
+        launch_deps = [ready[role]]
+        if len(spec.get('configs', {})) != 0 and rendering:
+            scheduler.add(f"configure:{role}", functools.partial(do_configure, role),
+                          deps=[defaults[spec['sim']]])
+            launch_deps.append(f"configure:{role}")
+            if "push" in stages:
+                scheduler.add(f"push:{role}", functools.partial(do_push, role),
+                              deps=[f"configure:{role}", ready[role]], role=role)
+                launch_deps = [f"push:{role}"]
+        if len(spec.get('subscribers_from', ())) != 0 and "provision" in stages:
+            scheduler.add(f"provision:{role}", functools.partial(do_provision, role, spec['subscribers_from']),
+                          deps=[ready[role]] + [f"configure:{ue_role}" for ue_role in spec['subscribers_from']],
+                          role=role)
+        if len(spec.get('launch', ())) != 0 and "launch" in stages:
+            launch_deps += [f"launch:{other}" for other in spec.get('launch_after', ())]
+            if "provision" in stages:
+                launch_deps += [f"provision:{other}" for other, other_spec in roles.items()
+                                if role in other_spec.get('subscribers_from', ())]
+            scheduler.add(f"launch:{role}", functools.partial(do_launch, role), deps=launch_deps, role=role)
+    return scheduler
+
+
+def load_scenario(file_path: str) -> dict:
+    """
+    Reads a scenario description from a yaml file. See build_scenario for the format
+    :param file_path: str
+    :return: dict
+    """
+    return config.read_yaml(file_path)
+
+
+def run_scenario(scenario: dict | str, *, stages: [str] = STAGES) -> ({str: object}, {str: Exception}):
+    """
+    Runs the scenario (dict or path to a yaml file) and logs the critical path of the run
+    Returns results and errors keyed by step name, see Scheduler.run. Stages are passed to build_scenario
+    :param scenario: dict | str
+    :param stages: [str]
+    :return: ({str: object}, {str: Exception})
+    """
+    if isinstance(scenario, str):
+        scenario = load_scenario(scenario)
+    pool = vm.ConnectionPool()
+    scheduler = build_scenario(scenario, pool=pool, stages=stages)
+    try:
+        results, errors = scheduler.run()
+    finally:
+        pool.close_all()
+    logging.info(f"Scenario {scenario.get('name', 'scenario')} finished\n{scheduler.report()}\n"
+                 f"Time per host:\n{metrics.REGISTRY.summary()}")
+    return results, errors
@@ -0,0 +1,69 @@
+#!/usr/bin/env bash
+# Builds the install artifact of a simulator once, so other machines can install it without compiling anything
+# And without network access (see install_sim in test_VM_commands.py)
+# Usage: build_artifact.sh <open5gs|ueransim> <output tar> [UERANSIM git ref]
+# Artifact contains the .deb packages (with the dependencies missing on this machine) and for UERANSIM the built
+# Binaries and configs. Machine should be a clean clone of the image the other machines use
+# Last line of the output is "KEY <key>" - version of Open5Gs or commit of UERANSIM the artifact is for
+err_handler () {  # Executes if ERR signal is caught
+  echo -n "ERR: Invalid exit code $? for command: "
+  sed "$1!d" "$0"  # equivalent to awk "NR=$1" "$0"
+  exit 4
+}
+
+trap 'err_handler $LINENO 1>&2' ERR  # Listen for invalid exit codes
+
+if [[ $EUID -ne 0 ]]; then
+  echo "Root privileges needed" 1>&2
+  exit 1
+fi
+
+SIM="$1"
+OUT="$2"
+REF="$3"
+WORK=$(mktemp -d /tmp/vm_automation_build_XXXXXX)
+trap 'rm -rf "$WORK"' EXIT
+mkdir -p "$WORK/debs/partial"
+
+download () {  # Downloads the packages (and their dependencies missing on this machine) to the artifact
+  apt-get install --download-only --reinstall -y -o Dir::Cache::archives="$WORK/debs" "$@"
+}
+
+apt-get install dialog apt-utils -y  # Required to not encounter "tty required" error
+case "$SIM" in
+  open5gs)
+    apt-get update
+    apt-get install software-properties-common gnupg -y
+    add-apt-repository ppa:open5gs/latest -y
+    wget -qO - https://www.mongodb.org/static/pgp/server-4.4.asc | apt-key add -
+    echo "deb [ arch=amd64] https://repo.mongodb.org/apt/ubuntu focal/mongodb-org/4.4 multiverse" > /etc/apt/sources.list.d/mongodb-org-4.4.list
+    apt-get update
+    download mongodb-org open5gs python3-yaml
+    wget https://raw.githubusercontent.com/open5gs/open5gs/main/misc/db/open5gs-dbctl -O "$WORK/open5gs-dbctl"
+    KEY=$(apt-cache policy open5gs | awk '/Candidate:/ {print $2}')
+    CONTENT=(debs open5gs-dbctl)
+    ;;
+  ueransim)
+    apt-get update
+    download libsctp-dev lksctp-tools iproute2  # Runtime dependencies. Compilers are needed only here
+    apt-get install build-essential libsctp-dev lksctp-tools iproute2 g++ gcc -y
+    snap install cmake --classic
+    git clone https://github.com/aligungr/UERANSIM "$WORK/UERANSIM"
+    cd "$WORK/UERANSIM" || exit
+    if [[ -n "$REF" ]]; then
+      git checkout "$REF"
+    fi
+    make  # Note: takes some time. Done once for all the machines
+    KEY=$(git rev-parse --short=12 HEAD)
+    CONTENT=(debs UERANSIM/build UERANSIM/config)
+    ;;
+  *)
+    echo "Unknown simulator $SIM. Expected open5gs or ueransim" 1>&2
+    exit 3
+    ;;
+esac
+
+rm -rf "$WORK/debs/partial" "$WORK/debs/lock"
+tar -cf "$OUT" -C "$WORK" "${CONTENT[@]}"
+chmod 644 "$OUT"
+echo "KEY ${KEY//:/_}"  # Key is used as a file name, epoch separator is replaced
@@ -13,29 +13,46 @@ if [[ $EUID -ne 0 ]]; then
   exit 1
 fi
 
+ARTIFACT="$1"  # Optional artifact made by build_artifact.sh. If set, nothing is downloaded
+
 if [[ -f "/bin/open5gs-amfd" ]]; then
   echo "Open5gs is most likely installed. One of the binaries are present in /bin. Installation cancelled" 1>&2
   exit 2
 fi
 
-# Fetching dependency for open5gs and adding repository
-apt-get update
-apt-get install dialog apt-utils -y  # Required to not encounter "tty required" error
-apt-get install software-properties-common -y
-add-apt-repository ppa:open5gs/latest -y
+if [[ -n "$ARTIFACT" ]]; then
+  # Packages of mongo db and open5gs (with the dependencies) are installed from the artifact at once
+  WORK=$(mktemp -d /tmp/vm_automation_install_XXXXXX)
+  tar -xf "$ARTIFACT" -C "$WORK"
+  rm -f "$ARTIFACT"
+  apt-get install -y "$WORK"/debs/*.deb
+else
+  # Fetching dependency for open5gs and adding repository
+  apt-get update
+  apt-get install dialog apt-utils -y  # Required to not encounter "tty required" error
+  apt-get install software-properties-common -y
+  add-apt-repository ppa:open5gs/latest -y
+
+  # Installing mongo db
+  # Version 4 is used because for Version 6 mongo command is not available
+  # Version 5 requires some CPU flags that might not be available on older CPUs
+  apt-get install gnupg -y
+  wget -qO - https://www.mongodb.org/static/pgp/server-4.4.asc | sudo apt-key add -
+  echo "deb [ arch=amd64] https://repo.mongodb.org/apt/ubuntu focal/mongodb-org/4.4 multiverse" | sudo tee /etc/apt/sources.list.d/mongodb-org-4.4.list
+  apt-get update
+  apt-get install -y mongodb-org
+fi
 
-# Installing mongo db
-# Version 4 is used because for Version 6 mongo command is not available
-# Version 5 requires some CPU flags that might not be available on older CPUs
-apt-get install gnupg -y
-wget -qO - https://www.mongodb.org/static/pgp/server-4.4.asc | sudo apt-key add -
-echo "deb [ arch=amd64] https://repo.mongodb.org/apt/ubuntu focal/mongodb-org/4.4 multiverse" | sudo tee /etc/apt/sources.list.d/mongodb-org-4.4.list
-apt-get update
-apt-get install -y mongodb-org
+wait_mongod () {  # Polls for the mongo daemon for up to $1 seconds instead of sleeping a fixed time
+  for _ in $(seq $(($1 * 10))); do
+    pgrep -x "mongod" > /dev/null && return 0
+    sleep 0.1
+  done
+  return 1
+}
 
-sleep 2  # Just in case mongo takes some time to launch
 # Checking if mongodb works.
-if pgrep -x "mongod" > /dev/null; then
+if wait_mongod 2; then
   echo "Mongo daemon is running OK!"
 else
   echo "Mongo daemon is not working. Attempting to fix it..."
@@ -45,8 +62,7 @@ else
   #sleep 2
   #pkill mongod
   systemctl restart mongod
-  sleep 3
-  if pgrep -x "mongod" > /dev/null; then
+  if wait_mongod 3; then
     echo "Fix successful! Mongo daemon is running"
   else
     echo "Failed to fix mongo daemon. Aborting installation!"
@@ -54,12 +70,16 @@ else
   fi
 fi
 
-# Finalise open5gs installation
-apt-get install open5gs -y
-
-# Fetch cli interface for open5gs subscriber database
-wget https://raw.githubusercontent.com/open5gs/open5gs/main/misc/db/open5gs-dbctl -O /usr/bin/open5gs-dbctl
-chmod +x /usr/bin/open5gs-dbctl
+# Finalise open5gs installation and fetch cli interface for open5gs subscriber database
+if [[ -n "$ARTIFACT" ]]; then
+  install -m 755 "$WORK/open5gs-dbctl" /usr/bin/open5gs-dbctl
+  rm -rf "$WORK"
+else
+  apt-get install open5gs -y
+  apt-get install python3-yaml -y  # Used by the config patch helper (test_VM_commands.patch_yaml)
+  wget https://raw.githubusercontent.com/open5gs/open5gs/main/misc/db/open5gs-dbctl -O /usr/bin/open5gs-dbctl
+  chmod +x /usr/bin/open5gs-dbctl
+fi
 
 # Prevent open5gs daemons autostart. We need manual starts to provide alternate configs
 # e.g. ./bin/open5gs-amfd -c /etc/open5gs/amf2.yaml &
@@ -12,6 +12,7 @@ if [[ $EUID -ne 0 ]]; then
   exit 1
 fi
 
+ARTIFACT="$1"  # Optional artifact made by build_artifact.sh. If set, nothing is downloaded or compiled
 SRC_USERNAME=$(id -nu "$SUDO_UID")
 SRC_PATH=$(eval echo "~$SRC_USERNAME")
 if [[ -d "$HOME/UERANSIM" ]] || [[ -d "${SRC_PATH}/UERANSIM" ]]; then
@@ -19,19 +20,33 @@ if [[ -d "$HOME/UERANSIM" ]] || [[ -d "${SRC_PATH}/UERANSIM" ]]; then
   exit 2
 fi
 
-# Fetch dependencies
-apt-get install dialog apt-utils -y  # Required to not encounter "tty required" error
-apt-get update
-apt-get install build-essential libsctp-dev lksctp-tools iproute2 g++ gcc -y
-snap install cmake --classic
+if [[ -n "$ARTIFACT" ]]; then
+  WORK=$(mktemp -d /tmp/vm_automation_install_XXXXXX)
+  tar -xf "$ARTIFACT" -C "$WORK"
+  rm -f "$ARTIFACT"
+  shopt -s nullglob
+  debs=("$WORK"/debs/*.deb)
+  if [[ ${#debs[@]} -ne 0 ]]; then
+    apt-get install -y "${debs[@]}"
+  fi
+  mv "$WORK/UERANSIM" "$SRC_PATH/UERANSIM"
+  chown -R "$SRC_USERNAME:$SRC_USERNAME" "$SRC_PATH/UERANSIM"
+  rm -rf "$WORK"
+else
+  # Fetch dependencies
+  apt-get install dialog apt-utils -y  # Required to not encounter "tty required" error
+  apt-get update
+  apt-get install build-essential libsctp-dev lksctp-tools iproute2 g++ gcc -y
+  snap install cmake --classic
 
-# Fetch UERANSIM files
-cd "$SRC_PATH" || exit
-git clone https://github.com/aligungr/UERANSIM
-chown "$SRC_USERNAME:$SRC_USERNAME" ./UERANSIM/  # Git clone was made as root, so we need to change ownership
-# Build UERANSIM. Note: takes some time. Recommended to make some coffee or tea in the meantime
-cd "$SRC_PATH/UERANSIM" || exit
-make
+  # Fetch UERANSIM files
+  cd "$SRC_PATH" || exit
+  git clone https://github.com/aligungr/UERANSIM
+  chown "$SRC_USERNAME:$SRC_USERNAME" ./UERANSIM/  # Git clone was made as root, so we need to change ownership
+  # Build UERANSIM. Note: takes some time. Recommended to make some coffee or tea in the meantime
+  cd "$SRC_PATH/UERANSIM" || exit
+  make
+fi
 
 # Change hostname and hosts file
 echo "UERANSIM" > /etc/hostname
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Remote side of test_VM_commands.patch_yaml. Applies compiled diffs to yaml files in place, so a config change
+# Does not need the whole file to be downloaded, modified and uploaded again
+# Request is a json document on stdin:
+#   {"backup": true, "files": {"/etc/open5gs/upf.yaml": [["upf-gtpu0-addr", [["upf", null, "upf"], ...], value]]}}
+# Steps are the ones of yaml_processing.DiffPath and are applied by the same rules (keep the two in sync)
+# One json line is printed per file: {"path": str, "changed": bool, "missed": [str]} or {"path": str, "error": str}
+# Files are replaced atomically (temporary file in the same folder + rename), the previous version is kept as .bak
+# Only the standard library and PyYAML (python3-yaml, part of the Ubuntu server image) are needed
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import yaml
+
+
+def apply(root, steps, new_value):
+    node = root
+    last = len(steps) - 1
+    unindexed = False  # Same rules as yaml_processing.DiffPath.apply
+    for i, (name, index, literal) in enumerate(steps):
+        owner, key = node, literal
+        if index is not None and literal not in node and isinstance(node.get(name), list):
+            owner, key = node[name], index
+            if index >= len(owner):  # To avoid access of bad index, new element is appended
+                owner.append(new_value if i == last else dict())
+                key = len(owner) - 1
+                if i == last:
+                    return
+        if i == last:
+            if unindexed and isinstance(owner, dict) and key not in owner:
+                raise KeyError(key)
+            owner[key] = new_value
+            return
+        node = owner[key]
+        if isinstance(node, list):  # List without index is entered at the first element
+            node = node[0]
+            unindexed = True
+
+
+def replace(path, text, backup):
+    stat = os.stat(path)
+    if backup:
+        shutil.copy2(path, path + ".bak")
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temp_path, stat.st_mode & 0o7777)
+        if os.geteuid() == 0:
+            os.chown(temp_path, stat.st_uid, stat.st_gid)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def patch(path, diff, backup):
+    with open(path) as file:
+        data = yaml.safe_load(file) or {}
+    original = json.dumps(data, sort_keys=True, default=str)
+    missed = []
+    for key, steps, new_value in diff:
+        try:
+            apply(data, steps, new_value)
+        except (KeyError, IndexError, TypeError, AttributeError):
+            missed.append(key)
+    changed = json.dumps(data, sort_keys=True, default=str) != original
+    if changed:  # Unchanged files are not rewritten, so their mtime and backup stay as they were
+        replace(path, yaml.safe_dump(data, default_flow_style=False, sort_keys=False), backup)
+    return {"path": path, "changed": changed, "missed": missed}
+
+
+def main():
+    request = json.load(sys.stdin)
+    failed = False
+    for path, diff in request["files"].items():
+        try:
+            outcome = patch(path, diff, request.get("backup", True))
+        except (OSError, yaml.YAMLError) as e:
+            outcome = {"path": path, "error": f"{type(e).__name__}: {e}"}
+            failed = True
+        print(json.dumps(outcome), flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,7 @@
 
 # This script is not idiot proof. It's assumed the inputs are correct since they are mostly generated from Python
 # "Make something idiot proof, they'll make a better idiot" ~Unknown
+# NOTE: launch_engine.launch_open5gs does the same from Python, with readiness checks between the daemons
 # TODO - Globally replace echos with real commands (echo is used for testing only)
 if [[ $EUID -ne 0 ]]; then
   echo "Root privileges needed" 1>&2
@@ -68,7 +69,8 @@ else
       fi
     done
   done
-  sleep 5  # Give some time for daemons and interfaces to start
+  # Daemons are started without waiting for them. launch_engine.launch_open5gs starts them in dependency order
+  # and checks that each one listens on its sockets before the next one is started
 
   # Enable NAT and port forwards for Open5Gs related interfaces:
   echo "sudo sysctl -w net.ipv4.ip_forward=1"
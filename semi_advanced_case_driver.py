@@ -1,102 +1,67 @@
-import fabric
-import test_VM_commands as vm
-import yaml_processing as config
+import scenario_engine as engine
+import metrics
 import logging
 from datetime import datetime
-import copy
 
 
-def update_configs(ip_addr):
-    # Change configs - C-Plane
-    amf_diff = {'amf-ngap0-addr': ip_addr[0], 'amf-guami-plmn_mcc': '001', 'amf-guami-plmn_mnc': '01',
-                'amf-tai-plmn_id-mcc': '001', 'amf-tai-plmn_id-mnc': '01',
-                'amf-plmn_support-plmn_id-mcc': '001', 'amf-plmn_support-plmn_id-mnc': '01'}
-    config.modify_helper('amf', 'semi_adv/Cplane/amf.yaml', amf_diff, overwrite=True)
-
-    smf_diff = {'smf-pfcp0-addr': ip_addr[0], 'smf-gtpu0-addr': ip_addr[0],
-                'smf-subnet0-addr': "10.45.0.1/16", 'smf-subnet0-dnn': "internet",
-                'smf-subnet1-addr': "10.46.0.1/16", 'smf-subnet1-dnn': "internet2",
-                'smf-subnet2-addr': "10.47.0.1/16", 'smf-subnet2-dnn': "ims",
-                'upf-pfcp0-addr': ip_addr[1], 'upf-pfcp0-dnn': ["internet", "internet2"],
-                'upf-pfcp1-addr': ip_addr[2], 'upf-pfcp1-dnn': "ims"}
-    config.modify_helper('smf', 'semi_adv/Cplane/smf.yaml', smf_diff, overwrite=True)
-
-    # Change configs - U-Plane1
-    upf_diff1 = {'upf-pfcp0-addr': ip_addr[1], 'upf-gtpu0-addr': ip_addr[1],
-                 'upf-subnet0-addr': "10.45.0.1/16", 'upf-subnet0-dnn': "internet", 'upf-subnet0-dev': "ogstun",
-                 'upf-subnet1-addr': "10.46.0.1/16", 'upf-subnet1-dnn': "internet2", 'upf-subnet1-dev': "ogstun2"}
-    config.modify_helper('upf', 'semi_adv/Uplane1/upf.yaml', upf_diff1, overwrite=True)
-
-    # Change configs - U-Plane2
-    upf_diff2 = {'upf-pfcp0-addr': ip_addr[2], 'upf-gtpu0-addr': ip_addr[2],
-                 'upf-subnet0-addr': "10.47.0.1/16", 'upf-subnet0-dnn': "ims", 'upf-subnet0-dev': "ogstun3"}
-    config.modify_helper('upf', 'semi_adv/Uplane2/upf.yaml', upf_diff2, overwrite=True)
-
-    # Change configs - gNB
-    gnb_diff = {'mcc': "001", 'mnc': "01", 'linkIp': ip_addr[3], 'ngapIp': ip_addr[3], 'gtpIp': ip_addr[3],
-                'amfConfigs0-address': ip_addr[0]}
-    config.modify_helper('gnb', 'semi_adv/gnb/gnb.yaml', gnb_diff, overwrite=True)
-
-    # Change configs - UE
-    ue_diff0 = {'supi': 'imsi-001010000000000', 'mcc': '001', 'mnc': '01', 'gnbSearchList': ip_addr[3]}  # apn internet
-    ue_diff1 = {'supi': 'imsi-001010000000001', 'mcc': '001', 'mnc': '01', 'gnbSearchList': ip_addr[3],
-                'sessions0-apn': "internet2"}
-    ue_diff2 = copy.deepcopy(ue_diff1)
-    ue_diff2.update({'supi': 'imsi-001010000000002'})
-    ue_diff3 = copy.deepcopy(ue_diff1)
-    ue_diff3.update({'supi': 'imsi-001010000000003', 'sessions0-apn': 'ims'})
-    ue_diff4 = copy.deepcopy(ue_diff1)
-    ue_diff4.update({'supi': 'imsi-001010000000004', 'sessions0-apn': 'ims'})
-    dict_arr = [ue_diff0, ue_diff1, ue_diff2, ue_diff3, ue_diff4]
-    for i in range(5):
-        config.modify_helper('ue', f'semi_adv/ue/ue{i}.yaml', dict_arr[i], overwrite=True)
-
-
-def transfer_configs(c: [fabric.Connection]) -> None:
-    """
-    Transfers configs to the machines in the connection array
-    This function is only for the semi advanced case
-    :param c: [fabric.Connection]
-    :return: None
-    """
-    # VM1: Control Plane 5G c[0]
-    # VM2: User Plane 5G (1) c[1]
-    # VM3: User Plane 5G (2) c[2]
-    # VM4: gNodeB RAN c[3]
-    # VM5: UE RAN (in total 5 UEs on one machine) c[4]
-
-    # Control plane configs
-    vm.put_file(c[0], "./transfers/semi_adv/Cplane/amf.yaml", "/etc/open5gs/amf.yaml", overwrite=True, sudo=True)
-    vm.put_file(c[0], "./transfers/semi_adv/Cplane/smf.yaml", "/etc/open5gs/smf.yaml", overwrite=True, sudo=True)
-
-    # User plane 1 configs
-    vm.put_file(c[1], "./transfers/semi_adv/Uplane1/upf.yaml", "/etc/open5gs/upf.yaml", overwrite=True, sudo=True)
-
-    # User plane 2 configs
-    vm.put_file(c[2], "./transfers/semi_adv/Uplane2/upf.yaml", "/etc/open5gs/upf.yaml", overwrite=True, sudo=True)
-
-    # gNodeB configs
-    vm.put_file(c[3], "./transfers/semi_adv/gnb/gnb.yaml", f"/home/{c[3].user}/UERANSIM/config/gnb.yaml",
-                overwrite=True, sudo=True)
-
-    # UE configs
-    for i in range(5):
-        vm.put_file(c[4], f"./transfers/semi_adv/ue/ue{i}.yaml", f"/home/{c[4].user}/UERANSIM/config/ue{i}.yaml",
-                    overwrite=True, sudo=True)
-
-
-def put_launch_configs(c: [fabric.Connection]) -> None:
+def scenario(ip_addr: [str], key_path: str) -> dict:
     """
-    Prepares and transfers configs related to launch scripts
-    :param c: [fabric.Connection]
-    :return: None
+    Describes the semi advanced case for scenario_engine. The steps (push, provisioning, launch) are scheduled by
+    their dependencies and run on all machines at once
+    :param ip_addr: [str]
+    :param key_path: str
+    :return: dict
     """
-    created_file = vm.write_launch_config({"smf": "", "amf": "/some/path/to/config"})
-    print(created_file)
+    return {
+        "name": "semi_adv", "username": "open5gs", "key_path": key_path,
+        "roles": {
+            "cplane": {
+                "ip": ip_addr[0], "sim": "open5gs",
+                "configs": {
+                    "amf": {"diff": {'amf-ngap0-addr': "{cplane}", 'amf-guami0-plmn_id-mcc': '001',
+                                     'amf-guami0-plmn_id-mnc': '01', 'amf-tai-plmn_id-mcc': '001',
+                                     'amf-tai-plmn_id-mnc': '01', 'amf-plmn_support-plmn_id-mcc': '001',
+                                     'amf-plmn_support-plmn_id-mnc': '01'}},
+                    "smf": {"diff": {'smf-pfcp0-addr': "{cplane}", 'smf-gtpu0-addr': "{cplane}",
+                                     'smf-subnet0-addr': "10.45.0.1/16", 'smf-subnet0-dnn': "internet",
+                                     'smf-subnet1-addr': "10.46.0.1/16", 'smf-subnet1-dnn': "internet2",
+                                     'smf-subnet2-addr': "10.47.0.1/16", 'smf-subnet2-dnn': "ims",
+                                     'upf-pfcp0-addr': "{upf1}", 'upf-pfcp0-dnn': ["internet", "internet2"],
+                                     'upf-pfcp1-addr': "{upf2}", 'upf-pfcp1-dnn': "ims"}}},
+                "launch": ["nrf", "scp", "udr", "udm", "ausf", "pcf", "bsf", "nssf", "amf", "smf"],
+                "launch_after": ["upf1", "upf2"], "wait_pfcp": True,
+                "subscribers_from": ["ue"]},
+            "upf1": {
+                "ip": ip_addr[1], "sim": "open5gs",
+                "configs": {"upf": {"diff": {'upf-pfcp0-addr': "{upf1}", 'upf-gtpu0-addr': "{upf1}",
+                                             'upf-subnet0-addr': "10.45.0.1/16", 'upf-subnet0-dnn': "internet",
+                                             'upf-subnet0-dev': "ogstun", 'upf-subnet1-addr': "10.46.0.1/16",
+                                             'upf-subnet1-dnn': "internet2", 'upf-subnet1-dev': "ogstun2"}}},
+                "launch": ["upf"]},
+            "upf2": {
+                "ip": ip_addr[2], "sim": "open5gs",
+                "configs": {"upf": {"diff": {'upf-pfcp0-addr': "{upf2}", 'upf-gtpu0-addr': "{upf2}",
+                                             'upf-subnet0-addr': "10.47.0.1/16", 'upf-subnet0-dnn': "ims",
+                                             'upf-subnet0-dev': "ogstun3"}}},
+                "launch": ["upf"]},
+            "gnb": {
+                "ip": ip_addr[3], "sim": "ueransim",
+                "configs": {"gnb": {"diff": {'mcc': "001", 'mnc': "01", 'linkIp': "{gnb}", 'ngapIp': "{gnb}",
+                                             'gtpIp': "{gnb}", 'amfConfigs0-address': "{cplane}"}}},
+                "launch": ["gnb"], "launch_after": ["cplane"]},
+            "ue": {
+                "ip": ip_addr[4], "sim": "ueransim",
+                "configs": {"ue": {"supi": 'imsi-001010000000000', "count": 5,
+                                   "diff": {'mcc': '001', 'mnc': '01', 'gnbSearchList0': "{gnb}"},
+                                   "assignments": [(1, 3, {'sessions0-apn': "internet2"}),
+                                                   (3, 5, {'sessions0-apn': "ims"})]}},
+                "launch": ["ue"], "launch_after": ["gnb"]},
+        }
+    }
 
 
 def main():
-    # TODO - Finish this driver function. NOT TESTED!!
+    # The scenario can be checked without machines: run main() inside fake_connection.FakeNetwork
     # driver function for the case: https://github.com/s5uishida/open5gs_5gc_ueransim_sample_config
     logging.basicConfig(filename="semiadv_driver_script.log", level=logging.INFO)
     logging.info("\n--------------------------------------\n"
@@ -113,24 +78,11 @@ def main():
     ip_addr = ["192.168.111.111", "192.168.111.112", "192.168.111.113",  # Open5gs IPs
                "192.168.111.191", "192.168.111.192"]  # UERANSIM IPs
     key_path = r"C:\Users\batru\Desktop\Keys\private_clean_ubuntu_20_clone"
-    conn_dict = {}
-    for ip in ip_addr:  # Populate the connection dict. Key is same for all
-        conn_dict.update({ip: key_path})
-
-    c = []
-    # try:
-    #     c = vm.init_connections(conn_dict, username="open5gs")
-    # except ConnectionError:
-    #     logging.error("Received timeout error from init_connections. Driver script aborted!")
-    #     exit(1)
-
-    # vm.install_sim(c[0], "open5gs")
-    # vm.install_sim(c[1], "open5gs")
-    # vm.install_sim(c[2], "open5gs")
-    # vm.install_sim(c[3], "ueransim")
-    # vm.install_sim(c[4], "ueransim")
-    update_configs(ip_addr)
-    put_launch_configs(c)
+    # Whole case (push, provisioning and launch on all machines) scheduled by dependencies. Logs the critical path
+    _, errors = engine.run_scenario(scenario(ip_addr, key_path))
+    for step, error in errors.items():
+        logging.error(f"Step {step} of the semi advanced case failed: {error}")
+    logging.info(f"Time per host:\n{metrics.REGISTRY.summary()}")
 
 
 if __name__ == "__main__":
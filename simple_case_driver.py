@@ -1,7 +1,9 @@
 import fabric
 import test_VM_commands as vm
 import yaml_processing as config
+import metrics
 import logging
+import os
 from datetime import datetime
 
 
@@ -18,9 +20,6 @@ def update_configs(c: [fabric.Connection], ip_addr: [str]) -> None:
     # Modify the yaml dict
     new_upf = config.modify_yaml(upf, upf_diff_dict)
     new_amf = config.modify_yaml(amf, amf_diff_dict)
-    # Write out the modified version
-    config.write_yaml("./transfers/basic_test/upf.yaml", new_upf, overwrite=True)
-    config.write_yaml("./transfers/basic_test/amf.yaml", new_amf, overwrite=True)
 
     # Perform config file modification - UERANSIM
     # Read default configs
@@ -29,53 +28,43 @@ def update_configs(c: [fabric.Connection], ip_addr: [str]) -> None:
     # Prepare modification dicts
     gnb_diff_dict = {'mcc': 999, 'mnc': 99, 'ngapIp': ip_addr[1], 'gtpIp': ip_addr[1], 'amfConfigs-address': ip_addr[0]}
     ue_diff_dict = {'supi': 'imsi-999990000000001', 'mcc': 999, 'mnc': 99}
-    # Write out the modified version
     new_gnb = config.modify_yaml(gnb, gnb_diff_dict)
     new_ue = config.modify_yaml(ue, ue_diff_dict)
-    # Write out the modified version
-    config.write_yaml("./transfers/basic_test/open5gs-gnb.yaml", new_gnb, overwrite=True)
-    config.write_yaml("./transfers/basic_test/open5gs-ue.yaml", new_ue, overwrite=True)
 
     # Transfer new configs - Open5gs
-    # Open5gs configs are root only
-    vm.put_file(
+    # Configs are sent straight from memory, nothing is written to ./transfers unless local_copy_dir is passed
+    # Open5gs configs are root only. Configs that did not change since the last run are not transferred
+    changed = vm.put_yaml_bulk(
         c[0],
-        "./transfers/basic_test/upf.yaml",
-        "/etc/open5gs/upf.yaml",
+        {"/etc/open5gs/upf.yaml": new_upf, "/etc/open5gs/amf.yaml": new_amf},
         permissions="644",
         overwrite=True,
-        sudo=True
+        sudo=True,
+        skip_unchanged=True
     )
-    vm.put_file(
-        c[0],
-        "./transfers/basic_test/amf.yaml",
-        "/etc/open5gs/amf.yaml",
-        permissions="644",
-        overwrite=True,
-        sudo=True
-    )
-    # Restart daemons to update the configuration
-    vm.execute(c[0], command="systemctl restart open5gs-upfd", sudo=True)
-    vm.execute(c[0], command="systemctl restart open5gs-amfd", sudo=True)
+    # Restart daemons to update the configuration. Only daemons whose config changed are restarted
+    restarts = [f"systemctl restart open5gs-{os.path.basename(path)[:-len('.yaml')]}d" for path in changed]
+    vm.execute_batch(c[0], commands=restarts, sudo=True)
     # Transfer new configs - UERANSIM
-    vm.put_file(
-        c[1],
-        "./transfers/basic_test/open5gs-gnb.yaml",
-        f"/home/{c[1].user}/UERANSIM/config/open5gs-gnb.yaml",
-        permissions="644",
-        overwrite=True,
-        sudo=False
-    )
-    vm.put_file(
+    vm.put_yaml_bulk(
         c[1],
-        "./transfers/basic_test/open5gs-ue.yaml",
-        f"/home/{c[1].user}/UERANSIM/config/open5gs-ue.yaml",
+        {f"/home/{c[1].user}/UERANSIM/config/open5gs-gnb.yaml": new_gnb,
+         f"/home/{c[1].user}/UERANSIM/config/open5gs-ue.yaml": new_ue},
         permissions="644",
         overwrite=True,
-        sudo=False
+        sudo=False,
+        skip_unchanged=True
     )
 
 
+def patch_configs(c: [fabric.Connection], ip_addr: [str]) -> None:
+    # Alternative to update_configs for changes of already configured machines. Only the diffs are sent
+    # And applied on the machines, the default configs do not have to be present locally
+    changed = vm.patch_yaml(c[0], {"/etc/open5gs/upf.yaml": {'upf-gtpu0-addr': ip_addr[0]}})
+    restarts = [f"systemctl restart open5gs-{os.path.basename(path)[:-len('.yaml')]}d" for path in changed]
+    vm.execute_batch(c[0], commands=restarts, sudo=True)
+
+
 def main():
     logging.basicConfig(filename="driver_script.log", level=logging.INFO)
     logging.info("\n--------------------------------------\n"
@@ -89,16 +78,26 @@ def main():
     # conn_dict = {"192.168.111.101": key_path_all}
     # Initialise connections to the machines
     c = []
+    pool = vm.ConnectionPool()  # Keeps the SSH transports open for the whole driver run
     try:
-        c = vm.init_connections(conn_dict, username="open5gs")
+        c = vm.init_connections(conn_dict, username="open5gs", pool=pool)
     except ConnectionError:
         logging.error("Received timeout error from init_connections. Driver script aborted!")
         exit(1)
     # Run install scripts
-    # vm.install_sim(c[0], "open5gs")
-    # vm.install_sim(c[1], "ueransim")
+    # vm.install_sim_parallel({c[0]: "open5gs", c[1]: "ueransim"})
     # time.sleep(30)
+    # Defaults are fetched only if the installed versions are not in the local cache yet
+    vm.get_default_configs_cached(c[0], "open5gs")
+    vm.get_default_configs_cached(c[1], "ueransim")
     update_configs(c, ip_addr)
+    # patch_configs(c, ip_addr)
+    logging.info(f"Connection pool stats: {pool.stats()}")
+    pool.close_all()
+    # Where the time went, per host and operation. Json export can be compared between runs
+    logging.info(f"Time per host:\n{metrics.REGISTRY.summary()}")
+    with open("driver_metrics.json", "w") as file:
+        file.write(metrics.REGISTRY.to_json())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+import fabric
+import test_VM_commands as vm
+import yaml_processing as config
+import logging
+import gzip
+import json
+import subprocess
+import tempfile
+import time
+from typing import Iterable, Iterator
+
+# Mongo shell script that upserts all subscribers with bulkWrite, CHUNK operations per round trip to the database
+# Integers are converted to NumberInt (sqn to NumberLong), the same types as written by open5gs-dbctl and WebUI
+_PROVISION_JS = """
+var docs = %(docs)s;
+function toBson(v) {
+  if (typeof v === "number" && Number.isInteger(v)) return NumberInt(v);
+  if (Array.isArray(v)) return v.map(toBson);
+  if (v !== null && typeof v === "object") {
+    var out = {};
+    for (var k in v) out[k] = (k === "sqn") ? NumberLong(v[k]) : toBson(v[k]);
+    return out;
+  }
+  return v;
+}
+var inserted = 0, existing = 0;
+for (var i = 0; i < docs.length; i += %(chunk)d) {
+  var ops = docs.slice(i, i + %(chunk)d).map(function (d) {
+    return {updateOne: {filter: {imsi: d.imsi}, update: {"%(operator)s": toBson(d)}, upsert: true}};
+  });
+  var r = db.subscribers.bulkWrite(ops, {ordered: false});
+  inserted += r.upsertedCount;
+  existing += r.matchedCount;
+}
+print(JSON.stringify({inserted: inserted, existing: existing}));
+"""
+
+
+def subscriber_document(ue_config: dict) -> dict:
+    """
+    Creates Open5Gs subscriber document (as in open5gs-dbctl add) from the UERANSIM UE config
+    Imsi, key, op/opc, amf and the sessions (dnn and slice) are taken from the UE config
+    :param ue_config: dict
+    :return: dict
+    """
+    ambr = {'downlink': {'value': 1, 'unit': 3}, 'uplink': {'value': 1, 'unit': 3}}  # 1 Gbps
+    slices = {}
+    for session in ue_config.get('sessions') or [{'apn': 'internet', 'slice': {'sst': 1}}]:
+        s_nssai = session.get('slice') or {'sst': 1}
+        key = (s_nssai['sst'], s_nssai.get('sd'))
+        if key not in slices:
+            slices[key] = {'sst': s_nssai['sst'], 'default_indicator': len(slices) == 0, 'session': []}
+            if s_nssai.get('sd') is not None:
+                slices[key]['sd'] = f"{int(s_nssai['sd']):06x}" if isinstance(s_nssai['sd'], int) else s_nssai['sd']
+        slices[key]['session'].append({
+            'name': session.get('apn', 'internet'), 'type': 3,  # IPv4v6
+            'qos': {'index': 9, 'arp': {'priority_level': 8, 'pre_emption_capability': 1,
+                                        'pre_emption_vulnerability': 1}},
+            'ambr': ambr, 'pcc_rule': []})
+
+    opc = ue_config['op'] if ue_config.get('opType', 'OPC').upper() == 'OPC' else None
+    return {
+        'schema_version': 1,
+        'imsi': str(ue_config['supi']).split("-")[-1],
+        'msisdn': [], 'imeisv': [], 'mme_host': [], 'mm_realm': [], 'purge_flag': [],
+        'slice': list(slices.values()),
+        'security': {'k': ue_config['key'], 'op': None if opc else ue_config['op'], 'opc': opc,
+                     'amf': ue_config.get('amf', '8000'), 'sqn': 513},
+        'ambr': ambr,
+        'access_restriction_data': 32, 'network_access_mode': 0, 'subscriber_status': 0,
+        'operator_determined_barring': 0, 'subscribed_rau_tau_timer': 12, '__v': 0
+    }
+
+
+def subscribers_from_ues(template: dict, diffs: Iterable[dict]) -> Iterator[dict]:
+    """
+    Lazily creates subscriber documents of the UEs described by the template and diffs
+    The same diffs as used for UE config generation (see config_generator.ue_diffs) should be passed
+    :param template: dict
+    :param diffs: Iterable[dict]
+    :return: Iterator[dict]
+    """
+    for diff in diffs:
+        yield subscriber_document(config.overlay_yaml(template, diff))
+
+
+def provisioning_script(documents: Iterable[dict], *, update_existing: bool = False, chunk: int = 1000) -> str:
+    """
+    Returns mongo shell script that inserts all subscriber documents in batches of chunk documents
+    Subscribers that already exist (same imsi) are skipped, or updated if update_existing is set
+    :param documents: Iterable[dict]
+    :param update_existing: bool
+    :param chunk: int
+    :return: str
+    """
+    return _PROVISION_JS % {'docs': json.dumps(list(documents)), 'chunk': chunk,
+                            'operator': "$set" if update_existing else "$setOnInsert"}
+
+
+def _parse_counts(stdout: str, seconds: float) -> {str: float}:
+    counts = json.loads(stdout.strip().splitlines()[-1])  # Summary is the last printed line
+    counts['seconds'] = round(seconds, 3)
+    return counts
+
+
+def provision_subscribers(target_con: fabric.Connection, documents: Iterable[dict], *, db: str = "open5gs",
+                          mongo_cmd: str = "mongo", update_existing: bool = False) -> {str: float}:
+    """
+    Registers subscribers in the Open5Gs database of the machine specified in target_con
+    The whole set is sent as one script and inserted with batched bulk writes in one mongo shell session.
+    Provisioning is idempotent. Existing subscribers are skipped (or updated if update_existing is set)
+    Returns counts of inserted and existing subscribers, and the time it took in seconds
+    :param target_con: fabric.Connection
+    :param documents: Iterable[dict]
+    :param db: str
+    :param mongo_cmd: str - mongo or mongosh
+    :param update_existing: bool
+    :return: {str: float}
+    :raises invoke.UnexpectedExit: if the mongo shell failed (error is logged by execute_with_input)
+    """
+    start = time.perf_counter()
+    script = provisioning_script(documents, update_existing=update_existing)
+    # Script is compressed for the transfer (subscriber documents are very repetitive) and sent on stdin. It is
+    # Unpacked to a temporary file that only the user can read (mktemp creates it with mode 600), as it holds keys
+    command = (f'f=$(mktemp --suffix=.js /tmp/vm_automation_XXXXXX) || exit 1; '
+               f'gunzip -c > "$f" && {mongo_cmd} --quiet {db} "$f"; rc=$?; rm -f "$f"; exit $rc')
+    result = vm.execute_with_input(target_con, command=command, data=gzip.compress(script.encode()))
+
+    counts = _parse_counts(result.stdout, time.perf_counter() - start)
+    logging.info(f"Provisioned subscribers on {target_con.host}: {counts}")
+    return counts
+
+
+def provision_subscribers_local(documents: Iterable[dict], *, mongo_uri: str = "mongodb://localhost/open5gs",
+                                mongo_cmd: str = "mongo", update_existing: bool = False) -> {str: float}:
+    """
+    Same as provision_subscribers, but runs the script against a local mongod (e.g. a test stand-in)
+    :param documents: Iterable[dict]
+    :param mongo_uri: str
+    :param mongo_cmd: str - mongo or mongosh
+    :param update_existing: bool
+    :return: {str: float}
+    :raises subprocess.CalledProcessError: if the mongo shell failed
+    """
+    start = time.perf_counter()
+    with tempfile.NamedTemporaryFile("w", suffix=".js") as script:
+        script.write(provisioning_script(documents, update_existing=update_existing))
+        script.flush()
+        result = subprocess.run([mongo_cmd, "--quiet", mongo_uri, script.name],
+                                capture_output=True, text=True, check=True)
+
+    counts = _parse_counts(result.stdout, time.perf_counter() - start)
+    logging.info(f"Provisioned subscribers on {mongo_uri}: {counts}")
+    return counts
@@ -5,33 +5,79 @@ import os
 from datetime import datetime
 import paramiko.ssh_exception
 import uuid
+import threading
+import shlex
+import base64
+import io
+import tarfile
+import hashlib
+import json
+import re
+import shutil
+import select
+import codecs
+import collections
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import yaml_processing as config
+from metrics import instrumented, argument, file_size
 
+DEFAULT_CACHE_DIR = "./transfers/.default_cache"  # Default configs, one folder per simulator and installed version
+ARTIFACT_DIR = "./transfers/.artifacts"  # Prebuilt install artifacts, one tar per simulator and version (or commit)
+# Remote helper of patch_yaml. It is installed once per version (file name contains its hash)
+PATCH_HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts", "patch_yaml.py")
+PATCH_HELPER_DIR = "/usr/local/lib/vm_automation"
 OPEN5GS_ALL = ['amf', 'ausf', 'bsf', 'nrf', 'nssf', 'pcf', 'scp', 'smf', 'udm', 'udr', 'upf']
+# Log formats of the command results. Shared by execute and execute_batch
+EXEC_LOG = "Executed {0.command!r} on {0.connection.host}, got output \n{0.stdout}execution code {0.return_code}\n"
+EXEC_ERR_LOG = "Error during execution of {0.command!r} on {0.connection.host}.\n" \
+               "Got output on stderr \n{0.stderr}error code {0.return_code}\n"
+# Factory of the connections made by connect. Replaced by fake backends, see set_backend and fake_connection.py
+_BACKEND = fabric.Connection
 
 
-def connect(ip_addr: str, *, username: str, key_path: str) -> fabric.Connection:
+def set_backend(factory=None):
+    """
+    Sets the factory connect uses to create connections (takes the fabric.Connection arguments). Returns the
+    Previous one, so it can be restored. None restores fabric.Connection
+    :param factory: callable
+    :return: callable
+    """
+    global _BACKEND
+    previous, _BACKEND = _BACKEND, factory or fabric.Connection
+    return previous
+
+
+@instrumented("connect")
+def connect(ip_addr: str, *, username: str, key_path: str, keep_open: bool = False,
+            port: int = 22) -> fabric.Connection:
     """
     Establishes and checks the possibility of an SSH connection with specified parameters.
     If connection is not possible, a message informing about that is written to stderr
+    If keep_open is set, the checked connection is not closed, so the next call does not redo the handshake
     :param ip_addr: str
     :param username: str
     :param key_path: str
+    :param keep_open: bool
+    :param port: int - other than 22 only for stand-in servers (see local_ssh_server)
     :return: fabric.Connection
     :raises TimeoutError: if fabric.Connection connect_timeout is reached and connection is not established
     """
     # Initiate connection params
     err_str = f"Connection to {ip_addr} not established. Reason: "
-    c = fabric.Connection(
+    c = _BACKEND(
         host=ip_addr,
         user=username,
-        port=22,
+        port=port,
         connect_timeout=10,
         connect_kwargs={'key_filename': [key_path]}
     )
     # Check if the connection is possible
     try:
         c.open()  # Try opening the connection specified above. Will fail if connection was not established
-        c.close()
+        if not keep_open:
+            c.close()
     except TimeoutError:
         logging.exception(err_str + "timed out", exc_info=False)
     except FileNotFoundError:
@@ -48,6 +94,104 @@ def connect(ip_addr: str, *, username: str, key_path: str) -> fabric.Connection:
     raise ConnectionError
 
 
+class ConnectionPool:
+    """
+    Keeps one authenticated SSH transport open per (host, user, key_path) and reuses it across calls
+    Transports are kept alive with SSH keepalive packets. A dead transport is reopened on the next get
+    Handshake, get and session (channels opened for commands and transfers) counts are kept per key, see stats
+    Connections of the pool carry their pool and key (pool attribute), so the functions that open channels on them
+    Count the sessions, see count_session
+    """
+
+    def __init__(self, *, keepalive: int = 30):
+        """
+        :param keepalive: int - interval in seconds between keepalive packets. 0 disables them
+        """
+        self.keepalive = keepalive
+        self._connections = {}
+        self._stats = {}
+        self._locks = {}
+        self._lock = threading.Lock()  # Guards the dicts above and the counts. Handshakes are done under per key locks
+
+    def get(self, ip_addr: str, *, username: str, key_path: str) -> fabric.Connection:
+        """
+        Returns an open connection for the passed parameters. Opens (or reopens) it if needed
+        :param ip_addr: str
+        :param username: str
+        :param key_path: str
+        :return: fabric.Connection
+        :raises ConnectionError: if the connection could not be established (see connect)
+        """
+        key = (ip_addr, username, key_path)
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+            stats = self._stats.setdefault(key, {'handshakes': 0, 'gets': 0, 'sessions': 0})
+            stats['gets'] += 1
+
+        with key_lock:  # Different hosts can be connected to at once (e.g. from run_parallel)
+            c = self._connections.get(key)
+            if c is not None and c.is_connected and c.transport.is_authenticated():
+                return c
+            if c is not None:  # Transport died (e.g. VM reboot after install_sim). Cleanup and reconnect
+                logging.warning(f"Connection to {ip_addr} was lost. Reconnecting")
+                c.close()
+
+            c = connect(ip_addr, username=username, key_path=key_path, keep_open=True)
+            if self.keepalive:
+                c.transport.set_keepalive(self.keepalive)
+            # Plain attribute. Attributes fabric does not define would be stored in the config of the connection
+            object.__setattr__(c, "pool", (self, key))
+            with self._lock:
+                stats['handshakes'] += 1
+                self._connections[key] = c
+            return c
+
+    def count_session(self, key: (str, str, str)) -> None:
+        """
+        Counts a channel opened on the connection of the key
+        :param key: (str, str, str)
+        :return: None
+        """
+        with self._lock:
+            self._stats[key]['sessions'] += 1
+
+    def stats(self) -> {(str, str, str): {str: int}}:
+        """
+        Returns handshake, get and session counts for every (host, user, key_path) key used so far
+        Sessions minus handshakes is the number of handshakes the pool saved
+        :return: {(str, str, str): {str: int}}
+        """
+        with self._lock:
+            return {key: dict(value) for key, value in self._stats.items()}
+
+    def close_all(self) -> None:
+        """
+        Closes all connections kept by the pool
+        :return: None
+        """
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for c in connections:
+            c.close()
+
+
+def count_session(target_con: fabric.Connection, *, sftp: bool = False) -> None:
+    """
+    Counts the channel the caller is about to open on the connection, if it belongs to a ConnectionPool
+    Every command opens its own channel. SFTP transfers share one, opened by the first transfer of the connection
+    (fabric keeps its SFTP client until the connection is closed), so only that one is counted
+    :param target_con: fabric.Connection
+    :param sftp: bool - the channel is the SFTP session of a transfer
+    :return: None
+    """
+    pool = getattr(target_con, "pool", None)
+    if pool is None or (sftp and getattr(target_con, "_sftp", None) is not None):
+        return
+    pool[0].count_session(pool[1])
+
+
+@instrumented("execute", size=lambda args, kwargs, result: len(result.stdout) + len(result.stderr))
 def execute(target_con: fabric.Connection, *, command: str, sudo: bool = False) -> fabric.Result:
     """
     Performs a command on a machine specified in the connection. Can also be used to execute scripts.
@@ -59,9 +203,7 @@ def execute(target_con: fabric.Connection, *, command: str, sudo: bool = False)
     :param sudo: bool
     :return: fabric.Result
     """
-    out = "Executed {0.command!r} on {0.connection.host}, got output \n{0.stdout}execution code {0.return_code}\n"
-    out_err = "Error during execution of {0.command!r} on {0.connection.host}.\n" \
-              "Got output on stderr \n{0.stderr}error code {0.return_code}\n"
+    count_session(target_con)
     try:
         # If exception occurs, result is not defined. Does not exist in local scope
         if sudo:
@@ -72,16 +214,177 @@ def execute(target_con: fabric.Connection, *, command: str, sudo: bool = False)
         if len(result.stdout) == 0:
             result.stdout = "<NO_OUTPUT>"
 
-        logging.info(out.format(result))
+        logging.info(EXEC_LOG.format(result))
     except invoke.UnexpectedExit as e:  # Details of the failed command execution are in the exception
         if sudo:
             e.result.command = e.result.command[31:]
-        logging.exception(out_err.format(e.result))
+        logging.exception(EXEC_ERR_LOG.format(e.result))
         raise  # re-raise the last exception to be handled in the caller functions (e.g. put_file)
     else:
         return result
 
 
+def stream_lines(target_con: fabric.Connection, *, command: str, sudo: bool = False,
+                 chunk_size: int = 32768) -> Iterator[tuple[str, str]]:
+    """
+    Performs a command on a machine specified in the connection and yields (stream, line) pairs as the output
+    Arrives, stream is "stdout" or "stderr". Output is not buffered, memory use does not depend on its length
+    The generator returns the exit code of the command (value of the StopIteration). See execute_stream
+    If sudo is true, the command is executed as an elevated user (sudo password from fabric config, if set)
+    :param target_con: fabric.Connection
+    :param command: str
+    :param sudo: bool
+    :param chunk_size: int
+    :return: Iterator[tuple[str, str]]
+    """
+    password = target_con.config.sudo.password
+    if sudo:
+        sudo_prefix = "sudo -S -p ''" if password else "sudo -n"
+        command = f"{sudo_prefix} bash -c {shlex.quote(command)}"
+    target_con.open()
+    count_session(target_con)
+    channel = target_con.transport.open_session()
+    try:
+        channel.exec_command(command)
+        if sudo and password:
+            channel.sendall((password + "\n").encode())
+
+        readers = {"stdout": (channel.recv_ready, channel.recv),
+                   "stderr": (channel.recv_stderr_ready, channel.recv_stderr)}
+        decoders = {name: codecs.getincrementaldecoder("utf-8")(errors="replace") for name in readers}
+        partial = {name: "" for name in readers}
+        while True:
+            received = False
+            for name, (ready, recv) in readers.items():
+                if not ready():
+                    continue
+                received = True
+                *lines, partial[name] = (partial[name] + decoders[name].decode(recv(chunk_size))).split("\n")
+                for line in lines:
+                    yield name, line
+            if not received:
+                if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+                select.select([channel], [], [], 0.1)  # Wakes up on stdout data. Stderr is checked on timeout
+        for name in readers:  # Last lines without the trailing new line
+            if len(partial[name]) != 0:
+                yield name, partial[name]
+        return channel.recv_exit_status()
+    finally:
+        channel.close()
+
+
+@instrumented("execute_stream")
+def execute_stream(target_con: fabric.Connection, *, command: str, sudo: bool = False, on_line=None,
+                   retain_lines: int = 100, log_level: int = logging.DEBUG) -> fabric.Result:
+    """
+    Streaming variant of execute, for long running commands (e.g. install scripts)
+    Output lines are passed to on_line(stream, line) callback as they arrive and logged with log_level
+    (None disables per line logging). Only the last retain_lines lines of stdout and stderr are kept
+    In the returned result (and in the error log), so memory use is constant regardless of the output length
+    invoke.UnexpectedExit is raised if the command returns an error code, as in execute
+    :param target_con: fabric.Connection
+    :param command: str
+    :param sudo: bool
+    :param on_line: callable
+    :param retain_lines: int
+    :param log_level: int
+    :return: fabric.Result
+    """
+    retained = {"stdout": collections.deque(maxlen=retain_lines), "stderr": collections.deque(maxlen=retain_lines)}
+    line_count = 0
+    lines = stream_lines(target_con, command=command, sudo=sudo)
+    while True:
+        try:
+            stream, line = next(lines)
+        except StopIteration as stop:
+            exit_code = stop.value
+            break
+        line_count += 1
+        retained[stream].append(line + "\n")
+        if log_level is not None:
+            logging.log(log_level, f"[{target_con.host}] {stream}: {line}")
+        if on_line is not None:
+            on_line(stream, line)
+
+    result = fabric.Result(connection=target_con, command=command, exited=exit_code,
+                           stdout="".join(retained["stdout"]), stderr="".join(retained["stderr"]),
+                           hide=("stdout", "stderr"))
+    if result.return_code != 0:
+        logging.error(EXEC_ERR_LOG.format(result))
+        raise invoke.UnexpectedExit(result)
+    logging.info(f"Executed {command!r} on {target_con.host}, streamed {line_count} lines, "
+                 f"execution code {result.return_code}\n")
+    return result
+
+
+@instrumented("execute_batch")
+def execute_batch(target_con: fabric.Connection, *, commands: [str], sudo: bool = False,
+                  stop_on_error: bool = True) -> [fabric.Result]:
+    """
+    Performs multiple commands on a machine specified in the connection, in one remote shell session (one round trip)
+    Each command runs in its own subshell. Its stdout, stderr and exit code are captured separately
+    Returns one fabric.Result per executed command, in the same shape (and logged the same way) as in execute
+    If sudo is true, the whole batch is executed as an elevated user
+    If stop_on_error is true, commands after the first failing one are not executed
+    and invoke.UnexpectedExit is raised for the failed command, like in execute.
+    Otherwise, all commands are executed and failures are only logged
+    :param target_con: fabric.Connection
+    :param commands: [str]
+    :param sudo: bool
+    :param stop_on_error: bool
+    :return: [fabric.Result]
+    """
+    if len(commands) == 0:
+        return []
+    token = "VMBATCH" + uuid.uuid4().hex  # Marks the result lines, so they can't be confused with other output
+    script = ['d=$(mktemp -d) || exit 1', 'trap \'rm -rf "$d"\' EXIT']
+    for i, command in enumerate(commands):
+        script.append(f'(\n{command}\n) >"$d/o" 2>"$d/e" </dev/null; rc=$?')
+        # Output is base64 encoded, so each command result fits exactly in one line
+        script.append(f'printf \'%s %d %d %s %s\\n\' {token} {i} $rc "$(base64 -w0 <"$d/o")" "$(base64 -w0 <"$d/e")"')
+        if stop_on_error:
+            script.append('[ $rc -eq 0 ] || exit 0')
+    batch_command = "bash -c " + shlex.quote("\n".join(script))
+
+    count_session(target_con)
+    try:
+        if sudo:
+            batch_result = target_con.sudo(batch_command, hide=True)
+        else:
+            batch_result = target_con.run(batch_command, hide=True)
+    except invoke.UnexpectedExit as e:  # Batch could not be started at all (e.g. mktemp or sudo failed)
+        logging.exception(f"Batch of {len(commands)} commands failed to run on {target_con.host}.\n"
+                          f"Got output on stderr \n{e.result.stderr}error code {e.result.return_code}\n")
+        raise
+
+    results = []
+    for line in batch_result.stdout.splitlines():
+        fields = line.split(" ")
+        if len(fields) != 5 or fields[0] != token:
+            continue
+        result = fabric.Result(
+            connection=target_con,
+            command=commands[int(fields[1])],
+            exited=int(fields[2]),
+            stdout=base64.b64decode(fields[3]).decode(errors="replace"),
+            stderr=base64.b64decode(fields[4]).decode(errors="replace"),
+            hide=("stdout", "stderr")
+        )
+        if result.return_code != 0:
+            logging.error(EXEC_ERR_LOG.format(result))
+            if stop_on_error:
+                raise invoke.UnexpectedExit(result)
+        else:
+            if len(result.stdout) == 0:
+                result.stdout = "<NO_OUTPUT>"
+            logging.info(EXEC_LOG.format(result))
+        results.append(result)
+
+    return results
+
+
+@instrumented("sudo_put_file", size=lambda args, kwargs, result: file_size(argument(args, kwargs, 1, "local_path")))
 def sudo_put_file(target_con: fabric.Connection, local_path: str, dest_path: str, *,
                   permissions: str):
     """
@@ -92,43 +395,121 @@ def sudo_put_file(target_con: fabric.Connection, local_path: str, dest_path: str
     :param dest_path: str
     :param permissions: str
     """
-    temp_file = execute(target_con, command="mktemp")
-    temp_file = temp_file.stdout.strip()  # Get the created temporary file name
+    # Exceptions are handled in the put_file. Content is streamed to install, which runs as root and creates the
+    # Destination with its final owner and mode. No temporary file (readable by other users meanwhile) is needed
+    with open(local_path, "rb") as file:
+        data = file.read()
+    execute_with_input(target_con, command=f"install -o root -g root -m {permissions} /dev/stdin "
+                                           f"{shlex.quote(dest_path)}", data=data, sudo=True)
+
+
+def file_hash(local_path: str) -> str:
+    """
+    Returns sha256 hex digest of the local file content
+    :param local_path: str
+    :return: str
+    """
+    digest = hashlib.sha256()
+    with open(local_path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
-    # Exceptions are already handled in the called functions
-    put_file(target_con, local_path, temp_file, permissions=permissions, overwrite=True)  # Overwrite temp file
-    execute(target_con, command=f"install -o root -g root -m {permissions} {temp_file} {dest_path}", sudo=True)
+def remote_hashes(target_con: fabric.Connection, remote_paths: [str], *, sudo: bool = False,
+                  permissions: str = None) -> {str: str}:
+    """
+    Computes sha256 of all passed remote files in one remote call
+    Files that do not exist (or can't be read) are not present in the returned dict
+    If permissions is set, files with other permissions are not present either, so a transfer that would only
+    Change the mode of a file is not skipped as unchanged
+    :param target_con: fabric.Connection
+    :param remote_paths: [str]
+    :param sudo: bool
+    :param permissions: str
+    :return: {str: str}
+    """
+    if len(remote_paths) == 0:
+        return {}
+    paths = " ".join(shlex.quote(path) for path in remote_paths)
+    command = f"sha256sum {paths} 2>/dev/null || true"
+    if permissions is not None:
+        command = f"find {paths} -maxdepth 0 -type f -perm {permissions} -exec sha256sum {{}} + 2>/dev/null || true"
+    result = execute(target_con, command=command, sudo=sudo)
+    hashes = {}
+    for line in result.stdout.splitlines():
+        digest, _, path = line.partition("  ")
+        if path in remote_paths:
+            hashes[path] = digest
+    return hashes
+
+
+def changed_files(target_con: fabric.Connection, files: {str: str}, *, sudo: bool = False,
+                  permissions: str = None) -> {str: str}:
+    """
+    Returns the subset of files (local_path:remote_path dict) whose content differs from the remote file
+    Remote hashes are computed in one remote call. If permissions is set, files whose mode differs are returned too
+    :param target_con: fabric.Connection
+    :param files: {str: str}
+    :param sudo: bool
+    :param permissions: str
+    :return: {str: str}
+    """
+    local_hashes = {}
+    for local_path in files:
+        try:
+            local_hashes[local_path] = file_hash(local_path)
+        except FileNotFoundError:  # Let the transfer function report it
+            local_hashes[local_path] = None
 
-    execute(target_con, command=f"rm {temp_file}")
+    current = remote_hashes(target_con, list(files.values()), sudo=sudo, permissions=permissions)
+    changed = {local: dest for local, dest in files.items()
+               if local_hashes[local] is None or current.get(dest) != local_hashes[local]}
+    logging.info(f"Content check on {target_con.host}: {len(files) - len(changed)} unchanged (skipped), "
+                 f"{len(changed)} to transfer")
+    return changed
 
 
+@instrumented("put_file", size=lambda args, kwargs, result:
+              file_size(argument(args, kwargs, 1, "local_path")) if result else 0)
 def put_file(target_con: fabric.Connection, local_path: str, dest_path: str, *,
-             permissions: str = "644", overwrite: bool = False, sudo: bool = False) -> str:
+             permissions: str = "644", overwrite: bool = False, sudo: bool = False,
+             skip_unchanged: bool = False) -> str:
     """
     Transfers a file found at file_path to the machine specified in target_con.
     Due to harder implementation, sudo version of the method might not be implemented in the future
     Permissions determines the permission on the target system. Should be of Linux format e.g. "700"
     Overwrite flag defines whether the file should be overwritten in destination if it exists
-    Returns the remote path of the file that was put. Returns empty string if transfer failed
+    If skip_unchanged is set and the remote file has the same content and permissions, the transfer is skipped
+    Returns the remote path of the file, also if the transfer was skipped. Returns empty string if transfer failed
+    Callers that act on changed files only (e.g. restart daemons) should use put_files_bulk, which returns
+    Only the files that were transferred
     :param target_con: fabric.Connection
     :param local_path: str
     :param dest_path: str
     :param permissions: str
     :param overwrite: bool
     :param sudo: bool
+    :param skip_unchanged: bool
     :return: str
     """
     try:
+        if skip_unchanged and len(changed_files(target_con, {local_path: dest_path}, sudo=sudo,
+                                                permissions=permissions)) == 0:
+            return dest_path  # Remote file already has the same content and permissions
+
         if not overwrite:  # We need to check if file exists already on target
-            file_list = execute(target_con, command=f'find {dest_path} -maxdepth 1 -type f', sudo=True)
-            if dest_path in file_list.stdout.split():  # Find command has found a file
+            check = execute(target_con, command=f"test -e {shlex.quote(dest_path)} && echo exists || true", sudo=True)
+            if check.stdout.strip() == "exists":  # Missing file is not an error, as it was with find
                 raise FileExistsError("Overwrite flag was not set, but file already exists on target machine!")
 
         if sudo:  # Invoke a special function if we want to put the file as root
             sudo_put_file(target_con, local_path, dest_path, permissions=permissions)
         else:
             # Transfer the file with put
+            count_session(target_con, sftp=True)
             target_con.put(local_path, dest_path)  # Might throw permission error if attempt to transfer folder is made
+            count_session(target_con)
             target_con.run(f'chmod {permissions} {dest_path}')
 
     except (FileNotFoundError, FileExistsError) as e:  # General error raised if transfer fails
@@ -138,7 +519,7 @@ def put_file(target_con: fabric.Connection, local_path: str, dest_path: str, *,
             f"OSError occured while transferring {local_path} to {dest_path}.\n"
             f"Most likely a try to transmit a folder was done")
     except invoke.UnexpectedExit:
-        logging.exception("Error while executing find command in put_file. Check previous exception",
+        logging.exception("Error while executing remote command in put_file. Check previous exception",
                           exc_info=False)
     else:  # If no exceptions are caught
         return dest_path
@@ -146,13 +527,366 @@ def put_file(target_con: fabric.Connection, local_path: str, dest_path: str, *,
     return ""  # When an exception is caught, the else in try: else: is not executed
 
 
+@instrumented("put_files_bulk", size=lambda args, kwargs, result:
+              sum(file_size(local) for local, dest in argument(args, kwargs, 1, "files").items() if dest in result))
+def put_files_bulk(target_con: fabric.Connection, files: {str: str}, *, permissions: str = "644",
+                   owner: str = None, overwrite: bool = False, sudo: bool = False,
+                   skip_unchanged: bool = False) -> [str]:
+    """
+    Transfers many files to the machine specified in target_con in one transfer.
+    Files dict maps the local path to the remote destination path. Files are read to memory and sent
+    As one compressed tar stream, which is unpacked and installed to the destinations (see put_data_bulk)
+    Permissions and overwrite flag have the same meaning as in put_file and apply to every file
+    Owner defaults to root if sudo is set, otherwise to the connection user
+    If skip_unchanged is set, files whose content and permissions already match the remote file are not transferred
+    Returns remote paths of the files that were transferred and landed on the machine. Files that failed are logged
+    :param target_con: fabric.Connection
+    :param files: {str: str}
+    :param permissions: str
+    :param owner: str
+    :param overwrite: bool
+    :param sudo: bool
+    :param skip_unchanged: bool
+    :return: [str]
+    """
+    if skip_unchanged:
+        files = changed_files(target_con, files, sudo=sudo, permissions=permissions)
+    data = {}  # Files are read to memory and sent the same way as generated content, see put_data_bulk
+    for local_path, dest_path in files.items():
+        try:
+            with open(local_path, "rb") as file:
+                data[dest_path] = file.read()
+        except FileNotFoundError as e:
+            logging.exception(f"File related error occurred while transferring {local_path}\nReason: {e}")
+    return put_data_bulk(target_con, data, permissions=permissions, owner=owner, overwrite=overwrite, sudo=sudo)
+
+
+def data_hash(data: bytes) -> str:
+    """
+    Returns sha256 hex digest of the data, same as file_hash of a file with that content
+    :param data: bytes
+    :return: str
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def _install_args(permissions: str, owner: str) -> str:
+    return f"-o {owner} -g {owner} -m {permissions}" if owner is not None else f"-m {permissions}"
+
+
+@instrumented("execute_with_input", size=lambda args, kwargs, result: len(kwargs["data"]))
+def execute_with_input(target_con: fabric.Connection, *, command: str, data: bytes,
+                       sudo: bool = False, chunk_size: int = 32768) -> fabric.Result:
+    """
+    Performs a command like execute, but data is streamed to its standard input. Nothing is stored on disk
+    On either side, so generated content can be installed on the remote machine in one round trip
+    Command should read whole stdin. Its output is read while the data is sent, so it may be of any length
+    :param target_con: fabric.Connection
+    :param command: str
+    :param data: bytes
+    :param sudo: bool
+    :param chunk_size: int
+    :return: fabric.Result
+    """
+    password = target_con.config.sudo.password
+    remote_command = command
+    if sudo:
+        sudo_prefix = "sudo -S -p ''" if password else "sudo -n"
+        remote_command = f"{sudo_prefix} bash -c {shlex.quote(command)}"
+    target_con.open()
+    count_session(target_con)
+    channel = target_con.transport.open_session()
+    try:
+        channel.exec_command(remote_command)
+        if sudo and password:
+            channel.sendall((password + "\n").encode())
+        # Input is sent while both outputs are read, as in stream_lines. A command that writes a lot before it
+        # Reads all of its input (or a lot to stderr) can not fill a window that nobody reads and block the transfer
+        output = {"stdout": bytearray(), "stderr": bytearray()}
+        readers = {"stdout": (channel.recv_ready, channel.recv),
+                   "stderr": (channel.recv_stderr_ready, channel.recv_stderr)}
+        sent = 0
+        if len(data) == 0:
+            channel.shutdown_write()
+        while True:
+            progress = False
+            if sent < len(data) and channel.send_ready():
+                sent += channel.send(data[sent:sent + chunk_size])
+                if sent == len(data):
+                    channel.shutdown_write()
+                progress = True
+            for name, (ready, recv) in readers.items():
+                if ready():
+                    output[name] += recv(chunk_size)
+                    progress = True
+            if not progress:
+                if sent == len(data) and channel.exit_status_ready() and not channel.recv_ready() and \
+                        not channel.recv_stderr_ready():
+                    break
+                select.select([channel], [], [], 0.1)  # Wakes up on stdout data. Stderr is checked on timeout
+        exited = channel.recv_exit_status()
+    finally:
+        channel.close()
+
+    result = fabric.Result(connection=target_con, command=command, exited=exited,
+                           stdout=output["stdout"].decode(errors="replace"),
+                           stderr=output["stderr"].decode(errors="replace"), hide=("stdout", "stderr"))
+    if result.return_code != 0:
+        logging.error(EXEC_ERR_LOG.format(result))
+        raise invoke.UnexpectedExit(result)
+    logging.info(EXEC_LOG.format(result))
+    return result
+
+
+def put_data(target_con: fabric.Connection, data: bytes | str, dest_path: str, *, permissions: str = "644",
+             owner: str = None, overwrite: bool = False, sudo: bool = False, skip_unchanged: bool = False) -> str:
+    """
+    Writes data (e.g. a generated config) to dest_path on the machine specified in target_con.
+    Data is streamed from memory to install on the remote machine. No local file and no remote temporary file
+    Is used, the existence and content checks are done in the same round trip
+    Parameters and return value have the same meaning as in put_file. Owner is set as in put_files_bulk
+    :param target_con: fabric.Connection
+    :param data: bytes | str
+    :param dest_path: str
+    :param permissions: str
+    :param owner: str
+    :param overwrite: bool
+    :param sudo: bool
+    :param skip_unchanged: bool
+    :return: str
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    if owner is None and sudo:
+        owner = "root"
+    digest = data_hash(data)
+    quoted = shlex.quote(dest_path)
+    checks = []
+    if skip_unchanged:  # Mode is compared as stat prints it (octal, no leading zeros)
+        checks.append(f'if [ "$(sha256sum < {quoted} | cut -d" " -f1)" = {digest} ] && '
+                      f'[ "$(stat -c %a {quoted})" = {int(permissions, 8):o} ]; then '
+                      f'cat >/dev/null; echo UNCHANGED; exit 0; fi')
+    if not overwrite:
+        checks.append("cat >/dev/null; echo EXISTS; exit 0")
+    command = f"install {_install_args(permissions, owner)} /dev/stdin {quoted} && echo WRITTEN"
+    if len(checks) != 0:  # Remaining stdin is drained, so the data can always be sent whole
+        command = f"if [ -e {quoted} ]; then {'; '.join(checks)}; fi; " + command
+
+    try:
+        result = execute_with_input(target_con, command=command, data=data, sudo=sudo)
+        if result.stdout.strip() == "EXISTS":
+            raise FileExistsError("Overwrite flag was not set, but file already exists on target machine!")
+    except FileExistsError as e:
+        logging.exception(f"File related error occurred while transferring data to {dest_path}\nReason: {e}")
+    except OSError:
+        logging.exception(f"OSError occured while transferring data to {dest_path} on {target_con.host}")
+    except invoke.UnexpectedExit:
+        logging.exception("Error while executing remote command in put_data. Check previous exception",
+                          exc_info=False)
+    else:
+        return dest_path
+
+    return ""
+
+
+@instrumented("put_data_bulk", size=lambda args, kwargs, result:
+              sum(len(data) for dest, data in argument(args, kwargs, 1, "data").items() if dest in result))
+def put_data_bulk(target_con: fabric.Connection, data: {str: bytes | str}, *, permissions: str = "644",
+                  owner: str = None, overwrite: bool = False, sudo: bool = False,
+                  skip_unchanged: bool = False) -> [str]:
+    """
+    Writes many in-memory contents (remote path:data dict) to the machine specified in target_con.
+    Contents are packed into one compressed tar in memory and streamed to the remote machine, where it is
+    Unpacked and installed to the destinations by the same command. One round trip for any number of files
+    Parameters have the same meaning as in put_files_bulk. Returns remote paths of the contents that landed
+    :param target_con: fabric.Connection
+    :param data: {str: bytes | str}
+    :param permissions: str
+    :param owner: str
+    :param overwrite: bool
+    :param sudo: bool
+    :param skip_unchanged: bool
+    :return: [str]
+    """
+    if owner is None and sudo:
+        owner = "root"
+    data = {dest: content.encode() if isinstance(content, str) else content for dest, content in data.items()}
+    hashes = {dest: data_hash(content) for dest, content in data.items()}
+    if skip_unchanged:  # One remote call for all files
+        current = remote_hashes(target_con, list(data), sudo=sudo, permissions=permissions)
+        data = {dest: content for dest, content in data.items() if current.get(dest) != hashes[dest]}
+        logging.info(f"Content check on {target_con.host}: {len(hashes) - len(data)} unchanged (skipped), "
+                     f"{len(data)} to transfer")
+    if len(data) == 0:
+        return []
+
+    archive = io.BytesIO()
+    mtime = datetime.now().timestamp()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for i, content in enumerate(data.values()):  # Member name is the index of the destination
+            info = tarfile.TarInfo(str(i))
+            info.size, info.mtime = len(content), mtime
+            tar.addfile(info, io.BytesIO(content))
+
+    lines = ['t=$(mktemp -d /tmp/vm_automation_XXXXXX) || exit 1', 'tar -xzf - -C "$t" || { rm -rf "$t"; exit 1; }']
+    install_args = _install_args(permissions, owner)
+    for i, dest_path in enumerate(data):
+        quoted = shlex.quote(dest_path)
+        install = f'if install {install_args} "$t/{i}" {quoted}; then echo "OK {i}"; else echo "FAILED {i}"; fi'
+        if not overwrite:  # Same semantics as in put_file. File that exists is not touched and reported as failed
+            install = f'if [ -e {quoted} ]; then echo "EXISTS {i}"; else {install}; fi'
+        lines.append(install)
+    lines.append('rm -rf "$t"')
+
+    try:
+        result = execute_with_input(target_con, command="\n".join(lines), data=archive.getvalue(), sudo=sudo)
+    except OSError:
+        logging.exception(f"OSError occured while transferring archive of {len(data)} files to {target_con.host}")
+        return []
+    except invoke.UnexpectedExit:
+        logging.exception("Error while executing remote command in put_data_bulk. Check previous exception",
+                          exc_info=False)
+        return []
+
+    destinations = list(data)
+    landed = []
+    for line in result.stdout.splitlines():
+        status, _, index = line.partition(" ")
+        if status == "OK":
+            landed.append(destinations[int(index)])
+        elif status == "EXISTS":
+            logging.error(f"Overwrite flag was not set, but {destinations[int(index)]} exists on {target_con.host}")
+        elif status == "FAILED":
+            logging.error(f"Install of {destinations[int(index)]} on {target_con.host} failed")
+    logging.info(f"Bulk transfer to {target_con.host}: {len(landed)} of {len(data)} files landed")
+    return landed
+
+
+def _write_local_copy(file_path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    with open(file_path, "w", newline="\n") as file:
+        file.write(text)
+
+
+def put_yaml(target_con: fabric.Connection, yaml_data: dict, dest_path: str, *, flow: bool = False,
+             local_copy: str = None, **put_kwargs) -> str:
+    """
+    Serializes yaml_data (e.g. result of yaml_processing.modify_yaml) in memory and writes it to dest_path
+    On the machine specified in target_con, see put_data. Local file is written only if local_copy path is set
+    Put_kwargs (permissions, owner, overwrite, sudo, skip_unchanged) are passed to put_data
+    :param target_con: fabric.Connection
+    :param yaml_data: dict
+    :param dest_path: str
+    :param flow: bool - see yaml_processing.yaml_to_string
+    :param local_copy: str
+    :return: str
+    """
+    text = config.yaml_to_string(yaml_data, flow=flow)
+    if local_copy is not None:
+        _write_local_copy(local_copy, text)
+    return put_data(target_con, text, dest_path, **put_kwargs)
+
+
+def put_yaml_bulk(target_con: fabric.Connection, configs: {str: dict}, *, flow: bool = False,
+                  local_copy_dir: str = None, **put_kwargs) -> [str]:
+    """
+    Serializes many configs (remote path:yaml dict) in memory and writes them in one round trip, see put_data_bulk
+    Local files are written to local_copy_dir (file name is the remote one) only if it is set
+    :param target_con: fabric.Connection
+    :param configs: {str: dict}
+    :param flow: bool
+    :param local_copy_dir: str
+    :return: [str]
+    """
+    data = {dest: config.yaml_to_string(yaml_data, flow=flow) for dest, yaml_data in configs.items()}
+    if local_copy_dir is not None:
+        for dest, text in data.items():
+            _write_local_copy(os.path.join(local_copy_dir, os.path.basename(dest)), text)
+    return put_data_bulk(target_con, data, **put_kwargs)
+
+
+def patch_helper() -> (bytes, str):
+    """
+    Returns content of the remote patch helper and the path it is installed to on the remote machines
+    :return: (bytes, str)
+    """
+    with open(PATCH_HELPER, "rb") as file:
+        content = file.read()
+    return content, f"{PATCH_HELPER_DIR}/patch_yaml_{data_hash(content)[:12]}.py"
+
+
+def patch_request(patches: {str: dict}, *, backup: bool = True) -> bytes:
+    """
+    Compiles the diffs (remote path:diff dict, diffs as accepted by yaml_processing.modify_yaml) to the request
+    Read by the remote patch helper. Keys are sent already split into DiffPath steps
+    :param patches: {str: dict}
+    :param backup: bool
+    :return: bytes
+    """
+    files = {path: [[diff_path.key, diff_path.steps, value] for diff_path, value in config.compile_diff(diff)]
+             for path, diff in patches.items()}
+    return json.dumps({"backup": backup, "files": files}, separators=(",", ":")).encode()
+
+
+@instrumented("patch_yaml")
+def patch_yaml(target_con: fabric.Connection, patches: {str: dict}, *, backup: bool = True,
+               sudo: bool = True) -> [str]:
+    """
+    Applies diffs (remote path:diff dict) to yaml files on the machine specified in target_con, in place.
+    Only the compiled diff is sent (a few hundred bytes), the files are not downloaded or uploaded. Remote helper
+    (scripts/patch_yaml.py) replaces each file atomically and keeps the previous version as <file>.bak if backup
+    Is set. Helper is installed on the first use, in the same round trip as the patch otherwise.
+    Returns remote paths of the files that changed, e.g. to restart only their daemons
+    NOTE: patched file is written by PyYAML on the remote machine, comments of the file are not kept
+    :param target_con: fabric.Connection
+    :param patches: {str: dict}
+    :param backup: bool
+    :param sudo: bool
+    :return: [str]
+    """
+    request = patch_request(patches, backup=backup)
+    helper, helper_path = patch_helper()
+    quoted = shlex.quote(helper_path)
+    command = f"if [ ! -f {quoted} ]; then cat >/dev/null; echo MISSING; exit 0; fi; python3 {quoted}"
+    try:
+        result = execute_with_input(target_con, command=command, data=request, sudo=sudo)
+        if result.stdout.strip() == "MISSING":
+            logging.info(f"Installing patch helper to {helper_path} on {target_con.host}")
+            execute_with_input(target_con, command=f"install -D -m 755 /dev/stdin {quoted}", data=helper, sudo=True)
+            result = execute_with_input(target_con, command=command, data=request, sudo=sudo)
+    except OSError:
+        logging.exception(f"OSError occured while patching {len(patches)} files on {target_con.host}")
+        return []
+    except invoke.UnexpectedExit as e:  # Files patched before the failing one are still reported
+        logging.exception("Error while executing remote command in patch_yaml. Check previous exception",
+                          exc_info=False)
+        result = e.result
+    metrics.REGISTRY.add_bytes("patch_yaml", target_con.host, len(request))
+
+    changed = []
+    for line in result.stdout.splitlines():
+        try:
+            outcome = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if "error" in outcome:
+            logging.error(f"Patch of {outcome['path']} on {target_con.host} failed. Reason: {outcome['error']}")
+            continue
+        for key in outcome["missed"]:
+            logging.error(f"Could not assign key {key} in {outcome['path']} on {target_con.host}. No match")
+        if outcome["changed"]:
+            changed.append(outcome["path"])
+    logging.info(f"Patch on {target_con.host}: {len(changed)} of {len(patches)} files changed")
+    return changed
+
+
 def get_default_configs(target_con: fabric.Connection, dest_path: str, mode: str, *, overwrite: bool = False) -> None:
     """
     Transfers all yaml files of open5gs from the machine specified in the target con to the dest_path
     If overwrite flag is set, the function will overwrite existing files in the path
     If it is not set and files exist in the path, the function will not execute
     This method theoretically does not need to be used every time. One fetch of open5gs and UERANSIM configs
-    Might be enough for config file modifications
+    Might be enough for config file modifications. See get_default_configs_cached for a version aware variant
     :param target_con: fabric.Connection
     :param dest_path: str
     :param mode: str
@@ -175,6 +909,90 @@ def get_default_configs(target_con: fabric.Connection, dest_path: str, mode: str
             get_file(target_con, "/home/open5gs/UERANSIM/config/open5gs-ue.yaml", dest_path)
 
 
+def default_config_key(target_con: fabric.Connection, mode: str) -> str:
+    """
+    Returns the key of the default configs installed on the machine, determined in one remote call
+    The key is the installed version (open5gs package version or UERANSIM commit)
+    If the version can't be determined, the key is a hash of the remote default config files
+    :param target_con: fabric.Connection
+    :param mode: str
+    :return: str
+    """
+    if mode.lower() == "open5gs":
+        version = "dpkg-query -W -f='${Version}' open5gs"
+        files = "cat /etc/open5gs/*.yaml"
+    else:
+        version = f"git -C /home/{target_con.user}/UERANSIM rev-parse --short=12 HEAD"
+        files = f"cat /home/{target_con.user}/UERANSIM/config/open5gs-*.yaml"
+    command = (f'v=$({version} 2>/dev/null) && [ -n "$v" ] && echo "version-$v" || '
+               f'echo "hash-$({files} 2>/dev/null | sha256sum | cut -c1-16)"')
+    key = execute(target_con, command=command).stdout.strip()
+    return re.sub(r"[^A-Za-z0-9._+~-]", "_", key)  # Version strings are used as folder names
+
+
+def get_default_configs_cached(target_con: fabric.Connection, mode: str) -> str:
+    """
+    Makes sure the default configs of open5gs or UERANSIM in ./transfers/all_open5gs or ./transfers/all_ueransim
+    Match the version installed on the machine specified in the target_con
+    Configs are fetched only if the local cache has no entry for the installed version. The cache is shared
+    By all drivers and hosts running the same version, so most runs do not fetch anything
+    The local folder is replaced as a whole, files of the previously used version do not remain in it
+    Returns the local folder with the default configs. Returns empty string if the fetch failed
+    :param target_con: fabric.Connection
+    :param mode: str
+    :return: str
+    """
+    mode = mode.lower()
+    try:
+        if mode not in ("open5gs", "ueransim"):
+            raise ValueError("Invalid type variable passed. Should be open5gs or ueransim")
+    except ValueError as e:
+        logging.exception(e)
+        return ""
+
+    key = default_config_key(target_con, mode)
+    cache_folder = os.path.join(DEFAULT_CACHE_DIR, mode, key)
+    local_folder = f"./transfers/all_{mode}"
+    marker = os.path.join(local_folder, ".cache_key")
+
+    if not os.path.isdir(cache_folder):
+        logging.info(f"Default {mode} configs for {key} are not cached. Fetching from {target_con.host}")
+        if mode == "open5gs":
+            remote_path, pattern = "/etc/open5gs/", "*.yaml"
+        else:
+            remote_path, pattern = f"/home/{target_con.user}/UERANSIM/config/", "open5gs-*.yaml"
+        # Unique per fetch, so concurrent fetches of the same key do not mix. Relative to ./transfers, see get_folder
+        partial = f".default_cache/{mode}/{key}.{uuid.uuid4().hex}.partial"
+        if len(get_folder(target_con, remote_path, partial, pattern=pattern)) == 0:
+            return ""
+        try:
+            os.replace(f"./transfers/{partial}", cache_folder)  # Cache entry appears only if the fetch succeeded
+        except OSError:
+            if not os.path.isdir(cache_folder):
+                raise
+            # Another fetch of the same key published it first. Its configs are used
+            shutil.rmtree(f"./transfers/{partial}", ignore_errors=True)
+
+    if os.path.exists(marker):
+        with open(marker, "r") as file:
+            if file.read().strip() == key:
+                return local_folder  # Local defaults already match the installed version
+
+    # Copied to a fresh folder that replaces the old one, so configs of the previous version (e.g. of a daemon
+    # The new version no longer ships) do not stay next to the new ones. Readers see the old or the new folder
+    fresh_folder = f"{local_folder}.{uuid.uuid4().hex}.partial"
+    shutil.copytree(cache_folder, fresh_folder)
+    with open(os.path.join(fresh_folder, ".cache_key"), "w") as file:
+        file.write(key)
+    old_folder = f"{local_folder}.{uuid.uuid4().hex}.old"
+    if os.path.exists(local_folder):
+        os.replace(local_folder, old_folder)
+    os.replace(fresh_folder, local_folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+    logging.info(f"Default {mode} configs in {local_folder} updated to {key}")
+    return local_folder
+
+
 def sudo_get_file(target_con: fabric.Connection, remote_path: str, dest_path: str):
     """
     Helper function for the get_file, sudo variant
@@ -183,63 +1001,143 @@ def sudo_get_file(target_con: fabric.Connection, remote_path: str, dest_path: st
     :param remote_path: str
     :param dest_path: str
     """
-    # TODO - Test this function
-    temp_file = execute(target_con, command="mktemp")
+    temp_file = execute(target_con, command="mktemp")  # Created with mode 600, readable only by the user
     temp_file = temp_file.stdout.strip()  # Get the created temporary file name
 
-    # Exceptions are already handled in the called functions
-    execute(target_con, command=f"cp {remote_path} {temp_file}", sudo=True)
-    # We use get_file rather than .get to handle exceptions
-    # get_file(target_con, temp_file, dest_path, folder_mode=False)
-    target_con.get(temp_file, dest_path)
+    # Exceptions are handled in the get_file. Temporary file is removed also if the copy or transfer fails
+    try:
+        execute(target_con, command=f"cp {shlex.quote(remote_path)} {temp_file}", sudo=True)
+        count_session(target_con, sftp=True)
+        target_con.get(temp_file, dest_path)
+    finally:
+        execute(target_con, command=f"rm -f {temp_file}", sudo=True)  # Cleanup
+
+
+def folder_pack_command(remote_path: str, pattern: str = "*") -> str:
+    """
+    Returns a command that prints files of the remote folder matching the pattern as base64 encoded tar.gz stream
+    Stream is base64 encoded, because the command output is decoded as text. See get_folder
+    :param remote_path: str
+    :param pattern: str
+    :return: str
+    """
+    script = (f"set -o pipefail; cd {shlex.quote(remote_path)} && "
+              f"find . -maxdepth 1 -type f -name {shlex.quote(pattern)} -print0 | "
+              f"tar --null -T - -czf - | base64 -w0")
+    return "bash -c " + shlex.quote(script)
 
-    execute(target_con, command=f"rm {temp_file}", sudo=True)  # Cleanup
+
+def unpack_folder(packed: str, dest_path: str, *, preserve_times: bool = True) -> [str]:
+    """
+    Unpacks the output of the folder_pack_command to ./transfers/dest_path. Returns local paths of the files
+    :param packed: str
+    :param dest_path: str
+    :param preserve_times: bool
+    :return: [str]
+    :raises ValueError, tarfile.TarError: if the packed stream is invalid
+    """
+    local_folder = f"./transfers/{dest_path}"
+    os.makedirs(local_folder, exist_ok=True)
+    local_paths = []
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(packed)), mode="r:gz") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            local_path = os.path.join(local_folder, os.path.basename(member.name))
+            with archive.extractfile(member) as src, open(local_path, "wb") as dst:
+                dst.write(src.read())
+            if preserve_times:
+                os.utime(local_path, (member.mtime, member.mtime))
+            local_paths.append(local_path)
+    return local_paths
+
+
+@instrumented("get_folder", size=lambda args, kwargs, result: sum(file_size(path) for path in result))
+def get_folder(target_con: fabric.Connection, remote_path: str, dest_path: str = "", *, pattern: str = "*",
+               preserve_times: bool = True, sudo: bool = False) -> [str]:
+    """
+    Transfers all files (not subfolders) of the remote folder to ./transfers/dest_path in a single remote command.
+    Files are packed into a compressed tar stream on the remote machine and unpacked locally
+    Pattern is a glob (as in find -name) that the file names have to match, e.g. "*.yaml"
+    If preserve_times is set, local files keep the modification times of the remote files
+    Returns local paths of the fetched files. Returns empty list if the transfer failed
+    :param target_con: fabric.Connection
+    :param remote_path: str
+    :param dest_path: str
+    :param pattern: str
+    :param preserve_times: bool
+    :param sudo: bool
+    :return: [str]
+    """
+    command = folder_pack_command(remote_path, pattern)
+    count_session(target_con)
+    try:
+        if sudo:
+            result = target_con.sudo(command, hide=True)
+        else:
+            result = target_con.run(command, hide=True)
+        local_paths = unpack_folder(result.stdout, dest_path, preserve_times=preserve_times)
+    except invoke.UnexpectedExit as e:
+        logging.exception(f"Transfer failed: unable to pack {remote_path} on {target_con.host}.\n"
+                          f"Got output on stderr \n{e.result.stderr}error code {e.result.return_code}\n",
+                          exc_info=False)
+        return []
+    except (ValueError, tarfile.TarError):
+        logging.exception(f"Transfer failed: invalid archive of {remote_path} received from {target_con.host}")
+        return []
+
+    logging.info(f"Fetched {len(local_paths)} files from {remote_path} on {target_con.host} to ./transfers/{dest_path}")
+    return local_paths
 
 
 # NOTE. Get method is unable to fetch files into a directory:
 # target_con.get(remote_path, "./configs/nrf.yaml")  # e.g. when remote_path is /etc/open5gs/nrf.yaml - works
 # target_con.get(remote_path, "./")  # when remote_path is /etc/open5gs/ does not work, because:
 # PermissionError: [Errno 13] Permission denied: 'C:\\Users\\batru\\Desktop\\system_commands_testing\\configs'
+@instrumented("get_file", size=lambda args, kwargs, result: 0 if kwargs.get("folder_mode") else
+              file_size(f"./transfers/{argument(args, kwargs, 2, 'dest_path')}"))  # Folders are counted in get_folder
 def get_file(target_con: fabric.connection, remote_path: str, dest_path: str = "", *,
-             folder_mode: bool = False, sudo: bool = False) -> None:
+             folder_mode: bool = False, sudo: bool = False, pattern: str = "*", preserve_times: bool = True) -> None:
     """
     Transfers file from remote machine specified in target_con, to local filesystem.
-    If folder_mode is true, it will attempt to transfer whole folder
+    If folder_mode is true, it will attempt to transfer whole folder in a single pass (see get_folder).
+    Pattern and preserve_times are used only in the folder_mode
     Dest_path should be relative to the 'transfers' folder.
     :param target_con: fabric.connection
     :param remote_path: str
     :param dest_path: str
     :param folder_mode: bool
     :param sudo: bool
+    :param pattern: str
+    :param preserve_times: bool
     :return: str
     """
-    # Determine the directory contents
-    try:  # If the file or folder in remote_path doesnt exist, the exception is handled in the execute function
-        if folder_mode:  # We need to fetch folder contents to transfer files one by one
-            # Find only files (not folders) in the specified remote_path
-            file_list = execute(target_con, command=f'find {remote_path} -maxdepth 1 -type f', sudo=True)
-            if len(file_list.stdout) == 0:
-                raise ValueError(file_list.stderr)
-            # Split each file path into different array indexes
-            file_paths = file_list.stdout.split()
-            # Since find gives the full path, we need to extract only the file names to properly specify the destination
-            file_names = [file.split("/")[-1] for file in file_paths]
+    if folder_mode:  # Whole folder is fetched as one tar stream. Errors are logged in the get_folder
+        get_folder(target_con, remote_path, dest_path, pattern=pattern, preserve_times=preserve_times, sudo=sudo)
+        return
+
+    try:  # If the file in remote_path doesnt exist, the exception is handled in the execute function
+        file_name = dest_path.split("/")[-1]
+        # Remove the file name from the dest_path
+        dest_path = dest_path.split("/")[:-1]  # Split by "/" and get everything except last element (file name)
+        dest_path = '/'.join(dest_path)  # Reassemble the string
+
+        dest_folder = f"./transfers/{dest_path}/{file_name}"
+        existed = os.path.exists(dest_folder)
+        if sudo:
+            sudo_get_file(target_con, remote_path, dest_folder)
         else:
-            file_names = [dest_path.split("/")[-1]]  # One elem array needed due to for loop
-            file_paths = [remote_path]  # Single file_path
-            # Remove the file name from the dest_path
-            dest_path = dest_path.split("/")[:-1]  # Split by "/" and get everything except last element (file name)
-            dest_path = '/'.join(dest_path)  # Reassemble the string
-
-        for file_path, file_name in zip(file_paths, file_names):
-            dest_folder = f"./transfers/{dest_path}/{file_name}"
-            if sudo:
-                sudo_get_file(target_con, file_path, dest_folder)
-            else:
-                target_con.get(file_path, dest_folder)
+            count_session(target_con, sftp=True)
+            target_con.get(remote_path, dest_folder)
 
+    except invoke.UnexpectedExit:  # Copy of the sudo variant failed, the error is logged in the execute function
+        logging.exception(f"Transfer failed: unable to fetch file {remote_path}. Check previous exception",
+                          exc_info=False)
+        return
     except (ValueError, OSError):
-        logging.exception(f"Transfer failed: unable to fetch file list for {remote_path}")
+        logging.exception(f"Transfer failed: unable to fetch file {remote_path}")
+        if not existed and os.path.isfile(dest_folder):  # Get creates the local file before it reads the remote one
+            os.remove(dest_folder)
         return
 
 
@@ -266,20 +1164,120 @@ def write_launch_config(daemons: {str: str}) -> str:
         return absolute_script_path
 
 
-def install_sim(target_con: fabric.Connection, sim_name: str) -> None:
+def find_artifact(sim_name: str, key: str = None) -> str:
+    """
+    Returns local path of the install artifact of the simulator for key (Open5Gs version or UERANSIM commit)
+    Without key, the most recently built artifact is returned. Returns empty string if there is none
+    :param sim_name: str
+    :param key: str
+    :return: str
+    """
+    folder = os.path.join(ARTIFACT_DIR, sim_name.lower())
+    if key is not None:
+        path = os.path.join(folder, f"{key}.tar")
+        return path if os.path.isfile(path) else ""
+    try:
+        candidates = [os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".tar")]
+    except FileNotFoundError:
+        return ""
+    return max(candidates, key=os.path.getmtime, default="")
+
+
+@instrumented("build_artifact", size=lambda args, kwargs, result: file_size(result))
+def build_artifact(build_con: fabric.Connection, sim_name: str, *, ref: str = None) -> str:
+    """
+    Builds the install artifact of the simulator on the machine specified in build_con (see
+    scripts/build_artifact.sh) and fetches it to the local artifact cache. UERANSIM is compiled once there,
+    Packages are downloaded once. Ref is the UERANSIM git ref to build (default branch if None)
+    Returns local path of the artifact, empty string if build failed
+    :param build_con: fabric.Connection
+    :param sim_name: str
+    :param ref: str
+    :return: str
+    """
+    sim_name = sim_name.lower()
+    home = f"/home/{build_con.user}" if build_con.user != "root" else "/root"
+    script_path = f"{home}/build_artifact"
+    remote_artifact = f"/tmp/vm_automation_{sim_name}_artifact.tar"
+    if len(put_file(build_con, "./scripts/build_artifact.sh", script_path, permissions="744", overwrite=True)) == 0:
+        return ""
+    command = f"{script_path} {sim_name} {remote_artifact}" + (f" {shlex.quote(ref)}" if ref else "")
+    try:
+        result = execute_stream(build_con, command=command, sudo=True, log_level=logging.INFO)
+    except invoke.UnexpectedExit:
+        logging.exception(f"Build of {sim_name} artifact on {build_con.host} failed. Check previous exception",
+                          exc_info=False)
+        return ""
+    # Script prints the key of the artifact as its last line, "KEY <key>"
+    key_lines = [line for line in result.stdout.splitlines() if line.startswith("KEY ")]
+    if len(key_lines) == 0:
+        logging.error(f"Build of {sim_name} artifact on {build_con.host} did not report the artifact key")
+        return ""
+    key = key_lines[-1].split(" ", 1)[1].strip()
+
+    local_path = os.path.join(ARTIFACT_DIR, sim_name, f"{key}.tar")
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    get_file(build_con, remote_artifact, os.path.relpath(local_path, "./transfers").replace(os.sep, "/"))
+    execute(build_con, command=f"rm -f {remote_artifact}", sudo=True)
+    if not os.path.isfile(local_path):
+        return ""
+    logging.info(f"Built {sim_name} artifact {key} on {build_con.host}, cached at {local_path}")
+    return local_path
+
+
+def prepare_artifacts(sim_dict: {fabric.Connection: str}, *, keys: {str: str} = None,
+                      ref: str = None) -> {str: str}:
+    """
+    Returns sim name:local artifact path for all simulators in sim_dict (as passed to install_sim_parallel)
+    Artifacts found in the local cache (for the key of the simulator if keys has it) are used as they are, no
+    Machine or network access is needed then. Missing ones are built in parallel, each on the first machine
+    Of its simulator. Simulators whose artifact is not available are not in the returned dict
+    :param sim_dict: {fabric.Connection: str}
+    :param keys: {str: str}
+    :param ref: str - UERANSIM git ref, see build_artifact
+    :return: {str: str}
+    """
+    keys = keys or {}
+    artifacts, builders = {}, {}
+    for target_con, sim_name in sim_dict.items():
+        sim_name = sim_name.lower()
+        if sim_name in artifacts or sim_name in builders.values():
+            continue
+        path = find_artifact(sim_name, keys.get(sim_name))
+        if len(path) != 0:
+            artifacts[sim_name] = path
+        else:
+            builders[target_con] = sim_name
+
+    def _build(build_con: fabric.Connection) -> str:
+        return build_artifact(build_con, builders[build_con], ref=ref)
+
+    built, _ = run_parallel(list(builders), _build)
+    for target_con, sim_name in builders.items():
+        if len(built.get(target_con.host, "")) != 0:
+            artifacts[sim_name] = built[target_con.host]
+    return artifacts
+
+
+def install_sim(target_con: fabric.Connection, sim_name: str, *, artifact: str = None) -> None:
     """
     Does necessary file transfers and commands executions to install Open5Gs or UERANSIM
     On the machine specified by the ip_addr, authenticating with key found in key_path
+    If artifact (local path, see prepare_artifacts) is set, prebuilt binaries and packages from it are installed
+    Instead, so the machine does not compile anything or need network access
+    Failures are raised, so install_sim_parallel reports the host in its errors
     :param target_con: fabric.Connection
     :param sim_name: str
+    :param artifact: str
     :return: None
+    :raises ValueError: if sim_name is neither open5gs nor ueransim
+    :raises OSError: if the install script or the artifact could not be transferred
+    :raises invoke.UnexpectedExit: if the install script returns an error code
     """
     sim_name = sim_name.lower()
-    try:
-        if sim_name not in ("ueransim", "open5gs"):
-            raise ValueError("Install_sim called with invalid simulator type to install. Aborting installation")
-    except ValueError as e:
-        logging.exception(e)
+    if sim_name not in ("ueransim", "open5gs"):
+        logging.error(f"Install_sim called with invalid simulator type {sim_name!r} to install. Aborting installation")
+        raise ValueError(f"Invalid simulator type {sim_name!r}, expected open5gs or ueransim")
 
     src_path = f"./scripts/install_{sim_name}.sh"  # dot specifies relative path
     # Due to internals of put command, we need full path. Tilde (home) won't work
@@ -295,10 +1293,18 @@ def install_sim(target_con: fabric.Connection, sim_name: str) -> None:
     else:
         # Logging might not be needed as message is already written out in the transfer_file function
         logging.error(message + " FAILED!")
-        return
+        raise OSError(message + " failed")
+    command = dest_path
+    if artifact is not None:  # Install script removes the artifact after unpacking it
+        remote_artifact = f"/tmp/vm_automation_{sim_name}_artifact.tar"
+        if len(put_file(target_con, artifact, remote_artifact, overwrite=True)) == 0:
+            logging.error(f"Transfer of artifact {artifact} to machine {target_con.host} FAILED!")
+            raise OSError(f"Transfer of artifact {artifact} to machine {target_con.host} failed")
+        command = f"{dest_path} {remote_artifact}"
     # Sudo true is needed in case connection is for the non-root user
     # However, if "no password sudo" is not enabled, this will not work for non-root
-    execute(target_con, command=dest_path, sudo=True)
+    # Output is streamed to the log as it arrives. Installs take minutes and print a lot
+    execute_stream(target_con, command=command, sudo=True, log_level=logging.INFO)
 
 
 def setup_end(machine_dict: {str: str}) -> None:
@@ -323,24 +1329,126 @@ def setup_end(machine_dict: {str: str}) -> None:
     print("To perform some simulations, it is required build gnb and ue elements. Use the following commands:")
     print(r"cd ~/UERANSIM\nsudo build/nr-[ue/gnb] -c config/open5gs-[ue/gnb].yaml")
     print("It is also recommended to start tcpdump just before initialising the gnb and ue for traffic analysis")
+    print("Captures on all machines at once: python cli.py capture <scenario> (see packet_capture.py)")
+
+
+def run_parallel(targets: list, func, *args, max_workers: int = 8, **kwargs) -> ({str: object}, {str: Exception}):
+    """
+    Runs func(target, *args, **kwargs) for every target at once, using a bounded pool of worker threads
+    Targets are either fabric.Connection objects or plain ip addresses (e.g. keys of the conn_dict)
+    Exceptions do not abort other hosts. They are collected and returned alongside the results
+    Both returned dicts are keyed by host (ip address) and keep the order of the passed targets
+    :param targets: [fabric.Connection] or [str]
+    :param func: callable
+    :param max_workers: int
+    :return: ({str: object}, {str: Exception})
+    """
+    results, errors = {}, {}
+    if len(targets) == 0:
+        return results, errors
 
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as executor:
+        futures = {}
+        for target in targets:
+            host = target.host if isinstance(target, fabric.Connection) else target
+            futures[host] = executor.submit(func, target, *args, **kwargs)
+        for host, future in futures.items():  # Wall time is set by the slowest host, not the sum of all hosts
+            try:
+                results[host] = future.result()
+            except Exception as e:  # Any failure is reported per host, rest of the hosts are unaffected
+                logging.error(f"{func.__name__} failed on {host}: {e!r}")
+                errors[host] = e
+    return results, errors
 
-def init_connections(conn_dict: {str: str}, *, username: str = "open5gs") -> [fabric.Connection]:
+
+def init_connections_parallel(conn_dict: {str: str}, *, username: str = "open5gs", max_workers: int = 8,
+                              pool: ConnectionPool = None) -> ({str: fabric.Connection}, {str: Exception}):
+    """
+    Connects to all machines from the ip_addr:key_path dictionary at once
+    Unlike init_connections, a failed connection does not abort the others. Errors are returned per host
+    If pool is passed, connections are taken from it (and stay open) instead of being created from scratch
+    :param conn_dict: {str: str}
+    :param username: str
+    :param max_workers: int
+    :param pool: ConnectionPool
+    :return: ({str: fabric.Connection}, {str: Exception})
+    """
+    def _connect(ip: str) -> fabric.Connection:
+        if pool is not None:
+            return pool.get(ip, username=username, key_path=conn_dict[ip])
+        return connect(ip, username=username, key_path=conn_dict[ip])
+
+    return run_parallel(list(conn_dict), _connect, max_workers=max_workers)
+
+
+def execute_parallel(connections: [fabric.Connection], *, command: str, sudo: bool = False,
+                     max_workers: int = 8) -> ({str: fabric.Result}, {str: Exception}):
+    """
+    Executes the same command on all machines at once. See execute for details
+    :param connections: [fabric.Connection]
+    :param command: str
+    :param sudo: bool
+    :param max_workers: int
+    :return: ({str: fabric.Result}, {str: Exception})
+    """
+    return run_parallel(connections, execute, command=command, sudo=sudo, max_workers=max_workers)
+
+
+def install_sim_parallel(sim_dict: {fabric.Connection: str}, *, artifacts: {str: str} = None,
+                         max_workers: int = 8) -> ({str: None}, {str: Exception}):
+    """
+    Installs simulators on all machines at once. Dict maps a connection to the simulator name (open5gs or ueransim)
+    Artifacts maps a simulator name to its local artifact (see prepare_artifacts). Simulators present there are
+    Built once and only copied to the machines, e.g.:
+        install_sim_parallel(sim_dict, artifacts=prepare_artifacts(sim_dict))
+    :param sim_dict: {fabric.Connection: str}
+    :param artifacts: {str: str}
+    :param max_workers: int
+    :return: ({str: None}, {str: Exception})
+    """
+    artifacts = artifacts or {}
+
+    def _install(target_con: fabric.Connection) -> None:
+        install_sim(target_con, sim_dict[target_con], artifact=artifacts.get(sim_dict[target_con].lower()))
+
+    return run_parallel(list(sim_dict), _install, max_workers=max_workers)
+
+
+def patch_yaml_parallel(patch_dict: {fabric.Connection: {str: dict}}, *, backup: bool = True, sudo: bool = True,
+                        max_workers: int = 8) -> ({str: [str]}, {str: Exception}):
+    """
+    Patches yaml files on all machines at once, see patch_yaml. Dict maps a connection to its remote path:diff dict
+    Results are the changed files of each host
+    :param patch_dict: {fabric.Connection: {str: dict}}
+    :param backup: bool
+    :param sudo: bool
+    :param max_workers: int
+    :return: ({str: [str]}, {str: Exception})
+    """
+    def _patch(target_con: fabric.Connection) -> [str]:
+        return patch_yaml(target_con, patch_dict[target_con], backup=backup, sudo=sudo)
+
+    return run_parallel(list(patch_dict), _patch, max_workers=max_workers)
+
+
+def init_connections(conn_dict: {str: str}, *, username: str = "open5gs",
+                     pool: ConnectionPool = None) -> [fabric.Connection]:
     """
     Connects to all machines from the ip_addr:key_path dictionary
+    Connections are opened in parallel, the returned list keeps the order of conn_dict
     :param conn_dict: dict
     :param username: str
+    :param pool: ConnectionPool
     :return: [fabric.Connection]
+    :raises ConnectionError: if any of the machines could not be connected to
     """
-    c = []
+    connections, errors = init_connections_parallel(conn_dict, username=username, pool=pool)
+    for ip in errors:
+        logging.error(f"Unable to connect to machine {ip}")
+    if len(errors) != 0:
+        raise ConnectionError(f"Unable to connect to machine(s): {', '.join(errors)}")
 
-    for ip, key_path in conn_dict.items():
-        try:
-            c.append(connect(ip, username=username, key_path=key_path))
-        except ConnectionError:
-            logging.exception(f"Unable to connect to machine {ip}")
-            raise
-    return c
+    return [connections[ip] for ip in conn_dict]
 
 
 def main():
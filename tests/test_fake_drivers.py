@@ -0,0 +1,296 @@
+# Drivers and scenarios run against fake_connection.FakeNetwork. Machines are strict, so a command nothing simulates
+# Fails the run instead of succeeding silently. Round trips per host are pinned: a change that adds remote commands
+# Or transfers has to update the numbers here
+import fabric
+import pytest
+import cli
+import fake_connection as fake
+import scenario_engine as engine
+import semi_advanced_case_driver as semi
+import simple_case_driver as simple
+import test_VM_commands as vm
+import yaml_processing as config
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEMI_IPS = ["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4", "10.0.0.5"]
+SIMPLE_SCENARIO = {
+    "name": "simple", "username": "open5gs", "key_path": "/keys/id_ed25519",
+    "roles": {
+        "cplane": {"ip": "10.1.0.1", "sim": "open5gs",
+                   "configs": {"amf": {"diff": {'amf-ngap0-addr': "{cplane}"}},
+                               "smf": {"diff": {'smf-pfcp0-addr': "{cplane}", 'upf-pfcp0-addr': "{upf}"}}},
+                   "subscribers_from": ["ue"]},
+        "upf": {"ip": "10.1.0.2", "sim": "open5gs", "configs": {"upf": {"diff": {'upf-pfcp0-addr': "{upf}"}}}},
+        "gnb": {"ip": "10.1.0.3", "sim": "ueransim",
+                "configs": {"gnb": {"diff": {'linkIp': "{gnb}", 'amfConfigs0-address': "{cplane}"}}},
+                "launch": ["gnb"]},
+        "ue": {"ip": "10.1.0.4", "sim": "ueransim",
+               "configs": {"ue": {"supi": "imsi-001010000000000", "count": 3, "diff": {'gnbSearchList0': "{gnb}"},
+                                  "assignments": [(1, 3, {'sessions0-apn': "ims"})]}},
+               "launch": ["ue"], "launch_after": ["gnb"]},
+    }
+}
+
+
+class Tools:
+    """
+    Simulates the system tools the drivers call (package versions, sysctl, ip, iptables, systemctl) on fake hosts
+    State of every host is kept, so the tests can check what the drivers changed
+    """
+
+    def __init__(self):
+        self.sysctl = {}  # host:{key:value}
+        self.interfaces = {}  # host:{dev:{"addr", "up"}}
+        self.nat = {}  # host:[rule]
+        self.restarts = {}  # host:[unit]
+
+    def install(self, host: fake.FakeHost) -> None:
+        self.sysctl[host.name], self.interfaces[host.name] = {}, {}
+        self.nat[host.name], self.restarts[host.name] = [], []
+        host.on(r"dpkg-query -W -f=\$\{Version\} open5gs$", lambda host, argv, stdin: "2.7.0")
+        host.on(r"git -C \S+ rev-parse --short=12 HEAD$", lambda host, argv, stdin: "0123456789ab\n")
+        host.on(r"sysctl -w ", self.sysctl_write)
+        host.on(r"ip ", self.ip)
+        host.on(r"ip6?tables -t nat ", self.iptables)
+        host.on(r"systemctl restart ", self.systemctl)
+
+    def sysctl_write(self, host, argv, stdin):
+        key, _, value = argv[2].partition("=")
+        self.sysctl[host.name][key] = value
+        return f"{key} = {value}\n"
+
+    def ip(self, host, argv, stdin):
+        interfaces = self.interfaces[host.name]
+        command = " ".join(argv[1:])
+        if match := re.fullmatch(r"link show (\S+)", command):
+            if match[1] not in interfaces:
+                return "", f'Device "{match[1]}" does not exist.\n', 1
+            return f"{match[1]}: <POINTOPOINT> mtu 1500\n"
+        if match := re.fullmatch(r"tuntap add name (\S+) mode tun", command):
+            interfaces[match[1]] = {"addr": None, "up": False}
+        elif match := re.fullmatch(r"addr replace (\S+) dev (\S+)", command):
+            interfaces[match[2]]["addr"] = match[1]
+        elif match := re.fullmatch(r"link set (\S+) up", command):
+            interfaces[match[1]]["up"] = True
+        else:
+            return "", f"ip: unexpected arguments {command}\n", 1
+        return 0
+
+    def iptables(self, host, argv, stdin):
+        rule = " ".join([argv[0]] + argv[4:])
+        if argv[3] == "-C":
+            return 0 if rule in self.nat[host.name] else ("", "iptables: Bad rule\n", 1)
+        self.nat[host.name].append(rule)
+        return 0
+
+    def systemctl(self, host, argv, stdin):
+        self.restarts[host.name].append(argv[2])
+        return 0
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Caches and local copies are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def network(workdir):
+    with fake.FakeNetwork(strict=True, seed=fake.DEFAULT_SEED) as network:
+        yield network
+
+
+def machines(network: fake.FakeNetwork, hosts: [str]) -> Tools:
+    tools = Tools()
+    for host in hosts:
+        tools.install(network.host(host))
+    return tools
+
+
+def unhandled(network: fake.FakeNetwork) -> {str: [str]}:
+    return {name: [command["command"] for command in host.unhandled]
+            for name, host in network.hosts.items() if len(host.unhandled) != 0}
+
+
+def remote_yaml(network: fake.FakeNetwork, host: str, path: str) -> dict:
+    return config.parse_yaml(network.host(host).files[path].decode())
+
+
+def daemons(network: fake.FakeNetwork, host: str) -> [str]:
+    return sorted(process["name"] for process in network.host(host).processes.values())
+
+
+def test_simple_driver(network, workdir):
+    tools = machines(network, ["192.168.111.105", "192.168.111.110"])
+    simple.main()
+
+    assert unhandled(network) == {}
+    assert network.counts() == {"192.168.111.105": {"connect": 1, "exec": 1, "run": 2, "sudo": 2},
+                                "192.168.111.110": {"connect": 1, "exec": 1, "run": 3}}
+    assert network.round_trips("192.168.111.105") == 6
+    assert network.round_trips("192.168.111.110") == 5
+    amf = remote_yaml(network, "192.168.111.105", "/etc/open5gs/amf.yaml")
+    assert amf["amf"]["ngap"][0]["addr"] == "192.168.111.105"
+    assert amf["amf"]["guami"][0]["plmn_id"] == {"mcc": 999, "mnc": 99}
+    assert sorted(tools.restarts["192.168.111.105"]) == ["open5gs-amfd", "open5gs-upfd"]
+    gnb = remote_yaml(network, "192.168.111.110", "/home/open5gs/UERANSIM/config/open5gs-gnb.yaml")
+    assert gnb["amfConfigs"][0]["address"] == "192.168.111.105"
+    assert (workdir / "transfers/.default_cache/open5gs/version-2.7.0").is_dir()
+    assert (workdir / "transfers/.default_cache/ueransim/version-0123456789ab").is_dir()
+
+
+def test_simple_driver_second_run_skips_unchanged(network):
+    tools = machines(network, ["192.168.111.105", "192.168.111.110"])
+    simple.main()
+    network.reset()
+    simple.main()
+
+    assert unhandled(network) == {}
+    # Defaults come from the local cache and no config changed: only the version checks and hash comparisons are left
+    assert network.counts() == {"192.168.111.105": {"connect": 1, "run": 1, "sudo": 1},
+                                "192.168.111.110": {"connect": 1, "run": 2}}
+    assert len(tools.restarts["192.168.111.105"]) == 2
+
+
+def test_default_configs_replace_previous_version(network, workdir):
+    machines(network, ["192.168.111.105"])
+    stale = workdir / "transfers/all_open5gs"
+    stale.mkdir(parents=True)
+    (stale / "amf.yaml").write_text("amf: old\n")
+    (stale / "mme.yaml").write_text("mme: old\n")  # Not shipped by the installed version
+    (stale / ".cache_key").write_text("version-2.6.0")
+    c = vm.connect("192.168.111.105", username="open5gs", key_path="/keys/id_ed25519")
+
+    assert vm.get_default_configs_cached(c, "open5gs") == "./transfers/all_open5gs"
+    assert sorted(path.name for path in stale.iterdir()) == [".cache_key", "amf.yaml", "smf.yaml", "upf.yaml"]
+    assert (stale / ".cache_key").read_text() == "version-2.7.0"
+    assert sorted(path.name for path in (workdir / "transfers").iterdir()) == [".default_cache", "all_open5gs"]
+
+
+def test_build_artifact(network, workdir, caplog):
+    (workdir / "scripts").mkdir()
+    shutil.copy(os.path.join(REPO_ROOT, "scripts", "build_artifact.sh"), workdir / "scripts")
+    host = network.host("192.168.111.105")
+    c = vm.connect("192.168.111.105", username="open5gs", key_path="/keys/id_ed25519")
+
+    # Build that does not report its key (e.g. output lost) fails cleanly
+    host.on(r"/home/open5gs/build_artifact ", lambda host, argv, stdin: "")
+    assert vm.build_artifact(c, "open5gs") == ""
+    assert "did not report the artifact key" in caplog.text
+
+    def build(host, argv, stdin):
+        host.write(argv[2], b"artifact")
+        return "Building open5gs\nKEY 2.7.0\n"
+    host.on(r"/home/open5gs/build_artifact ", build)
+    assert vm.build_artifact(c, "open5gs") == os.path.join(vm.ARTIFACT_DIR, "open5gs", "2.7.0.tar")
+    assert (workdir / "transfers/.artifacts/open5gs/2.7.0.tar").read_bytes() == b"artifact"
+
+
+def test_pool_counts_sessions(network, workdir):
+    pool = vm.ConnectionPool()
+    key = ("10.1.0.1", "open5gs", "/keys/id_ed25519")
+    c = pool.get(*key[:1], username=key[1], key_path=key[2])
+    (workdir / "local.yaml").write_text("a: 1\n")
+    vm.execute(c, command="true")
+    vm.execute_batch(c, commands=["true", "true"])  # One channel
+    vm.put_data(c, "a: 1\n", "/tmp/a.yaml")
+    vm.put_file(c, str(workdir / "local.yaml"), "/tmp/b.yaml", overwrite=True)  # SFTP channel and chmod
+    vm.put_file(c, str(workdir / "local.yaml"), "/tmp/c.yaml", overwrite=True)  # SFTP channel is reused
+    vm.get_file(c, "/tmp/b.yaml", "b.yaml")
+    vm.get_folder(c, "/tmp", "tmp")
+
+    # Every channel the transport opened is counted. That is each command plus the one SFTP session
+    channels = network.round_trips("10.1.0.1") - network.round_trips("10.1.0.1", "connect") - \
+        network.round_trips("10.1.0.1", "put") - network.round_trips("10.1.0.1", "get") + 1
+    assert pool.stats() == {key: {"handshakes": 1, "gets": 1, "sessions": channels}}
+    assert channels == 7
+
+    def use_pool(i):
+        vm.execute(pool.get(*key[:1], username=key[1], key_path=key[2]), command="true")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(use_pool, range(200)))
+    assert pool.stats() == {key: {"handshakes": 1, "gets": 201, "sessions": 207}}
+
+
+def test_simple_scenario(network):
+    machines(network, ["10.1.0.1", "10.1.0.2", "10.1.0.3", "10.1.0.4"])
+    results, errors = engine.run_scenario(SIMPLE_SCENARIO)
+
+    assert errors == {}
+    assert unhandled(network) == {}
+    assert len(results) == 17
+    assert network.counts() == {"10.1.0.1": {"connect": 1, "exec": 2, "run": 2, "sudo": 1},
+                                "10.1.0.2": {"connect": 1, "exec": 1, "sudo": 1},
+                                "10.1.0.3": {"connect": 1, "exec": 1, "run": 2, "sudo": 2},
+                                "10.1.0.4": {"connect": 1, "exec": 1, "sudo": 2}}
+    assert len(network.host("10.1.0.1").databases["open5gs"]["subscribers"]) == 3
+    assert daemons(network, "10.1.0.3") == ["nr-gnb"]
+    assert daemons(network, "10.1.0.4") == ["nr-ue"] * 3
+
+
+def test_semi_advanced_scenario(network):
+    tools = machines(network, SEMI_IPS)
+    results, errors = engine.run_scenario(semi.scenario(SEMI_IPS, "/keys/id_ed25519"))
+
+    assert errors == {}
+    assert unhandled(network) == {}
+    assert len(results) == 23
+    assert network.counts() == {"10.0.0.1": {"connect": 1, "exec": 2, "run": 2, "sudo": 5},
+                                "10.0.0.2": {"connect": 1, "exec": 1, "sudo": 4},
+                                "10.0.0.3": {"connect": 1, "exec": 1, "sudo": 4},
+                                "10.0.0.4": {"connect": 1, "exec": 1, "run": 2, "sudo": 2},
+                                "10.0.0.5": {"connect": 1, "exec": 1, "sudo": 2}}
+    amf = remote_yaml(network, "10.0.0.1", "/etc/open5gs/amf.yaml")
+    assert amf["amf"]["guami"][0]["plmn_id"] == {"mcc": "001", "mnc": "01"}
+    assert "plmn_mcc" not in amf["amf"]["guami"][0]
+    smf = remote_yaml(network, "10.0.0.1", "/etc/open5gs/smf.yaml")
+    assert [pfcp["addr"] for pfcp in smf["upf"]["pfcp"]] == ["10.0.0.2", "10.0.0.3"]
+    assert len(network.host("10.0.0.1").databases["open5gs"]["subscribers"]) == 5
+    assert daemons(network, "10.0.0.1") == sorted(f"open5gs-{name}d" for name in
+                                                  ["nrf", "scp", "udr", "udm", "ausf", "pcf", "bsf", "nssf", "amf",
+                                                   "smf"])
+    assert daemons(network, "10.0.0.2") == ["open5gs-upfd"]
+    assert {dev: interface["addr"] for dev, interface in tools.interfaces["10.0.0.2"].items()} == \
+        {"ogstun": "10.45.0.1/16", "ogstun2": "10.46.0.1/16"}
+    assert tools.sysctl["10.0.0.3"]["net.ipv4.ip_forward"] == "1"
+    assert len(tools.nat["10.0.0.3"]) == 2
+    assert daemons(network, "10.0.0.5") == ["nr-ue"] * 5
+
+
+def test_semi_advanced_driver(network, caplog):
+    # main() has no local inputs: a fresh checkout runs the whole case from the scenario
+    ips = ["192.168.111.111", "192.168.111.112", "192.168.111.113", "192.168.111.191", "192.168.111.192"]
+    tools = machines(network, ips)
+    semi.main()
+
+    assert unhandled(network) == {}
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
+    assert len(network.host(ips[0]).databases["open5gs"]["subscribers"]) == 5
+    assert daemons(network, ips[1]) == ["open5gs-upfd"]
+    assert len(tools.nat[ips[2]]) == 2
+    assert daemons(network, ips[4]) == ["nr-ue"] * 5
+
+
+def test_strict_host_fails_unhandled_commands(network):
+    # Without the simulated tools the UPF interfaces can not be created, and the launch has to fail
+    results, errors = engine.run_scenario(semi.scenario(SEMI_IPS, "/keys/id_ed25519"))
+
+    assert "launch:upf1" in errors
+    assert any(command.startswith("sysctl -w") for command in unhandled(network)["10.0.0.2"])
+
+
+def test_cli_dry_run(workdir, capsys):
+    # Default configs come from DEFAULT_SEED, so a clean checkout (no ./transfers) can run it
+    (workdir / "scenario.yaml").write_text(json.dumps(SIMPLE_SCENARIO))
+
+    assert cli.main(["--quiet", "--dry-run", "run", "scenario.yaml"]) == 0
+    output = capsys.readouterr()
+    assert "17 steps done, 0 failed" in output.out + output.err
+    assert all(ip in output.err for ip in ["10.1.0.1", "10.1.0.2", "10.1.0.3", "10.1.0.4"])
+    assert vm._BACKEND is fabric.Connection  # Real connections again after the dry run
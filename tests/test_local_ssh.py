@@ -0,0 +1,324 @@
+# test_VM_commands against local_ssh_server.LocalSSHServer: real SSH sessions, real shells and real SFTP on the
+# Local machine. Remote paths are kept in temporary folders, nothing outside of them is changed
+import invoke
+import paramiko
+import pytest
+import async_vm_commands as avm
+import fake_connection as fake
+import log_collector
+import test_VM_commands as vm
+import asyncio
+import os
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def server():
+    local_ssh_server = pytest.importorskip("local_ssh_server")
+    server = local_ssh_server.LocalSSHServer()
+    server.start_in_thread()
+    yield server
+    server.stop_in_thread()
+
+
+@pytest.fixture
+def connection(server):
+    # Commands run as the user of the test process whatever the username is. It only sets the remote home paths
+    opened = []
+
+    def _connect(username: str = "tester"):
+        opened.append(vm.connect("127.0.0.1", username=username, key_path=server.client_key_path, port=server.port))
+        opened[-1].config.run.in_stream = False  # Stdin of pytest can not be read
+        return opened[-1]
+
+    yield _connect
+    for c in opened:
+        c.close()
+
+
+def test_connect_errors(server, tmp_path, caplog):
+    with pytest.raises(ConnectionError):
+        vm.connect("127.0.0.1", username="tester", key_path=str(tmp_path / "missing_key"), port=server.port)
+    assert "does not exist" in caplog.text
+    other_key = str(tmp_path / "other_key")
+    paramiko.RSAKey.generate(2048).write_private_key_file(other_key)
+    with pytest.raises(ConnectionError):  # Key the server does not authorize
+        vm.connect("127.0.0.1", username="tester", key_path=other_key, port=server.port)
+    assert "authentication failed" in caplog.text
+
+
+def test_execute(connection, caplog):
+    c = connection()
+
+    assert vm.execute(c, command="echo out; echo err >&2").stdout == "out\n"
+    assert vm.execute(c, command="true").stdout == "<NO_OUTPUT>"
+    assert vm.execute(c, command="id -u", sudo=True).stdout.strip() == str(os.getuid())
+    with pytest.raises(invoke.UnexpectedExit) as e:
+        vm.execute(c, command="echo failed >&2; exit 3")
+    assert e.value.result.return_code == 3
+    assert "Error during execution of 'echo failed >&2; exit 3'" in caplog.text
+    assert "error code 3" in caplog.text
+
+
+@pytest.mark.parametrize("sudo", [False, True])
+def test_put_file_and_get_file(connection, tmp_path, monkeypatch, caplog, sudo):
+    monkeypatch.chdir(tmp_path)
+    c = connection()
+    local_path = tmp_path / "amf.yaml"
+    local_path.write_text("amf: 1\n")
+    dest = str(tmp_path / "remote_amf.yaml")
+    temp_files = set(os.listdir("/tmp"))
+
+    assert vm.put_file(c, str(local_path), dest, permissions="640", sudo=sudo) == dest
+    assert os.stat(dest).st_mode & 0o777 == 0o640
+    # Existing file is not overwritten without the flag. The error is logged, not raised
+    local_path.write_text("amf: 2\n")
+    assert vm.put_file(c, str(local_path), dest, sudo=sudo) == ""
+    assert "FileExistsError" in caplog.text or "already exists" in caplog.text
+    assert vm.put_file(c, str(local_path), dest, overwrite=True, sudo=sudo) == dest
+    assert vm.put_file(c, str(tmp_path / "missing.yaml"), dest, overwrite=True, sudo=sudo) == ""
+
+    vm.get_file(c, dest, "fetched/amf.yaml", sudo=sudo)
+    assert (tmp_path / "transfers/fetched/amf.yaml").read_text() == "amf: 2\n"
+    caplog.clear()
+    vm.get_file(c, str(tmp_path / "missing.yaml"), "fetched/missing.yaml", sudo=sudo)  # Logged, not raised
+    assert not (tmp_path / "transfers/fetched/missing.yaml").exists()
+    assert any(record.levelname == "ERROR" for record in caplog.records)
+    assert set(os.listdir("/tmp")) - temp_files == set()  # Temporary files of the sudo variants are removed
+
+
+def test_async_connect_errors(server, tmp_path, caplog):
+    with pytest.raises(ConnectionError):
+        asyncio.run(avm.connect("127.0.0.1", username="tester", key_path=str(tmp_path / "missing_key"),
+                                port=server.port))
+    assert "does not exist" in caplog.text
+
+
+@pytest.mark.parametrize("sudo", [False, True])
+def test_async_execute_put_file_and_get_file(server, tmp_path, monkeypatch, caplog, sudo):
+    monkeypatch.chdir(tmp_path)
+    local_path = tmp_path / "amf.yaml"
+    local_path.write_text("amf: 1\n")
+    dest = str(tmp_path / "remote_amf.yaml")
+    temp_files = set(os.listdir("/tmp"))
+
+    async def scenario():
+        # The user owns the temporary copy of a sudo get, so it has to exist. The server runs commands as root
+        c = await avm.connect("127.0.0.1", username="root", key_path=server.client_key_path, port=server.port)
+        try:
+            assert (await avm.execute(c, command="echo out", sudo=sudo)).stdout == "out\n"
+            with pytest.raises(invoke.UnexpectedExit):
+                await avm.execute(c, command="exit 3", sudo=sudo)
+            assert await avm.put_file(c, str(local_path), dest, permissions="640", sudo=sudo) == dest
+            assert await avm.put_file(c, str(local_path), dest, sudo=sudo) == ""
+            await avm.get_file(c, dest, "fetched/amf.yaml", sudo=sudo)
+            await avm.get_file(c, str(tmp_path / "missing.yaml"), "fetched/missing.yaml", sudo=sudo)
+        finally:
+            await c.close()
+
+    asyncio.run(scenario())
+    assert os.stat(dest).st_mode & 0o777 == 0o640
+    assert "already exists" in caplog.text
+    assert (tmp_path / "transfers/fetched/amf.yaml").read_text() == "amf: 1\n"
+    assert not (tmp_path / "transfers/fetched/missing.yaml").exists()
+    assert "Transfer failed: unable to fetch" in caplog.text
+    assert [name for name in set(os.listdir("/tmp")) - temp_files if name.startswith("vm_automation_")] == []
+
+
+def test_install_sim_parallel_reports_invalid_simulator(connection):
+    c = connection()
+    results, errors = vm.install_sim_parallel({c: "free5gc"})
+
+    assert results == {}
+    assert isinstance(errors["127.0.0.1"], ValueError)
+
+
+def test_install_sim_parallel_reports_failed_transfer(connection, monkeypatch):
+    # Home of the user does not exist on the server, so the install script can not be put there
+    monkeypatch.chdir(REPO_ROOT)
+    c = connection("no_such_user_vm_automation")
+    results, errors = vm.install_sim_parallel({c: "open5gs"})
+
+    assert results == {}
+    assert isinstance(errors["127.0.0.1"], OSError)
+
+
+def test_execute_with_input_reads_output_while_sending(connection):
+    # Command fills stderr (more than the SSH window) before it reads its input. Nothing may wait for the other side
+    data = b"x" * (4 * 1024 * 1024)
+    result = vm.execute_with_input(connection(), command="head -c 4194304 /dev/zero >&2; wc -c", data=data)
+
+    assert result.stdout.strip() == str(len(data))
+    assert len(result.stderr) == 4 * 1024 * 1024
+
+
+# Remote scripts of test_VM_commands and log_collector, run on the local server and on a fake machine. Both have to
+# Give the same results, fake_connection recognises the scripts by their shape and applies them to its files
+class Target:
+    def __init__(self, connect, folder: str, host=None):
+        self.connect = connect  # username -> connection
+        self.connection = connect("root")
+        self.folder = folder
+        self.host = host
+
+    def path(self, name: str) -> str:
+        return f"{self.folder}/{name}"
+
+    def write(self, name: str, data: bytes) -> None:
+        if self.host is not None:
+            self.host.write(self.path(name), data)
+        else:
+            with open(self.path(name), "wb") as file:
+                file.write(data)
+
+    def read(self, name: str) -> bytes:
+        if self.host is not None:
+            return self.host.read(self.path(name))
+        with open(self.path(name), "rb") as file:
+            return file.read()
+
+    def mode(self, name: str) -> int:
+        if self.host is not None:
+            return self.host.meta[self.path(name)]["mode"]
+        return os.stat(self.path(name)).st_mode & 0o777
+
+
+@pytest.fixture(params=["local", "fake"])
+def target(request, tmp_path, monkeypatch):
+    # Local copies are relative to the working directory. Remote files are in remote/
+    monkeypatch.chdir(tmp_path)
+    folder = str(tmp_path / "remote")
+    os.makedirs(folder)
+    if request.param == "local":
+        yield Target(request.getfixturevalue("connection"), folder)
+        return
+    with fake.FakeNetwork(strict=True) as network:
+        host = network.host("127.0.0.1")
+        host.makedirs(folder)
+        yield Target(lambda username: vm.connect("127.0.0.1", username=username, key_path="/keys/id_ed25519"),
+                     folder, host)
+        assert host.unhandled == []
+
+
+def test_execute_batch(target):
+    missing = target.path("missing")
+    results = vm.execute_batch(target.connection, commands=["echo one", f"cat {missing}", "echo never"],
+                               stop_on_error=False)
+
+    assert [(result.stdout, result.stderr, result.return_code) for result in results] == \
+        [("one\n", "", 0), ("", f"cat: {missing}: No such file or directory\n", 1), ("never\n", "", 0)]
+    with pytest.raises(invoke.UnexpectedExit):
+        vm.execute_batch(target.connection, commands=["true", "false", "echo never"])
+
+
+def test_put_data(target):
+    dest = target.path("a.yaml")
+
+    assert vm.put_data(target.connection, "a: 1\n", dest, permissions="600") == dest
+    assert vm.put_data(target.connection, "a: 2\n", dest) == ""  # Exists, overwrite not set
+    assert target.read("a.yaml") == b"a: 1\n"
+    assert target.mode("a.yaml") == 0o600
+    assert vm.put_data(target.connection, "a: 2\n", dest, overwrite=True) == dest
+    assert target.read("a.yaml") == b"a: 2\n"
+
+
+def test_put_data_bulk_and_remote_hashes(target):
+    target.write("old.yaml", b"old\n")
+    data = {target.path("old.yaml"): b"new\n", target.path("new.yaml"): b"fresh\n"}
+
+    assert vm.put_data_bulk(target.connection, data) == [target.path("new.yaml")]
+    assert target.read("old.yaml") == b"old\n"
+    assert vm.put_data_bulk(target.connection, data, overwrite=True, permissions="640") == list(data)
+    assert target.read("old.yaml") == b"new\n"
+    assert target.mode("new.yaml") == 0o640
+    hashes = vm.remote_hashes(target.connection, list(data) + [target.path("missing.yaml")])
+    assert hashes == {dest: vm.data_hash(content) for dest, content in data.items()}
+
+
+def test_get_folder(target):
+    target.write("amf.yaml", b"amf: 1\n")
+    target.write("smf.yaml", b"smf: 1\n")
+    target.write("notes.txt", b"text\n")
+
+    local_paths = vm.get_folder(target.connection, target.folder, "fetched", pattern="*.yaml")
+    assert sorted(os.path.basename(path) for path in local_paths) == ["amf.yaml", "smf.yaml"]
+    with open("./transfers/fetched/amf.yaml", "rb") as file:
+        assert file.read() == b"amf: 1\n"
+    assert vm.get_folder(target.connection, target.path("missing"), "fetched") == []
+
+
+def test_sudo_put_file(target, tmp_path):
+    local_path = tmp_path / "upf.yaml"
+    local_path.write_text("upf: 1\n")
+
+    vm.sudo_put_file(target.connection, str(local_path), target.path("upf.yaml"), permissions="640")
+    assert target.read("upf.yaml") == b"upf: 1\n"
+    assert target.mode("upf.yaml") == 0o640
+
+
+def test_default_config_key(target):
+    # UERANSIM is not installed for the user, so the key is the hash of its (missing) configs
+    if target.host is not None:
+        target.host.on(r"git ", lambda host, argv, stdin: ("", f"fatal: cannot change to '{argv[2]}'\n", 128))
+    c = target.connect("no_such_user_vm_automation")
+
+    assert vm.default_config_key(c, "ueransim") == "hash-e3b0c44298fc1c14"
+
+
+def test_collect_logs(target):
+    target.write("amf.log", b"first\n")
+    patterns = [target.path("*.log")]
+
+    assert log_collector.collect_logs(target.connection, patterns=patterns, sudo=False) == {target.path("amf.log"): 6}
+    target.write("amf.log", b"first\nsecond\n")
+    assert log_collector.collect_logs(target.connection, patterns=patterns, sudo=False) == {target.path("amf.log"): 7}
+    with open(os.path.join(log_collector.DEFAULT_DEST, "127.0.0.1", "amf.log"), "rb") as file:
+        assert file.read() == b"first\nsecond\n"
+
+
+def test_skip_unchanged_checks_permissions(target, tmp_path):
+    local_path = tmp_path / "amf.yaml"
+    local_path.write_text("amf: 1\n")
+    dest = target.path("amf.yaml")
+
+    assert vm.put_file(target.connection, str(local_path), dest, permissions="600", overwrite=True,
+                       skip_unchanged=True) == dest
+    assert target.mode("amf.yaml") == 0o600
+    # Same content, other mode: the transfer is not skipped
+    assert vm.put_files_bulk(target.connection, {str(local_path): dest}, permissions="640", overwrite=True,
+                             skip_unchanged=True) == [dest]
+    assert target.mode("amf.yaml") == 0o640
+    assert vm.put_files_bulk(target.connection, {str(local_path): dest}, permissions="640", overwrite=True,
+                             skip_unchanged=True) == []
+    assert vm.put_data(target.connection, "amf: 1\n", dest, permissions="600", overwrite=True,
+                       skip_unchanged=True) == dest
+    assert target.mode("amf.yaml") == 0o600
+
+
+def test_collect_logs_recovers_local_state(target):
+    target.write("amf.log", b"first\n")
+    patterns = [target.path("*.log")]
+    host_folder = os.path.join(log_collector.DEFAULT_DEST, "127.0.0.1")
+    log_collector.collect_logs(target.connection, patterns=patterns, sudo=False)
+    # Unfinished collection: bytes after the saved lengths, and a log the saved offsets do not know
+    with open(os.path.join(host_folder, "amf.log"), "ab") as file:
+        file.write(b"partial")
+    with open(os.path.join(host_folder, "notes.log"), "wb") as file:
+        file.write(b"kept")
+
+    assert log_collector.collect_logs(target.connection, patterns=patterns, sudo=False) == {}
+    with open(os.path.join(host_folder, "amf.log"), "rb") as file:
+        assert file.read() == b"first\n"
+    previous = [name for name in os.listdir(host_folder) if name.startswith("previous_")]
+    assert os.listdir(os.path.join(host_folder, previous[0])) == ["notes.log"]
+
+    # Offsets without the local lengths (e.g. of an older version): the collected files start a new generation
+    with open(os.path.join(host_folder, "offsets.json"), "w") as file:
+        file.write('{"remote": {}}')
+    assert log_collector.collect_logs(target.connection, patterns=patterns, sudo=False) == {target.path("amf.log"): 6}
+    previous = sorted(name for name in os.listdir(host_folder) if name.startswith("previous_"))
+    assert len(previous) == 2
+    assert sorted(os.listdir(os.path.join(host_folder, previous[1]))) == ["amf.log", "index.jsonl", "offsets.json"]
+    with open(os.path.join(host_folder, "amf.log"), "rb") as file:
+        assert file.read() == b"first\n"
@@ -1,32 +1,215 @@
 import ruamel.yaml as yaml
+from ruamel.yaml.comments import CommentedBase, CommentedMap
 import logging
 import copy
 import os
+import threading
+import re
+import functools
+import json
+import io
 from datetime import datetime
+from metrics import instrumented, argument, file_size
 
+# Parsed templates kept in memory, (file_path, round_trip): (mtime_ns, parsed yaml). See read_yaml_cached
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+_MAPPING_LINE = re.compile(r"( *)[^ #\-][^:#]*:\s*(#.*)?$")  # Key of a nested block, e.g. "  subnet:"
+_ENTRY_LINE = re.compile(r"( *)(- )?[^ #]")
 
-def read_yaml(file_path: str) -> dict:
+
+class YamlEngine:
+    """
+    Reusable, preconfigured yaml loader and dumper. The ruamel.yaml objects are built once per thread
+    (they are not thread safe) instead of on every call as the ruamel module functions do
+    Safe mode uses the C-accelerated (libyaml) parser and emitter if ruamel.yaml.clib is installed, otherwise
+    The pure Python ones. Documents are plain dicts and the output is the same as of the module functions
+    Round trip mode keeps comments, key order and indentation of the read document, so written configs differ
+    From the defaults only in the modified values. Documents are CommentedMaps (dict subclass), which
+    Modify_yaml and overlay_yaml handle the same as dicts. Round trip mode has no C implementation
+    """
+
+    def __init__(self, *, round_trip: bool = False, pure: bool = False):
+        """
+        :param round_trip: bool
+        :param pure: bool - use the pure Python implementation even if the C one is available
+        """
+        self.round_trip = round_trip
+        self.pure = pure
+        self._local = threading.local()
+
+    @property
+    def _yaml(self) -> yaml.YAML:
+        instance = getattr(self._local, "yaml", None)
+        if instance is None:
+            instance = yaml.YAML(typ="rt" if self.round_trip else "safe", pure=self.pure)
+            instance.default_flow_style = False
+            if self.round_trip:
+                instance.width = 4096  # Long values (e.g. paths) are not wrapped
+                instance.preserve_quotes = True
+            self._local.yaml = instance
+        return instance
+
+    @property
+    def accelerated(self) -> bool:
+        """
+        True if the C-accelerated parser is used
+        :return: bool
+        """
+        return self._yaml.Parser.__name__ == "CParser"
+
+    @staticmethod
+    def guess_indent(text: str) -> (int, int, int):
+        """
+        Returns (mapping, sequence, offset) indentation of the block style document, as accepted by YAML.indent
+        E.g. Open5Gs configs are (4, 4, 2), UERANSIM configs are (2, 4, 2)
+        :param text: str
+        :return: (int, int, int)
+        """
+        mapping, offset = None, None
+        parent = None  # Indentation of the last "key:" line with the nested block under it
+        for line in text.splitlines():
+            entry = _ENTRY_LINE.match(line)
+            if entry is None:
+                continue
+            column = len(entry.group(1))
+            if parent is not None and column > parent:
+                if entry.group(2):
+                    offset = column - parent if offset is None else offset
+                else:
+                    mapping = column - parent if mapping is None else mapping
+            if mapping is not None and offset is not None:
+                break
+            nested = _MAPPING_LINE.match(line)
+            parent = column if nested else None
+        mapping = mapping or 2
+        offset = 0 if offset is None else offset
+        return mapping, offset + 2, offset
+
+    def load(self, text: str) -> dict:
+        """
+        Parses yaml document from a string
+        :param text: str
+        :return: dict
+        """
+        yaml_data = self._yaml.load(text)
+        if self.round_trip and isinstance(yaml_data, CommentedMap):
+            yaml_data.yaml_indent = self.guess_indent(text)  # Kept by copy.copy and used by dump
+        return yaml_data
+
+    def dump(self, yaml_data: dict, stream=None) -> str | None:
+        """
+        Serializes yaml_data to stream, or returns it as a string if no stream is passed
+        :param yaml_data: dict
+        :param stream: text stream
+        :return: str | None
+        """
+        instance = self._yaml
+        if self.round_trip:
+            mapping, sequence, offset = getattr(yaml_data, "yaml_indent", (2, 2, 0))
+            instance.indent(mapping=mapping, sequence=sequence, offset=offset)
+        if stream is not None:
+            instance.dump(yaml_data, stream)
+            return None
+        output = io.StringIO()
+        instance.dump(yaml_data, output)
+        return output.getvalue()
+
+    def read(self, file_path: str) -> dict:
+        """
+        Reads yaml document from the file
+        :param file_path: str
+        :return: dict
+        """
+        with open(file_path, "r") as file:
+            return self.load(file.read())
+
+    def write(self, file_path: str, yaml_data: dict) -> None:
+        """
+        Writes yaml_data to the file, with unix line endings
+        :param file_path: str
+        :param yaml_data: dict
+        :return: None
+        """
+        with open(file_path, "w", newline="\n") as file:
+            self.dump(yaml_data, file)
+
+
+SAFE_ENGINE = YamlEngine()
+ROUND_TRIP_ENGINE = YamlEngine(round_trip=True)
+
+
+def engine_for(yaml_data: dict) -> YamlEngine:
+    """
+    Returns the engine able to write yaml_data: round trip engine for documents it has read, safe one otherwise
+    :param yaml_data: dict
+    :return: YamlEngine
+    """
+    return ROUND_TRIP_ENGINE if isinstance(yaml_data, CommentedBase) else SAFE_ENGINE
+
+
+@instrumented("read_yaml", remote=False,
+              size=lambda args, kwargs, result: file_size(argument(args, kwargs, 0, "file_path")))
+def read_yaml(file_path: str, *, round_trip: bool = False) -> dict:
     """
     Reads a yaml file specified in the file_path
+    If round_trip is set, comments, order and indentation are kept for write_yaml (see YamlEngine)
     :param file_path: str
+    :param round_trip: bool
     :return: dict
     """
-    with open(file_path, 'r') as text:
-        try:
-            yaml_parsed = yaml.safe_load(text)
-        except yaml.YAMLError as e:
-            logging.exception("Unable to process yaml stream:\n {}".format(e))
-            raise
-        # print(yaml.dump(yaml_parsed))
+    try:
+        yaml_parsed = (ROUND_TRIP_ENGINE if round_trip else SAFE_ENGINE).read(file_path)
+    except yaml.YAMLError as e:
+        logging.exception("Unable to process yaml stream:\n {}".format(e))
+        raise
+    return yaml_parsed
+
+
+def parse_yaml(text: str, *, round_trip: bool = False) -> dict:
+    """
+    Parses yaml document passed as a string (e.g. output of a remote cat command)
+    :param text: str
+    :param round_trip: bool
+    :return: dict
+    """
+    try:
+        return (ROUND_TRIP_ENGINE if round_trip else SAFE_ENGINE).load(text)
+    except yaml.YAMLError as e:
+        logging.exception("Unable to process yaml stream:\n {}".format(e))
+        raise
+
+
+def read_yaml_cached(file_path: str, *, round_trip: bool = False) -> dict:
+    """
+    Reads a yaml file specified in the file_path, same as read_yaml
+    Parsed file is kept in memory and reused until the modification time of the file changes
+    IMPORTANT NOTE: Returned dict is shared between the callers and must not be modified. Use overlay_yaml
+    :param file_path: str
+    :param round_trip: bool
+    :return: dict
+    """
+    mtime = os.stat(file_path).st_mtime_ns
+    with _template_cache_lock:
+        cached = _template_cache.get((file_path, round_trip))
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    yaml_parsed = read_yaml(file_path, round_trip=round_trip)
+    with _template_cache_lock:
+        _template_cache[(file_path, round_trip)] = (mtime, yaml_parsed)
     return yaml_parsed
 
 
+@instrumented("write_yaml", remote=False,
+              size=lambda args, kwargs, result: file_size(argument(args, kwargs, 0, "file_path")))
 def write_yaml(file_path: str, yaml_data: dict, *, overwrite: bool = False) -> None:
     """
     Writes yaml_data to the provided file in file_path.
     If overwrite flag is set, the destination file will be overwritten with the passed yaml_data
     If overwrite flag is not set and the file exists, FileExistsError is raised and yaml_data is not written
     Otherwise, overwrite flag has no effect
+    Documents read in the round trip mode are written with their comments and formatting
     :param file_path: str
     :param yaml_data: dict
     :param overwrite: bool
@@ -37,45 +220,152 @@ def write_yaml(file_path: str, yaml_data: dict, *, overwrite: bool = False) -> N
             raise FileExistsError("Overwrite file was not set, but file {} exists!".format(file_path))
         # exist_ok=false raises FileExistsError if folder exists, which is undesired if we write multiple files
         os.makedirs(os.path.dirname(file_path), exist_ok=True)  # Create a folder if it does not exist
-        with open(file_path, 'w', newline='\n') as output:
-            # Output compared with https://www.yamldiff.com/ - It is semantically the same
-            yaml.dump(yaml_data, output, default_flow_style=False, line_break=b'\n')
+        # Output compared with https://www.yamldiff.com/ - It is semantically the same
+        engine_for(yaml_data).write(file_path, yaml_data)
     except FileExistsError as e:
         logging.exception(e)
         raise
 
 
-def modify_dict(key: list[str], diff_dict: dict, new_value: int | str) -> dict:
-    message = "Could not assign key {}. No match".format(key)
-    try:
-        if len(key) == 1 and key[0][:-1] not in ("gnbSearchList", "amfConfigs"):
-            diff_dict[key[0]] = new_value
-        elif len(key) == 1:
-            if (len(diff_dict[key[0][:-1]]) - 1) < int(key[0][-1]):  # To avoid access of bad index
-                diff_dict[key[0][:-1]].append(new_value)
-            else:
-                diff_dict[key[0][:-1]][int(key[0][-1])] = new_value
+def yaml_to_string(yaml_data: dict, *, flow: bool = False) -> str:
+    """
+    Serializes yaml_data to a string with the preconfigured engine. Output is the same yaml as in write_yaml
+    If flow is set, the data is written in the (indented) flow style, which is a JSON document.
+    It is valid yaml for both Open5Gs and UERANSIM parsers and is serialized over 20 times faster
+    Flow is ignored for documents read in the round trip mode, as their formatting is kept
+    :param yaml_data: dict
+    :param flow: bool
+    :return: str
+    """
+    engine = engine_for(yaml_data)
+    if flow and not engine.round_trip:
+        return json.dumps(yaml_data, indent=2) + "\n"
+    return engine.dump(yaml_data)
 
-        if len(key) == 2:
-            if (len(diff_dict[key[0][:-1]]) - 1) < int(key[0][-1]):  # To avoid access of bad index
-                diff_dict[key[0][:-1]].append(dict())
-            diff_dict[key[0][:-1]][int(key[0][-1])][key[1]] = new_value
 
-        elif len(key) == 3:
-            # Last char of key[1] is the array index, hence we do slicing to get key name, and key[-1] to get arr index
-            if (len(diff_dict[key[0]][key[1][:-1]]) - 1) < int(key[1][-1]):  # To avoid access of bad index
-                diff_dict[key[0]][key[1][:-1]].append(dict())
-            diff_dict[key[0]][key[1][:-1]][int(key[1][-1])][key[2]] = new_value
+class DiffPath:
+    """
+    Compiled diff key, e.g. 'smf-subnet10-addr' or 'amf-guami-plmn_id-mcc'. See compile_key
+    Key is split by "-" once. Each part becomes a step (name, index, literal). Trailing digits of a part are
+    The list index (any number of digits), e.g. subnet10 -> ('subnet', 10, 'subnet10'). Paths can be of any depth.
+    Applying the path does not parse any strings. Rules of the apply:
+    - if the part exists as a key (e.g. class11 in uacAcc), it is used as is
+    - if the part has an index and names a list, the list element is used. Missing index appends a new element
+      (value for the last part, empty dict otherwise), e.g. gnbSearchList2 or amfConfigs1-address
+    - list reached by a part without an index is entered at its first element (e.g. amf-guami-plmn_id-mcc)
+      Below such a list, the last part has to name an existing key. New keys are created only on fully indexed
+      Paths (e.g. amf-guami0-plmn_id-mcc), so a misspelled key (amf-guami-plmn_mcc) fails instead of being added
+    """
+    __slots__ = ("key", "steps")
+
+    _INDEXED = re.compile(r"(.*[^0-9])([0-9]+)")
 
-        elif len(key) == 4:
-            diff_dict[key[0]][key[1]][0][key[2]][key[3]] = new_value
+    def __init__(self, key: str):
+        self.key = key
+        steps = []
+        for part in key.split("-"):
+            match = self._INDEXED.fullmatch(part)
+            if match:
+                steps.append((match.group(1), int(match.group(2)), part))
+            else:
+                steps.append((part, None, part))
+        self.steps = tuple(steps)
+
+    @staticmethod
+    def _child(parent, key, copied: set):
+        child = parent[key]
+        if copied is not None and id(child) not in copied and isinstance(child, (dict, list)):
+            child = copy.copy(child)  # Copy-on-write. Only containers on the path are copied
+            parent[key] = child
+            copied.add(id(child))
+        return child
+
+    def apply(self, root: dict, new_value, copied: set = None) -> None:
+        """
+        Assigns new_value in the root at this path. Root is modified in place
+        If copied set is passed, every container on the path that is not in the set (by id) is copied before
+        Being modified, and the copy is added to the set. Root itself has to be a copy already
+        :param root: dict
+        :param new_value: any
+        :param copied: set
+        :return: None
+        :raises KeyError, IndexError, TypeError: if the path does not match the root
+        """
+        node = root
+        last = len(self.steps) - 1
+        unindexed = False  # A list was entered without an index on the way
+        for i, (name, index, literal) in enumerate(self.steps):
+            owner, key = node, literal
+            if index is not None and literal not in node and isinstance(node.get(name), list):
+                owner, key = self._child(node, name, copied), index
+                if index >= len(owner):  # To avoid access of bad index, new element is appended
+                    owner.append(new_value if i == last else dict())
+                    key = len(owner) - 1
+                    if i == last:
+                        return
+                    if copied is not None:
+                        copied.add(id(owner[key]))
+            if i == last:
+                if unindexed and isinstance(owner, dict) and key not in owner:
+                    raise KeyError(f"{key} is not in the first element of a list entered without an index")
+                owner[key] = new_value
+                return
+            node = self._child(owner, key, copied)
+            if isinstance(node, list):  # List without index is entered at the first element
+                node = self._child(node, 0, copied)
+                unindexed = True
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_key(key: str) -> DiffPath:
+    """
+    Returns compiled DiffPath for the hyphenated diff key. Compiled keys are cached, so each key is parsed once
+    :param key: str
+    :return: DiffPath
+    """
+    return DiffPath(key)
 
-    except (KeyError, TypeError):
-        logging.exception(message)
 
+def compile_diff(new_values_dict: dict) -> [(DiffPath, object)]:
+    """
+    Compiles all keys of the diff dict (as accepted by modify_yaml). Result can be applied many times
+    With apply_compiled, e.g. to thousands of generated configs
+    :param new_values_dict: dict
+    :return: [(DiffPath, object)]
+    """
+    return [(compile_key(key), value) for key, value in new_values_dict.items()]
+
+
+def apply_compiled(diff_dict: dict, compiled_diff: [(DiffPath, object)], *, copied: set = None) -> dict:
+    """
+    Applies compiled diff (see compile_diff) to diff_dict in place. Keys that do not match are logged
+    If copied set is passed, containers on the modified paths are copied first (see DiffPath.apply)
+    :param diff_dict: dict
+    :param compiled_diff: [(DiffPath, object)]
+    :param copied: set
+    :return: dict
+    """
+    for path, new_value in compiled_diff:
+        try:
+            path.apply(diff_dict, new_value, copied)
+        except (KeyError, IndexError, TypeError, AttributeError):
+            logging.exception("Could not assign key {}. No match".format(path.key))
     return diff_dict
 
 
+def modify_dict(key: list[str], diff_dict: dict, new_value: int | str) -> dict:
+    """
+    Assigns new_value in diff_dict (in place) at the path described by the split diff key
+    E.g. ['smf', 'subnet0', 'addr']. See DiffPath for the path rules
+    :param key: list[str]
+    :param diff_dict: dict
+    :param new_value: int | str
+    :return: dict
+    """
+    return apply_compiled(diff_dict, [(compile_key("-".join(key)), new_value)])
+
+
+@instrumented("modify_yaml", remote=False)
 def modify_yaml(src_dict: dict, new_values_dict: dict) -> dict:
     """
     Function creates a modified deep copy of src_dict with values present in the new_values_dict
@@ -87,25 +377,46 @@ def modify_yaml(src_dict: dict, new_values_dict: dict) -> dict:
     :return: dict
     """
     diff_dict = copy.deepcopy(src_dict)  # By default, python does a shallow cpy, which results in modifying amf_dict
-    for key in new_values_dict:
-        diff_dict = modify_dict(key.split("-"), diff_dict, new_values_dict[key])
+    if hasattr(src_dict, "yaml_indent"):  # Formatting of round trip documents is not deep copied
+        diff_dict.yaml_indent = src_dict.yaml_indent
+    return apply_compiled(diff_dict, compile_diff(new_values_dict))
 
-    return diff_dict
+
+def overlay_yaml(src_dict: dict, new_values_dict: dict | list) -> dict:
+    """
+    Copy-on-write variant of modify_yaml. Creates a modified copy of src_dict with values present in new_values_dict
+    Only the containers on the paths touched by new_values_dict are copied, the rest is shared with src_dict.
+    Cost of a variant is proportional to the size of the diff, not to the size of the src_dict
+    New_values_dict can also be an already compiled diff (see compile_diff)
+    IMPORTANT NOTE: Returned dict shares data with src_dict. Neither of them should be modified in place later
+    :param src_dict: dict
+    :param new_values_dict: dict | list
+    :return: dict
+    """
+    if isinstance(new_values_dict, dict):
+        new_values_dict = compile_diff(new_values_dict)
+    diff_dict = copy.copy(src_dict)
+    # Containers that belong to the new dict already and can be modified in place
+    return apply_compiled(diff_dict, new_values_dict, copied={id(diff_dict)})
 
 
-def modify_helper(mode: str, dest: str, diff_dict: {str: int or str}, overwrite: bool) -> str:
+def modify_helper(mode: str, dest: str, diff_dict: {str: int or str}, overwrite: bool, *,
+                  round_trip: bool = False) -> str:
+    # If round_trip is set, written config keeps the comments and formatting of the default config
     daemons_open5gs = ("amf", "ausf", "bsf", "hss", "mme", "nrf", "nssf", "pcf", "pcrf",
                        "scp", "sgwc", "sgwu", "smf", "udm", "udr", "upf")
     try:
         # Check if we modify UERANSIM or Open5Gs config
         if mode.lower() in daemons_open5gs:
-            source_file = read_yaml(f"./transfers/all_open5gs/{mode}.yaml")
+            source_file = read_yaml_cached(f"./transfers/all_open5gs/{mode}.yaml", round_trip=round_trip)
         elif mode.lower() in ("gnb", "ue"):
-            source_file = read_yaml(f"./transfers/all_ueransim/open5gs-{mode}.yaml")
+            source_file = read_yaml_cached(f"./transfers/all_ueransim/open5gs-{mode}.yaml",
+                                           round_trip=round_trip)
         else:  # Invalid mode
             raise ValueError("Mode did not match any of the available options (Open5Gs or UERANSIM)")
 
-        new_file = modify_yaml(source_file, diff_dict)
+        # Template is shared with other calls, so only the parts touched by the diff are copied
+        new_file = overlay_yaml(source_file, diff_dict)
         dest_path = f"./transfers/{dest}"
         write_yaml(dest_path, new_file, overwrite=overwrite)
     except (ValueError, FileExistsError) as e:
@@ -120,7 +431,7 @@ def test_amf():
                  'amf-tai-plmn_id-mcc': "001", 'amf-tai-plmn_id-mnc': "01",
                  'amf-plmn_support-plmn_id-mcc': "001", 'amf-plmn_support-plmn_id-mnc': "01"}
     new_yaml_data = modify_yaml(yaml_data, test_dict)
-    print(yaml.dump(new_yaml_data))
+    print(yaml_to_string(new_yaml_data))
     write_yaml("./transfers/some_folder/amf_realconfig_test.yaml", new_yaml_data, overwrite=True)
 
 
@@ -140,7 +451,7 @@ def test_smf(advanced: bool = False):
         yaml_data1['smf']['info'] = list()  # Needs to be created manually
 
     new_yaml_data = modify_yaml(yaml_data1, test_dict)
-    print(yaml.dump(new_yaml_data))
+    print(yaml_to_string(new_yaml_data))
     write_yaml("./transfers/some_folder/smf_realconfig_test.yaml", new_yaml_data, overwrite=True)
 
 
@@ -151,7 +462,7 @@ def test_upf():
                  'upf-subnet1-addr': "10.46.0.1/16", 'upf-subnet1-dnn': "internet2", 'upf-subnet1-dev': "ogstun2"}
     yaml_data = read_yaml("./transfers/all_open5gs/upf.yaml")
     new_yaml_data = modify_yaml(yaml_data, test_dict)
-    #print(yaml.dump(new_yaml_data))
+    #print(yaml_to_string(new_yaml_data))
     write_yaml("./transfers/some_folder/upf_realconfig_test.yaml", new_yaml_data, overwrite=True)
 
 